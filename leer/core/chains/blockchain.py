@@ -5,12 +5,19 @@ from leer.core.storage.blocks_storage import BlocksStorage, RollBack
 from leer.core.storage.txos_storage import TXOsStorage
 from leer.core.storage.headers_storage import HeadersStorage
 from leer.core.storage.excesses_storage import ExcessesStorage
+from leer.core.storage.merkle_storage import cached_nodes
+from leer.core.chains.chain_state import ChainState
 from leer.core.parameters.dynamic import next_reward
+from leer.core.lubbadubdub import verification_pool
 from leer.core.utils import DOSException
 
 class Blockchain:
+  max_awaited_blocks = 1024 # download queue is scheduled over peers in windows, see BlocksDownloadScheduler
+  verification_lookahead = 64 # number of blocks on the path which outputs are verified in pool ahead of application
+
   def __init__(self, storage_space, notify_wallet=None):
     self.storage_space = storage_space
+    self.chain_state = ChainState(storage_space)
     self.awaited_blocks = {} # requested but not downloaded blocks
     self.storage_space.register_blockchain(self)
     self.download_queue = [] #Note: it's different from awaited blocks: download queue is queue of blocks still to be requested
@@ -53,15 +60,18 @@ class Blockchain:
     '''
     block = self.storage_space.blocks_storage.get(block_hash, rtx=wtx)
     block.non_context_verify(rtx=wtx) #build tx from skeleton
-    if not self.context_validation(block, wtx=wtx):
+    with cached_nodes(wtx, *self._merkle_trees()):
+      valid = self.context_validation(block, wtx=wtx)
+      if valid:
+        rb = RollBack()
+        rb.prev_state = self.current_tip(rtx=wtx)
+        # Note excesses_storage.apply_block_tx modidies transaction, in particular adds
+        # context-dependent address_excess_num_index to outputs. Thus it should be applied before txos_storage.apply_block_tx
+        excesses_num, rollback_updates = self.storage_space.excesses_storage.apply_block_tx(tx=block.tx, new_state=block_hash, wtx=wtx)
+        rollback_inputs, output_num = self.storage_space.txos_storage.apply_block_tx(tx=block.tx, new_state=block_hash, wtx=wtx, height=block.header.height)
+    if not valid:
       ch = self.storage_space.headers_manager.mark_subchain_invalid(block.hash, wtx=wtx, reason = "Block %s(h:%d) failed context validation"%(block.hash, block.header.height))
-      return self.update(wtx=wtx, reason="Detected corrupted block")    
-    rb = RollBack()
-    rb.prev_state = self.current_tip(rtx=wtx)
-    # Note excesses_storage.apply_block_tx modidies transaction, in particular adds
-    # context-dependent address_excess_num_index to outputs. Thus it should be applied before txos_storage.apply_block_tx
-    excesses_num, rollback_updates = self.storage_space.excesses_storage.apply_block_tx(tx=block.tx, new_state=block_hash, wtx=wtx)  
-    rollback_inputs, output_num = self.storage_space.txos_storage.apply_block_tx(tx=block.tx, new_state=block_hash, wtx=wtx)
+      return self.update(wtx=wtx, reason="Detected corrupted block")
     #Write to db
     burden_for_rollback = []
     for burden in block.tx.burdens:
@@ -74,22 +84,39 @@ class Blockchain:
     rb.num_of_added_outputs = output_num
     rb.num_of_added_excesses = excesses_num
     rb.burdens = burden_for_rollback
-    self.storage_space.blocks_storage.put_rollback_object(block_hash, rb, wtx=wtx)
+    self.storage_space.blocks_storage.put_rollback_object(block_hash, rb, wtx=wtx, height=block.header.height)
+    self.storage_space.headers_storage.set_main_chain(block.header.height, block_hash, wtx=wtx)
+    self.chain_state.remember(block_hash, self.storage_space.headers_storage.get(block_hash, rtx=wtx))
     self.storage_space.mempool_tx.update(rtx=wtx, reason="new block")
     if self.notify_wallet:
       self.notify_wallet("apply", block.tx, block.header.height)
     
 
   def _rollback(self, wtx):
-    rb = self.storage_space.blocks_storage.pop_rollback_object(self.current_tip(rtx=wtx), wtx=wtx)
     h = self.current_height(rtx=wtx)
-    self.storage_space.txos_storage.rollback(pruned_inputs=rb.pruned_inputs, num_of_added_outputs=rb.num_of_added_outputs, prev_state=rb.prev_state, wtx=wtx)
-    self.storage_space.excesses_storage.rollback(num_of_added_excesses=rb.num_of_added_excesses, prev_state=rb.prev_state, rollback_updates=rb.updated_excesses, wtx=wtx)
+    rb = self.storage_space.blocks_storage.pop_rollback_object(self.current_tip(rtx=wtx), wtx=wtx, height=h)
+    self.storage_space.headers_storage.unset_main_chain(h, wtx=wtx)
+    with cached_nodes(wtx, *self._merkle_trees()):
+      self.storage_space.txos_storage.rollback(pruned_inputs=rb.pruned_inputs, num_of_added_outputs=rb.num_of_added_outputs, prev_state=rb.prev_state, wtx=wtx, height=h)
+      self.storage_space.excesses_storage.rollback(num_of_added_excesses=rb.num_of_added_excesses, prev_state=rb.prev_state, rollback_updates=rb.updated_excesses, wtx=wtx)
     for burden in rb.burdens:
       self.storage_space.txos_storage.confirmed.burden.remove(burden[0], wtx=wtx)
     if self.notify_wallet:
       self.notify_wallet("rollback", rb, h)
 
+  def _rollback_is_possible(self, block_hash, rtx):
+    '''
+      Rollback to `block_hash` is impossible if spent outputs of next blocks are already collapsed (see prune_horizon)
+      or if rollback objects of next blocks are already deleted (see rollback_depth).
+    '''
+    height = self.storage_space.headers_storage.get(block_hash, rtx=rtx).height
+    return height >= max(self.storage_space.txos_storage.confirmed.settled_height(rtx=rtx),
+                         self.storage_space.blocks_storage.rollback_horizon(rtx=rtx))
+
+  def _merkle_trees(self):
+    confirmed = self.storage_space.txos_storage.confirmed
+    return confirmed.commitments, confirmed.txos, self.storage_space.excesses_storage.excesses
+
   def clean_old_block_requests(self):
     to_delete = []
     for bh in self.awaited_blocks:
@@ -103,7 +130,7 @@ class Blockchain:
 
   def _download_queued_blocks(self):
     self.clean_old_block_requests()
-    if len(self.awaited_blocks)>256:
+    if len(self.awaited_blocks)>self.max_awaited_blocks:
       return
     to_download = []
     for bh in self.download_queue:
@@ -115,7 +142,7 @@ class Blockchain:
 
   def _ask_for_blocks(self, block_hash):
     self.clean_old_block_requests()
-    if len(self.awaited_blocks)>256 or (block_hash in self.awaited_blocks):
+    if len(self.awaited_blocks)>self.max_awaited_blocks or (block_hash in self.awaited_blocks):
       return
     self.awaited_blocks[block_hash]=time()
     self.ask_for_blocks_hook(block_hash) #It should be set by user
@@ -124,8 +151,8 @@ class Blockchain:
   def context_validation(self, block, wtx):
     assert block.header.prev == self.current_tip(rtx=wtx)
     block.tx.verify(block_height=self.current_height(rtx=wtx), block_version = block.header.version, rtx=wtx, skip_non_context=True)
-    excesses_root = self.storage_space.excesses_storage.apply_block_tx_get_merkles_and_rollback(block.tx, wtx=wtx)
-    commitment_root, txos_root = self.storage_space.txos_storage.apply_block_tx_get_merkles_and_rollback(block.tx, wtx=wtx)
+    excesses_root = self.storage_space.excesses_storage.get_merkle_after_block_tx(block.tx, rtx=wtx)
+    commitment_root, txos_root = self.storage_space.txos_storage.get_merkles_after_block_tx(block.tx, rtx=wtx)
     if not [commitment_root, txos_root, excesses_root]==block.header.merkles:
       return False
     '''excesses = block.tx.additional_excesses + list(block.tx.updated_excesses.values())
@@ -172,20 +199,16 @@ class Blockchain:
     return True
 
   def current_tip(self, rtx):
-    ts,es = self.storage_space.txos_storage.confirmed.get_state(rtx=rtx), self.storage_space.excesses_storage.get_state(rtx=rtx)
-    es=None if es == b"" else es #TODO
-    assert ts==es
-    if ts==None:
-      return b"\x00"*32
-    return ts
+    return self.chain_state.tip_hash(rtx=rtx)
 
   def current_height(self,rtx):
-    current_tip = self.current_tip(rtx=rtx)
-    if current_tip==b"\x00"*32:
-      current_height = -1
-    else:
-      current_height = self.storage_space.blocks_storage.get(current_tip,rtx=rtx).header.height
-    return current_height
+    return self.chain_state.height(rtx=rtx)
+
+  def current_total_difficulty(self, rtx):
+    return self.chain_state.total_difficulty(rtx=rtx)
+
+  def current_tip_header(self, rtx):
+    return self.chain_state.tip_header(rtx=rtx)
 
   def update(self, wtx, reason=None):
     current_tip = self.current_tip(rtx=wtx)
@@ -199,6 +222,8 @@ class Blockchain:
       if good_path:
         break
       for ind, step in enumerate(path):
+        if step[0]=="ROLLBACK" and not self._rollback_is_possible(step[1], rtx=wtx):
+          break
         if step[0]=="ADDBLOCK":
           if not  self.storage_space.blocks_storage.has(step[1], rtx=wtx):
             #Try to download as much blocks as possible and break
@@ -220,6 +245,7 @@ class Blockchain:
               break
     if not good_path:
       return
+    self._verify_ahead(good_path, rtx=wtx)
     progress = self.process_path(good_path, wtx=wtx)
     if progress:# and (not good_path==actions[0]):
       # workaround for situations when branch with best known header is not available:
@@ -228,6 +254,20 @@ class Blockchain:
       self.update(wtx=wtx, reason="recursive check")
 
 
+  def _verify_ahead(self, path, rtx):
+    '''
+      Submit outputs of downloaded blocks on the path to verification pool, so that
+      they are verified in parallel while preceding blocks are applied.
+    '''
+    mempool = self.storage_space.txos_storage.mempool
+    outputs = []
+    for action, block_hash in [step for step in path if step[0]=="ADDBLOCK"][:self.verification_lookahead]:
+      if not self.storage_space.blocks_storage.has(block_hash, rtx=rtx):
+        break
+      block = self.storage_space.blocks_storage.get(block_hash, rtx=rtx)
+      outputs += [mempool[_o].serialize() for _o in block.transaction_skeleton.output_indexes if _o in mempool]
+    verification_pool.submit(outputs)
+
   def process_path(self, path, wtx):
     progress = False
     for step in path:
@@ -269,6 +309,21 @@ class Blockchain:
 
   def is_block_in_main_chain(self, block_hash, rtx):
     header = self.storage_space.headers_storage.get(block_hash,rtx=rtx)
-    return header.hash == self.storage_space.headers_manager.find_ancestor_with_height(self.current_tip(rtx=rtx), header.height, rtx=rtx) 
+    return block_hash == self.storage_space.headers_storage.get_main_chain_hash(header.height, rtx=rtx)
+
+  def fill_main_chain_index(self, wtx):
+    '''
+      Main chain index (height -> hash) is absent in databases created by old versions: fill it from tip down to genesis.
+    '''
+    headers_storage = self.storage_space.headers_storage
+    if self.current_height(rtx=wtx)<0 or not headers_storage.main_chain_index_is_empty(rtx=wtx):
+      return
+    _hash = self.current_tip(rtx=wtx)
+    while True:
+      header = headers_storage.get(_hash, rtx=wtx)
+      headers_storage.set_main_chain(header.height, _hash, wtx=wtx)
+      if header.height==0:
+        break
+      _hash = header.prev
     
 
@@ -0,0 +1,72 @@
+from collections import OrderedDict
+
+class ChainTip:
+  def __init__(self, _hash, height, total_difficulty, header):
+    self.hash = _hash
+    self.height = height
+    self.total_difficulty = total_difficulty
+    self.header = header
+
+
+class ChainState:
+  '''
+    Cache of blockchain tip: hash, height, total difficulty and header.
+
+    Tip hash is the state of txos and excesses trees and is always read from db (two lmdb gets),
+    since it is the only source which is consistent with transaction: changes made by aborted
+    write transaction or not visible in read transaction are never returned.
+    Everything else is determined by tip hash and is cached by it, so it is read
+    (from headers storage, not from blocks storage) only when tip changes.
+    Note, context of cached header (descendants, invalidity) may be outdated.
+  '''
+  __shared_states = {}
+  max_tips = 16
+
+  def __init__(self, storage_space):
+    path = storage_space.path
+    if not path in self.__shared_states:
+      self.__shared_states[path]={}
+    self.__dict__ = self.__shared_states[path]
+    self.storage_space = storage_space
+    self.tips = OrderedDict() # hash -> ChainTip, last used tips
+    self.storage_space.register_chain_state(self)
+
+  def tip_hash(self, rtx):
+    ts,es = self.storage_space.txos_storage.confirmed.get_state(rtx=rtx), self.storage_space.excesses_storage.get_state(rtx=rtx)
+    es=None if es == b"" else es #TODO
+    assert ts==es
+    if ts==None:
+      return b"\x00"*32
+    return ts
+
+  def tip(self, rtx):
+    '''
+      ChainTip for current tip visible in `rtx`, None if blockchain is empty.
+    '''
+    _hash = self.tip_hash(rtx=rtx)
+    if _hash==b"\x00"*32:
+      return None
+    if not _hash in self.tips:
+      self.remember(_hash, self.storage_space.headers_storage.get(_hash, rtx=rtx))
+    self.tips.move_to_end(_hash)
+    return self.tips[_hash]
+
+  def remember(self, _hash, header):
+    '''
+      Put ContextHeader of (new) tip with `_hash` to cache (hash is not recalculated since it is expensive).
+    '''
+    self.tips[_hash] = ChainTip(_hash, header.height, header.total_difficulty, header)
+    while len(self.tips) > self.max_tips:
+      self.tips.popitem(last=False)
+
+  def height(self, rtx):
+    tip = self.tip(rtx=rtx)
+    return tip.height if tip else -1
+
+  def total_difficulty(self, rtx):
+    tip = self.tip(rtx=rtx)
+    return tip.total_difficulty if tip else 0
+
+  def tip_header(self, rtx):
+    tip = self.tip(rtx=rtx)
+    return tip.header if tip else None
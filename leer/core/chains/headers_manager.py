@@ -1,11 +1,25 @@
 from leer.core.primitives.header import Header, PoPoW, VoteData, ContextHeader
 from leer.core.storage.headers_storage import HeadersStorage
 import time
+from collections import deque
 from leer.core.parameters.dynamic import next_reward, next_target, output_creation_fee
 from leer.core.parameters.constants import initial_target, initial_reward
 from leer.core.lubbadubdub.utils import compare_supply_and_merkle_roots
 
 
+def skip_height(height):
+  '''
+    Height of ancestor which is pointed by skip pointer of header with `height`.
+    Skips are chosen (as in bitcoin) so that any ancestor can be reached in O(log(height)) jumps.
+  '''
+  def invert_lowest_one(n):
+    return n & (n-1)
+  if height<2:
+    return 0
+  if height & 1:
+    return invert_lowest_one(invert_lowest_one(height-1))+1
+  return invert_lowest_one(height)
+
 class HeadersManager:
   def __init__(self, storage_space, do_not_check_pow=False):
     self.storage_space = storage_space
@@ -15,38 +29,41 @@ class HeadersManager:
 
   def set_genesis(self, genesis_header, wtx):
     self.genesis = genesis_header
-    self.best_tip = (self.genesis.hash, self.genesis.height)
-    if not self.storage_space.headers_storage.has(self.genesis.hash, rtx=wtx):
+    self.genesis_hash = self.genesis.hash
+    self.best_tip = (self.genesis_hash, self.genesis.height)
+    if not self.storage_space.headers_storage.has(self.genesis_hash, rtx=wtx):
       self.add_header(self.genesis, wtx=wtx)
 
 
   def add_header(self, header, wtx):
     #try:
-      assert header.check_self_consistency(), "Block header %s is invalid by itself"%(header.hash)
-      assert (not self.storage_space.headers_storage.has(header.hash, rtx=wtx)), "Duplication header %s"%(header.hash)
-
-      context_header = ContextHeader(header)
-      if self.storage_space.headers_storage.has(header.prev, rtx=wtx):
-        prev =  self.storage_space.headers_storage.get(header.prev, rtx=wtx)
-        context_header.connected_to_genesis = prev.connected_to_genesis
-        context_header.invalid = prev.invalid
-        prev.descendants.add(header.hash)
-        self.storage_space.headers_storage.update(header.prev, prev, wtx=wtx)
-      else:
-        context_header.connected_to_genesis = False
-        if not header == self.genesis:
-          self.loose_ends[header.prev] = header.hash
+      header_hash = header.hash
+      assert header.check_self_consistency(), "Block header %s is invalid by itself"%(header_hash)
+      assert (not self.storage_space.headers_storage.has(header_hash, rtx=wtx)), "Duplication header %s"%(header_hash)
+
+      with self.storage_space.headers_storage.batch(wtx):
+        context_header = ContextHeader(header)
+        if self.storage_space.headers_storage.has(header.prev, rtx=wtx):
+          prev =  self.storage_space.headers_storage.get(header.prev, rtx=wtx)
+          context_header.connected_to_genesis = prev.connected_to_genesis
+          context_header.invalid = prev.invalid
+          prev.descendants.add(header_hash)
+          self.storage_space.headers_storage.update(header.prev, prev, wtx=wtx)
         else:
-          context_header.connected_to_genesis = True
-
-      if header.hash in self.loose_ends:
-        context_header.descendants.add(self.loose_ends.pop(header.hash))
+          context_header.connected_to_genesis = False
+          if not header == self.genesis:
+            self.loose_ends[header.prev] = header_hash
+          else:
+            context_header.connected_to_genesis = True
+
+        if header_hash in self.loose_ends:
+          context_header.descendants.add(self.loose_ends.pop(header_hash))
         
 
-      self.storage_space.headers_storage.put(header.hash, context_header, wtx=wtx)
+        self.storage_space.headers_storage.put(header_hash, context_header, wtx=wtx)
 
-      if context_header.connected_to_genesis:
-        self.mark_subchain_connected_to_genesis(header.hash, wtx=wtx)
+        if context_header.connected_to_genesis:
+          self.mark_subchain_connected_to_genesis(header_hash, wtx=wtx)
       #if context_header.invalid:
       #  self.mark_subchain_invalid(header.hash)
 
@@ -60,98 +77,148 @@ class HeadersManager:
     #  raise e
 
   def mark_subchain_invalid(self, _hash, wtx, reason=None):
+    headers_storage = self.storage_space.headers_storage
+    root = headers_storage.get(_hash, rtx=wtx)
     if not reason:
       # reason of invalidity is by default inherited from prev block
-      this_header = self.storage_space.headers_storage.get(_hash, rtx=wtx)
-      prev_header = self.storage_space.headers_storage.get(this_header.prev, rtx=wtx)
-      reason=prev_header.reason      
-    to_be_marked = [_hash]
+      reason = headers_storage.get(root.prev, rtx=wtx).reason
+    to_be_marked = deque([_hash])
     # Recursion, while beatiful, can easily reach max depth here
     need_new_best_tip = False
-    while len(to_be_marked):
-      header_hash = to_be_marked.pop(0)
-      header = self.storage_space.headers_storage.get(header_hash, rtx=wtx)
-      header.invalid = True
-      if reason:
-        header.reason = reason
-      self.storage_space.headers_storage.put(header_hash, header, wtx=wtx)
-      to_be_marked += list(header.descendants)
-      if header.hash == self.best_tip[0]:
-        #subchain which was intended to be best occurs to be invalid
-        need_new_best_tip = True
+    with headers_storage.batch(wtx):
+      while len(to_be_marked):
+        header_hash = to_be_marked.popleft()
+        header = headers_storage.get(header_hash, rtx=wtx)
+        header.invalid = True
+        if reason:
+          header.reason = reason
+        headers_storage.put(header_hash, header, wtx=wtx)
+        headers_storage.remove_tip(header_hash, header, wtx=wtx)
+        to_be_marked.extend(header.descendants)
+        if header_hash == self.best_tip[0]:
+          #subchain which was intended to be best occurs to be invalid
+          need_new_best_tip = True
+      # prev of invalidated subchain may become leaf again
+      if headers_storage.has(root.prev, rtx=wtx):
+        prev = headers_storage.get(root.prev, rtx=wtx)
+        if self._is_valid_leaf(prev, rtx=wtx):
+          headers_storage.add_tip(root.prev, prev, wtx=wtx)
     if need_new_best_tip:
       self.find_best_tip(rtx=wtx)
 
+  def _is_valid_leaf(self, header, rtx):
+    if header.invalid or not header.connected_to_genesis:
+      return False
+    for descendant_hash in header.descendants:
+      descendant = self.storage_space.headers_storage.get(descendant_hash, rtx=rtx)
+      if descendant.connected_to_genesis and not descendant.invalid:
+        return False
+    return True
+
+  def _headers_by_height(self, rtx):
+    '''
+      Generator of (hash, header) for all known headers in order of height.
+    '''
+    height = 0
+    while True:
+      try:
+        hashes = self.storage_space.headers_storage.get_headers_hashes_at_height(height, rtx=rtx)
+      except AssertionError:
+        break
+      for header_hash in hashes:
+        yield header_hash, self.storage_space.headers_storage.get(header_hash, rtx=rtx)
+      height += 1
+
+  def fill_tips_index(self, wtx):
+    '''
+      Index of valid leafs is absent in databases created by old versions: fill it from all headers.
+    '''
+    if not self.storage_space.headers_storage.tips_index_is_empty(rtx=wtx):
+      return
+    for header_hash, header in self._headers_by_height(rtx=wtx):
+      if self._is_valid_leaf(header, rtx=wtx):
+        self.storage_space.headers_storage.add_tip(header_hash, header, wtx=wtx)
+
+  def fill_aggregates(self, wtx):
+    '''
+      Headers saved by old versions have no running aggregates (see ContextHeader.set_aggregates):
+      calculate them height by height for all headers connected to genesis.
+    '''
+    headers_storage = self.storage_space.headers_storage
+    if headers_storage.get(self.genesis_hash, rtx=wtx).subsidy_votes_sum!=None:
+      return
+    for header_hash, header in self._headers_by_height(rtx=wtx):
+      if not header.connected_to_genesis:
+        continue
+      header.set_aggregates(None if header_hash==self.genesis_hash else headers_storage.get(header.prev, rtx=wtx))
+      headers_storage.update(header_hash, header, wtx=wtx)
+
   def mark_subchain_connected_to_genesis(self, _hash, wtx):
-    to_be_marked = [_hash]
+    '''
+      Breadth-first traversal of subchain: each header is processed after its prev, so prev
+      (already updated) is taken from working set of headers batch. Headers are written to db
+      once, when the whole subchain is processed.
+    '''
+    headers_storage = self.storage_space.headers_storage
+    to_be_marked = deque([_hash])
     # Recursion, while beatiful, can easily reach max depth here
-    while len(to_be_marked):
-      header_hash = to_be_marked.pop(0)
-      header = self.storage_space.headers_storage.get(header_hash,rtx=wtx)
-      header.connected_to_genesis = True
-      to_be_marked += list(header.descendants)
-      if _hash ==self.genesis.hash:
-        header.coins_to_be_mint = header.supply
-      else:
-        try:
-          header.coins_to_be_mint = self.storage_space.headers_storage.get(header.prev,rtx=wtx).coins_to_be_mint + \
-                                  sum(next_reward(header.prev, self.storage_space.headers_storage, rtx=wtx)) +\
-                                  output_creation_fee
-        except KeyError:
-          ''' If something is wrong with block.height, for instance it is set to 2000, while it is 20 in sequence
-              next_reward will raise.
-          '''
-          header.coins_to_be_mint = 0
-        header.total_difficulty = self.storage_space.headers_storage.get(header.prev, rtx=wtx).total_difficulty + header.difficulty
-        # we should save here, since context_validation checks coins_to_be_mint too
-        self.storage_space.headers_storage.put(header_hash, header, wtx=wtx)
-        if self.storage_space.headers_storage.get(header.prev, rtx=wtx).invalid:
-          header.invalid = True
-          header.reason = self.storage_space.headers_storage.get(header.prev, rtx=wtx).reason
+    with headers_storage.batch(wtx):
+      while len(to_be_marked):
+        header_hash = to_be_marked.popleft()
+        header = headers_storage.get(header_hash,rtx=wtx)
+        header.connected_to_genesis = True
+        to_be_marked.extend(header.descendants)
+        prev = None if header_hash==self.genesis_hash else headers_storage.get(header.prev, rtx=wtx)
+        header.set_aggregates(prev)
+        if not prev:
+          header.coins_to_be_mint = header.supply
         else:
           try:
-            self.context_validation(_hash, rtx=wtx)
-          except Exception as e:
+            header.coins_to_be_mint = prev.coins_to_be_mint + \
+                                    sum(next_reward(header.prev, headers_storage, rtx=wtx)) +\
+                                    output_creation_fee
+          except KeyError:
+            ''' If something is wrong with block.height, for instance it is set to 2000, while it is 20 in sequence
+                next_reward will raise.
+            '''
+            header.coins_to_be_mint = 0
+          header.total_difficulty = prev.total_difficulty + header.difficulty
+          self._set_skip(header_hash, header, wtx=wtx)
+          # we should save here, since context_validation checks coins_to_be_mint too
+          headers_storage.put(header_hash, header, wtx=wtx)
+          if prev.invalid:
             header.invalid = True
-            header.reason = str(e)
-      self.storage_space.headers_storage.put(header_hash, header, wtx=wtx)
-      # NOTE if new header has the same height as current best tip, best_tip will not be changed
-      # (header.height==self.best_tip[1] and header.hash > self.best_tip[0])
-      if header.height > self.best_tip[1]:
+            header.reason = prev.reason
+          else:
+            try:
+              self.context_validation(header_hash, rtx=wtx)
+            except Exception as e:
+              header.invalid = True
+              header.reason = str(e)
+        headers_storage.put(header_hash, header, wtx=wtx)
         if not header.invalid:
-          self.best_tip = (header.hash, header.height)
+          headers_storage.add_tip(header_hash, header, wtx=wtx)
+          if prev:
+            headers_storage.remove_tip(header.prev, prev, wtx=wtx)
+    self.find_best_tip(rtx=wtx)
 
   def is_known(self):
     pass
 
-  def find_best_tip(self, rtx): 
-    # This function should be called only if subchain which was
-    # intended to be best, occurs to be invalid. For all other cases
-    # get_best_tip should be called
-    
-    # TODO consider refactoring. Finding best tip should be implemented on 
-    # database level, smthing like SQL 
-    #`select * from headers where invalid==None and connected_to_genesis=True ORDER BY height desc limit 1`
-    height = self.best_tip[1]+1
-    self.best_tip = None
-    while not self.best_tip:
-      height -=1
-      if height<0:
-        raise
-      try:
-        candidates = self.storage_space.headers_storage.get_headers_hashes_at_height(height, rtx=rtx)
-      except Exception as e: #specific exception
-        continue 
-      valid_candidates = []
-      for candidate_hash in candidates:
-        candidate = self.storage_space.headers_storage.get(candidate_hash, rtx=rtx)
-        if not candidate.invalid:
-          if candidate.connected_to_genesis: #Always true, consider to remove
-            valid_candidates.append(candidate_hash)
-      if len(valid_candidates):
-        best_candidate_hash = max(valid_candidates)
-        best_candidate = self.storage_space.headers_storage.get(best_candidate_hash, rtx=rtx)
-        self.best_tip = (best_candidate.hash, best_candidate.height)
+  def find_best_tip(self, rtx):
+    '''
+      Best tip is valid header connected to genesis with highest height. It is the last record
+      of index of valid leafs, unless current best tip is still valid leaf of the same height:
+      among tips of the same height the first seen is kept.
+    '''
+    headers_storage = self.storage_space.headers_storage
+    best_tip = headers_storage.best_tip(rtx=rtx)
+    if not best_tip:
+      raise Exception("There are no valid headers")
+    if self.best_tip[1]==best_tip[1] and headers_storage.has(self.best_tip[0], rtx=rtx):
+      if headers_storage.has_tip(self.best_tip[0], headers_storage.get(self.best_tip[0], rtx=rtx), rtx=rtx):
+        return
+    self.best_tip = best_tip
 
   def get_best_tip(self):
     return self.best_tip
@@ -329,37 +396,61 @@ class HeadersManager:
       assert header.integer_hash<header.target, "PoW less than target"
 
   def context_validation_of_subchain(self, from_hash, wtx):
-    to_be_validated = [from_hash]
+    to_be_validated = deque([from_hash])
     while len(to_be_validated):
-      header_hash = to_be_validated.pop(0)
+      header_hash = to_be_validated.popleft()
       check_descendants=True
       try:
         self.context_validation(header_hash, rtx=wtx)
       except Exception as e:
-        self.mark_subchain_invalid(header_hash, reason=str(e), rtx=wtx)
+        self.mark_subchain_invalid(header_hash, reason=str(e), wtx=wtx)
         check_descendants=False
       if check_descendants:
-        to_be_validated += list(self.storage_space.headers_storage.get(header_hash, rtx=wtx).descendants)
+        to_be_validated.extend(self.storage_space.headers_storage.get(header_hash, rtx=wtx).descendants)
+
 
+  def _set_skip(self, header_hash, header, wtx):
+    '''
+      Save skip pointer of header: hash of its ancestor at skip_height(header.height).
+      Prev header should already have skip pointer (headers are connected from genesis to tips).
+    '''
+    try:
+      skip = self.find_ancestor_with_height(header.prev, skip_height(header.height), rtx=wtx)
+    except Exception:
+      return # header with wrong height, it will be marked as invalid
+    self.storage_space.headers_storage.set_skip(header_hash, skip, wtx=wtx)
 
   def find_ancestor_with_height(self, header_hash, height, rtx):
+    '''
+      Main chain ancestors are taken from height->hash index of main chain, so
+      for headers in main chain it is one lookup. Headers from forks are traversed
+      via skip pointers till the fork point (or till the requested height), it takes O(log(length)) steps.
+      PoPoW pointers are used for headers without skip pointers.
+    '''
     # Previously we used recursion here, however we found in the wild 
     # (testnet2) that we can hit recursion limit: if PoW is constantly less
     # than 2**252 our fast PoPoW navigation doesn't work and instead we searchin
     # block after block. Thousand of such 'low PoW blocks' and we hit limit.
-    header = self.storage_space.headers_storage.get(header_hash, rtx=rtx)
-    confirmed_search_point = header
+    headers_storage = self.storage_space.headers_storage
+    search_hash, search_point = header_hash, headers_storage.get(header_hash, rtx=rtx)
+    if search_point.height<height:
+      raise Exception("Asking for ancestor with higher height")
     while True:
-      for pointer in confirmed_search_point.popow.pointers[:-1]:
-        next_search_point = self.storage_space.headers_storage.get(pointer, rtx=rtx)
-        if next_search_point.height<height:
-          break
-        else:
-          confirmed_search_point = next_search_point
-      if confirmed_search_point.height<height:
-        raise Exception("Asking for ancestor with higher height")
-      if confirmed_search_point.height==height:
-          return confirmed_search_point.hash
-      if confirmed_search_point.height==height+1:
-          return confirmed_search_point.prev
+      if search_point.height==height:
+        return search_hash
+      if headers_storage.get_main_chain_hash(search_point.height, rtx=rtx)==search_hash:
+        return headers_storage.get_main_chain_hash(height, rtx=rtx)
+      if search_point.height==height+1:
+        return search_point.prev
+      skip = headers_storage.get_skip(search_hash, rtx=rtx)
+      if skip and skip_height(search_point.height)>=height:
+        search_hash = skip
+      else:
+        search_hash = search_point.prev
+        if not skip:
+          for pointer in search_point.popow.pointers[1:-1]:
+            if headers_storage.get(pointer, rtx=rtx).height<height:
+              break
+            search_hash = pointer
+      search_point = headers_storage.get(search_hash, rtx=rtx)
 
@@ -1,10 +1,13 @@
 #general imports
 import logging
 #specific imports from std
-from time import sleep, time
+from time import time
+from heapq import heappush, heappop
+from itertools import count
 from uuid import uuid4
 from functools import partial
 from ipaddress import ip_address
+from os.path import expanduser
 #imports from 3rd party
 from secp256k1_zkp import PrivateKey
 #general leer imports
@@ -21,6 +24,8 @@ from leer.core.storage.blocks_storage import BlocksStorage
 from leer.core.storage.excesses_storage import ExcessesStorage
 from leer.core.storage.utxo_index_storage import UTXOIndex
 from leer.core.storage.mempool_tx import MempoolTx
+from leer.core.storage.snapshot import import_snapshot
+from leer.core.storage.verification_cache import verification_cache
 #primitives imports
 from leer.core.lubbadubdub.address import Address
 from leer.core.lubbadubdub.transaction import Transaction
@@ -32,7 +37,7 @@ from leer.core.core_operations.receiving_assets import process_new_headers, proc
 from leer.core.core_operations.sending_metadata import send_tip_info, notify_all_nodes_about_new_tip, send_find_common_root
 from leer.core.core_operations.process_metadata import metadata_handlers
 from leer.core.core_operations.notifications import set_notify_wallet_hook, set_value_to_queue
-from leer.core.core_operations.downloading import download_status_checks
+from leer.core.core_operations.downloading import queue_blocks_download, schedule_blocks_download, queue_txos_download, schedule_txos_download
 from leer.core.core_operations.process_requests import request_handlers
 from leer.core.core_operations.handle_mining import mining_operations
 from leer.core.core_operations.blockchain_initialization import init_blockchain, validate_state, set_ask_for_blocks_hook, set_ask_for_txouts_hook
@@ -44,7 +49,10 @@ storage_space = None
 def init_storage_space(config):
   global storage_space
   _path = config["location"]["basedir"]
-  storage_space=StorageSpace(_path)
+  storage_config = config.get("storage", {})
+  storage_space=StorageSpace(_path, mmr_node_storage=storage_config.get("mmr_node_storage", {}),
+                                    prune_horizon=storage_config.get("prune_horizon", None),
+                                    rollback_depth=storage_config.get("rollback_depth", 1024))
   with storage_space.env.begin(write=True) as wtx:
     hs = HeadersStorage(storage_space, wtx=wtx)
     hm = HeadersManager(storage_space, do_not_check_pow=config.get('testnet_options', {}).get('do_not_check_pow', False))
@@ -54,10 +62,30 @@ def init_storage_space(config):
     bc = Blockchain(storage_space)
     mptx = MempoolTx(storage_space, config["fee_policy"], config.get("mining", {}))
     utxoi = UTXOIndex(storage_space, wtx=wtx)
+    if "snapshot" in storage_config and bc.current_height(rtx=wtx)<1:
+      bootstrap_from_snapshot(storage_config["snapshot"], wtx=wtx)
     init_blockchain(storage_space, wtx=wtx, logger=logger)
     validate_state(storage_space, rtx=wtx, logger=logger)
   
 
+def bootstrap_from_snapshot(snapshot_config, wtx):
+  '''
+    Import state from snapshot file instead of downloading and applying all blocks from genesis.
+    If snapshot is broken, node starts from its current state.
+  '''
+  if not snapshot_config.get("tip", None):
+    logger.error("Can not bootstrap from snapshot: snapshot tip is not set in config")
+    return
+  expected_tip = bytes.fromhex(snapshot_config["tip"])
+  child_wtx = storage_space.env.begin(write=True, parent=wtx)
+  try:
+    meta = import_snapshot(storage_space, expanduser(snapshot_config["path"]), wtx=child_wtx, expected_tip=expected_tip)
+    child_wtx.commit()
+    logger.info("State is bootstrapped from snapshot at height %d"%meta['height'])
+  except Exception as e:
+    child_wtx.abort()
+    logger.error("Can not bootstrap from snapshot: %s"%str(e))
+
 def is_ip_port_array(x):
   res = True
   for _ in x:
@@ -102,8 +130,8 @@ def core_loop(syncer, config):
     syncer.queues['Wallet'].put({'action':'give new address', 'id':_id, 'sender': "Blockchain"})
     result = None
     start_time=time()
-    while True:
-      put_back = [] #We wait for specific message, all others will wait for being processed
+    put_back = [] #We wait for specific message, all others will wait for being processed
+    while not result and message_queue.wait(max(0, start_time+timeout-time())):
       while not message_queue.empty():
         message = message_queue.get()
         if (not 'id' in message)  or (not message['id']==_id):
@@ -111,13 +139,10 @@ def core_loop(syncer, config):
           continue
         result = message['result']
         break
-      for message in put_back:
-        message_queue.put(message)
-      if result:
-        break
-      sleep(0.01)
-      if time()-start_time>timeout:
-        raise Exception("get_new_address timeout: probably wallet has collapsed or not running")      
+    for message in put_back:
+      message_queue.put(message)
+    if not result:
+      raise Exception("get_new_address timeout: probably wallet has collapsed or not running")      
     if result=='error':
       raise Exception("Can not get_new_address: error on wallet side")      
     address = Address()
@@ -139,18 +164,34 @@ def core_loop(syncer, config):
   notify = partial(set_value_to_queue, syncer.queues["Notifications"], "Blockchain")
 
   core_context = CoreContext(storage_space, logger, nodes, notify, send_message, get_new_address, config)
+
+  def flush_txouts_requests(rtx):
+    #Outputs of just processed blocks are requested at once instead of waiting for requests cache check
+    queue_txos_download(requests_cache["txouts"], core=core_context)
+    requests_cache["txouts"] = []
+    schedule_txos_download(rtx=rtx, core=core_context)
+
   logger.debug("Start of core loop")
   with storage_space.env.begin(write=True) as rtx: #Set basic chain info, so wallet and other services can start work
     notify("blockchain height", storage_space.blockchain.current_height(rtx=rtx))
     notify("best header", storage_space.headers_manager.best_header_height)         
+  delayed_messages = [] # heap of (time, number, message), messages are processed not earlier than `time`
+  delayed_messages_counter = count()
+  def delay(message):
+    heappush(delayed_messages, (message['time'], next(delayed_messages_counter), message))
+
+  def incoming_messages():
+    while delayed_messages and delayed_messages[0][0]<=time():
+      yield heappop(delayed_messages)[2]
+    while not message_queue.empty():
+      yield message_queue.get()
+
   while True:
-    sleep(0.05)
-    put_back_messages = []
+    message_queue.wait(max(0, delayed_messages[0][0]-time()) if delayed_messages else None)
     notify("core workload", "idle")
-    while not message_queue.empty():
-      message = message_queue.get()
+    for message in incoming_messages():
       if 'time' in message and message['time']>time(): # delay this message
-        put_back_messages.append(message)
+        delay(message)
         continue
       if (('result' in message) and message['result']=="processed") or \
          (('result' in message) and message['result']=="set") or \
@@ -185,6 +226,8 @@ def core_loop(syncer, config):
           with storage_space.env.begin(write=True) as wtx:
             initial_tip = storage_space.blockchain.current_tip(rtx=wtx)
             process_new_blocks(message, wtx, core_context)
+            schedule_blocks_download(rtx=wtx, core=core_context)
+            flush_txouts_requests(rtx=wtx)
             after_tip = storage_space.blockchain.current_tip(rtx=wtx)
             notify("blockchain height", storage_space.blockchain.current_height(rtx=wtx))         
             if not after_tip==initial_tip:
@@ -194,6 +237,7 @@ def core_loop(syncer, config):
           notify("core workload", "processing new txos")
           with storage_space.env.begin(write=True) as wtx:
             process_new_txos(message, wtx=wtx, core=core_context)
+            flush_txouts_requests(rtx=wtx)
             #After downloading new txos some blocs may become downloaded
             notify("blockchain height", storage_space.blockchain.current_height(rtx=wtx)) 
             look_forward(nodes, send_to_network, rtx=wtx)
@@ -227,6 +271,14 @@ def core_loop(syncer, config):
           send_message(message["sender"], {"id": message["id"], "result":block_info})
         except Exception as e:
           send_message(message["sender"], {"id": message["id"], "result":"error", "error":str(e)})
+      if message["action"] == "give merkle proof":
+        notify("core workload", "composing merkle proof")
+        try:
+          with storage_space.env.begin(write=False) as rtx:
+            proof = compose_merkle_proof(message["tree"], message["indexes"], rtx=rtx)
+          send_message(message["sender"], {"id": message["id"], "result":proof})
+        except Exception as e:
+          send_message(message["sender"], {"id": message["id"], "result":"error", "error":str(e)})
       if message["action"] == "put arbitrary mining work" and is_benchmark:
         if not no_pow:
           raise Exception("`put arbitrary mining work` is only allowed for disabled pow checks")
@@ -279,11 +331,6 @@ def core_loop(syncer, config):
 
 
       #message from core_loop
-      if message["action"] in download_status_checks: # txouts and blocks download status checks
-        with storage_space.env.begin(write=True) as rtx:
-          ret_mes = download_status_checks[message["action"]](message, rtx, core_context)
-          if ret_mes:
-            put_back_messages.append(ret_mes)
       if message["action"] == "take nodes list":
         for node in message["nodes"]:
           if not node in nodes: #Do not overwrite
@@ -300,7 +347,7 @@ def core_loop(syncer, config):
         _id = str(uuid4())
         send_to_network({"action":"give intrinsic nodes list", "sender":"Blockchain", "id":_id})
         requests[_id] = "give nodes list"
-        put_back_messages.append({"action": "give nodes list reminder", "time":int(time())+3} )
+        delay({"action": "give nodes list reminder", "time":int(time())+3} )
 
       if message["action"] == "stop":
         logger.info("Core loop stops")
@@ -313,33 +360,23 @@ def core_loop(syncer, config):
           send_message(receiver, {"action":"stop", "sender":initiator})
 
       if message["action"] == "check requests cache":
-        put_back_messages.append({"action": "check requests cache", "time":int(time())+5} )
+        delay({"action": "check requests cache", "time":int(time())+5} )
         for k in requests_cache:
           if not len(requests_cache[k]):
             continue
           copy = list(set(requests_cache[k]))
           copy = sorted(copy, key= lambda x: requests_cache[k].index(x)) #preserve order of downloaded objects
           if k=="blocks":
-            chunk_size=20
-            while len(copy):
-              request, copy = copy[:chunk_size], copy[chunk_size:]
-              new_message = {"action": "check blocks download status", "block_hashes":request,
-                            "already_asked_nodes": [], "id": str(uuid4()),
-                            "time": -1 }
-              message_queue.put(new_message)
+            with storage_space.env.begin(write=False) as rtx:
+              queue_blocks_download(copy, rtx=rtx, core=core_context)
             requests_cache[k] = []
           if k=="txouts":
-            chunk_size=30
-            while len(copy):
-              request, copy = copy[:chunk_size], copy[chunk_size:]
-              new_message = {"action": "check txouts download status", "txos_hashes": request,
-                           "already_asked_nodes": [], "id": str(uuid4()),
-                           "time": -1 }
-              message_queue.put(new_message)
+            queue_txos_download(copy, core=core_context)
             requests_cache[k] = []
-
-    for _message in put_back_messages:
-      message_queue.put(_message)
+        with storage_space.env.begin(write=False) as rtx:
+          schedule_blocks_download(rtx=rtx, core=core_context)
+          schedule_txos_download(rtx=rtx, core=core_context)
+        notify("verification cache", verification_cache.stats())
 
     try:
       with storage_space.env.begin(write=True) as rtx:
@@ -358,18 +395,14 @@ def look_forward(nodes, send_to_network, rtx):
     for node_index in nodes:
       node = nodes[node_index]
       if ('height' in node) and (node['height']>storage_space.headers_manager.best_header_height):
-        our_tip_hash = storage_space.blockchain.current_tip(rtx=rtx)
-        send_find_common_root(storage_space.headers_storage.get(our_tip_hash,rtx=rtx), node['node'], send = send_to_network)
+        send_find_common_root(storage_space.blockchain.current_tip_header(rtx=rtx), node['node'], send = send_to_network)
         break
 
 def compose_block_info(block_num, rtx):
-  ct = storage_space.blockchain.current_tip(rtx=rtx)
   ch = storage_space.blockchain.current_height(rtx=rtx)
   if block_num>ch:
     raise Exception("Unknown block")
-  target_hash = ct
-  if block_num<ch:
-    target_hash = storage_space.headers_manager.find_ancestor_with_height(ct, block_num, rtx=rtx)
+  target_hash = storage_space.headers_storage.get_main_chain_hash(block_num, rtx=rtx)
   block = storage_space.blocks_storage.get(target_hash, rtx=rtx)
   result = {'hash':target_hash.hex()}
   result['target']=float(block.header.target)
@@ -393,6 +426,32 @@ def compose_block_info(block_num, rtx):
     result['outputs'].append(({"output_id":index, "address":address, "lock_height":lock_height, "relay_fee":relay_fee, "version":version, "amount":amount}))
   return result
   
+def compose_merkle_proof(tree, indexes, rtx):
+  '''
+    Merkle proof for `indexes` in "txos" (outputs, with spent status) or "excesses" tree at current tip.
+    All binary data is hex encoded.
+  '''
+  def proof_to_json(proof):
+    return {'num_of_elements': proof['num_of_elements'], 'sequence_nums': proof['sequence_nums'],
+            'nodes': [[level, sequence_num, node.hex()] for level, sequence_num, node in proof['nodes']]}
+  ct = storage_space.blockchain.current_tip(rtx=rtx)
+  header = storage_space.headers_storage.get(ct, rtx=rtx)
+  commitment_root, txo_root, excesses_root = header.merkles
+  result = {'hash':ct.hex(), 'height':header.height}
+  if tree=="txos":
+    proof = storage_space.txos_storage.confirmed.get_proof(indexes, rtx=rtx)
+    result['txo_root'], result['commitment_root'] = txo_root.hex(), commitment_root.hex()
+    result['txos_proof'] = proof_to_json(proof['txos'])
+    result['commitments_proof'] = proof_to_json(proof['commitments'])
+    result['commitment_leafs'] = [leaf.hex() for leaf in proof['commitment_leafs']]
+  elif tree=="excesses":
+    proof = storage_space.excesses_storage.get_proof(indexes, rtx=rtx)
+    result['excesses_root'] = excesses_root.hex()
+    result['excesses_proof'] = proof_to_json(proof)
+  else:
+    raise Exception("Unknown tree")
+  return result
+
 def check_sync_status(nodes, rtx, core_context):
   for node_index in nodes:
     node = nodes[node_index]
@@ -8,33 +8,16 @@ def init_blockchain(storage_space, wtx, logger):
   genesis = Block(storage_space = storage_space)
   genesis.deserialize(serialized_genesis_block)
   storage_space.headers_manager.set_genesis(genesis.header, wtx=wtx)
+  storage_space.headers_manager.fill_aggregates(wtx=wtx)
+  storage_space.headers_manager.fill_tips_index(wtx=wtx)
   if storage_space.blockchain.current_height(rtx=wtx)<0:
     storage_space.headers_manager.context_validation(genesis.header.hash, rtx=wtx)
     genesis.non_context_verify(rtx=wtx)
     storage_space.blockchain.add_block(genesis, wtx=wtx)
   else:
-    storage_space.headers_manager.best_tip = (storage_space.blockchain.current_tip(rtx=wtx), storage_space.blockchain.current_height(rtx=wtx) )
-    logger.info("Best header tip from blockchain state %d"%storage_space.headers_manager.best_tip[1])
-    #greedy search
-    current_tip = storage_space.headers_manager.best_tip[0]
-    while True:
-      try:
-        header = storage_space.headers_storage.get(current_tip, rtx=wtx)
-      except KeyError:
-        break
-      new_current_tip=current_tip
-      if len(header.descendants):
-        for d in header.descendants:
-          dh = storage_space.headers_storage.get(d, rtx=wtx)
-          if not dh.invalid:
-            new_current_tip = d
-            break
-      if not new_current_tip == current_tip:
-        current_tip=new_current_tip
-      else:
-        break
-    storage_space.headers_manager.best_tip = (current_tip, storage_space.headers_storage.get(current_tip, rtx=wtx).height)
-    logger.info("Best header tip after greedy search %d"%storage_space.headers_manager.best_tip[1])
+    storage_space.blockchain.fill_main_chain_index(wtx=wtx)
+    storage_space.headers_manager.find_best_tip(rtx=wtx)
+    logger.info("Best header tip %d"%storage_space.headers_manager.best_tip[1])
 
 
 def validate_state(storage_space, rtx, logger):
@@ -1,8 +1,10 @@
 from functools import partial
+from leer.core.core_operations.download_scheduler import BlocksDownloadScheduler, TXOsDownloadScheduler
 class CoreContext:
   """
     CoreContext contains resources which are required during delegation of core processing
-    It contains storage_space, core logger, nodes list, send_notification and send_message interfaces.
+    It contains storage_space, core logger, nodes list, send_notification and send_message interfaces
+    and schedulers of downloads.
   """
 
   def __init__(self, storage_space, logger, nodes, send_notification, send_message, get_new_address, config):
@@ -14,4 +16,6 @@ class CoreContext:
     self.send_to_network = partial(self.send_to_subprocess, "NetworkManager")
     self.config = config
     self.get_new_address = get_new_address
+    self.blocks_scheduler = BlocksDownloadScheduler(self.send_to_network)
+    self.txos_scheduler = TXOsDownloadScheduler(self.send_to_network)
 
@@ -0,0 +1,228 @@
+from uuid import uuid4
+from time import time
+
+
+class PeerStats:
+  """
+    Download statistics of one peer: throughput is exponential moving average of
+    items per second over completed requests, `in_flight` is number of unanswered requests.
+  """
+  smoothing = 0.3
+
+  def __init__(self):
+    self.throughput = None
+    self.in_flight = 0
+    self.received = 0
+    self.timeouts = 0
+
+  def update_throughput(self, items, duration):
+    sample = items/max(duration, 1e-3)
+    if self.throughput==None:
+      self.throughput = sample
+    else:
+      self.throughput = self.smoothing*sample + (1-self.smoothing)*self.throughput
+
+  def penalize(self):
+    self.timeouts += 1
+    self.throughput = self.throughput/2 if self.throughput else None
+
+
+class Request:
+  def __init__(self, node, order, sent, deadline):
+    self.node = node
+    self.order = order # item -> order
+    self.items = set(order) # not yet received items
+    self.size = len(order)
+    self.sent = sent
+    self.deadline = deadline
+
+
+class DownloadScheduler:
+  """
+    Distributes download of items (blocks, txos) over peers.
+    Items are queued with `order` (height of block, for instance) and requested from peers
+    in windows of `window_size` items in ascending order. Each peer has budget of requests
+    in flight: peers with unknown throughput get `default_budget`, others get budget
+    proportional to their throughput (enough to be busy for `target_latency` seconds),
+    capped by `min_budget` and `max_budget`. Windows go to the fastest peer with spare budget.
+    Requests without response for `timeout` seconds are cancelled: their items are returned
+    to the queue and will not be requested from the same peer again, peer throughput is halved.
+  """
+  window_size = 16
+  default_budget = 2
+  min_budget = 1
+  max_budget = 8
+  target_latency = 10
+  timeout = 30
+
+  def __init__(self, request):
+    self.request = request # function(node_params, items) which sends request to network
+    self.queue = {} # item -> order
+    self.excluded = {} # item -> set of peers which failed to deliver it
+    self.in_flight = {} # item -> request id
+    self.requests = {} # request id -> Request
+    self.peers = {} # node_params -> PeerStats
+    self.received_num, self.timeouts_num = 0, 0
+
+  def add(self, item, order=0):
+    if not item in self.queue and not item in self.in_flight:
+      self.queue[item] = order
+
+  def forget(self, item):
+    self.queue.pop(item, None)
+    self.excluded.pop(item, None)
+    request_id = self.in_flight.pop(item, None)
+    if request_id:
+      self._complete(request_id, item, time())
+
+  def received(self, item, now=None):
+    """
+      Should be called for each downloaded item. Returns True if item was awaited.
+    """
+    now = time() if now==None else now
+    if not item in self.queue and not item in self.in_flight:
+      return False
+    self.received_num += 1
+    request_id = self.in_flight.pop(item, None)
+    self.queue.pop(item, None)
+    self.excluded.pop(item, None)
+    if request_id:
+      self._complete(request_id, item, now)
+    return True
+
+  def _complete(self, request_id, item, now):
+    request = self.requests[request_id]
+    request.items.discard(item)
+    if not request.items:
+      self.requests.pop(request_id)
+      peer = self.peer(request.node)
+      peer.in_flight -= 1
+      peer.received += request.size
+      peer.update_throughput(request.size, now-request.sent)
+
+  def peer(self, node_params):
+    if not node_params in self.peers:
+      self.peers[node_params] = PeerStats()
+    return self.peers[node_params]
+
+  def budget(self, peer):
+    if peer.throughput==None:
+      return self.default_budget
+    budget = int(peer.throughput*self.target_latency/self.window_size)
+    return max(self.min_budget, min(self.max_budget, budget))
+
+  def can_serve(self, node, orders):
+    return True
+
+  def _cancel(self, request_id, penalize=True):
+    request = self.requests.pop(request_id)
+    peer = self.peer(request.node)
+    peer.in_flight -= 1
+    if penalize:
+      peer.penalize()
+      self.timeouts_num += 1
+    for item in request.items:
+      self.in_flight.pop(item, None)
+      self.excluded.setdefault(item, set()).add(request.node)
+      self.queue[item] = request.order[item]
+
+  def _cancel_failed(self, nodes, now):
+    """
+      Timed out requests and requests to disconnected peers are cancelled,
+      items of the latter are returned to queue without penalty.
+    """
+    for request_id in [r for r in self.requests if self.requests[r].deadline<now]:
+      self._cancel(request_id)
+    for request_id in [r for r in self.requests if not self.requests[r].node in nodes]:
+      self._cancel(request_id, penalize=False)
+
+  def schedule(self, nodes, is_needed=None, now=None):
+    """
+      Cancel failed requests and assign queued items to peers from `nodes` (node_params -> node info).
+      Items for which `is_needed` returns False are forgotten.
+    """
+    now = time() if now==None else now
+    self._cancel_failed(nodes, now)
+    if is_needed:
+      for item in [item for item in list(self.queue)+list(self.in_flight) if not is_needed(item)]:
+        self.forget(item)
+    for item in [item for item in self.queue if self.excluded.get(item, set()).issuperset(nodes)]:
+      self.excluded.pop(item) # all peers failed, try them again
+    for node_params in [n for n in self.peers if not n in nodes and not self.peers[n].in_flight]:
+      self.peers.pop(node_params)
+    candidates = sorted(nodes, key=lambda n: -(self.peer(n).throughput or 0))
+    pending = sorted(self.queue, key=lambda item: self.queue[item])
+    while pending and candidates:
+      window, pending = pending[:self.window_size], pending[self.window_size:]
+      for node_params in candidates:
+        peer = self.peer(node_params)
+        if peer.in_flight >= self.budget(peer):
+          continue
+        if not self.can_serve(nodes[node_params], [self.queue[item] for item in window]):
+          continue
+        assigned = [item for item in window if not node_params in self.excluded.get(item, ())]
+        if not assigned:
+          continue
+        self._send(node_params, assigned, now)
+        break
+      candidates = [n for n in candidates if self.peer(n).in_flight < self.budget(self.peer(n))]
+
+  def _send(self, node_params, items, now):
+    request_id = str(uuid4())
+    request = Request(node_params, {item: self.queue.pop(item) for item in items}, now, now+self.timeout)
+    self.requests[request_id] = request
+    for item in items:
+      self.in_flight[item] = request_id
+    self.peer(node_params).in_flight += 1
+    self.request(node_params, items)
+
+  def stats(self):
+    return {'queued': len(self.queue), 'in_flight': len(self.in_flight), 'requests': len(self.requests),
+            'received': self.received_num, 'timeouts': self.timeouts_num,
+            'peers': {str(n): {'throughput': p.throughput, 'in_flight': p.in_flight,
+                               'received': p.received, 'timeouts': p.timeouts} for n, p in self.peers.items()}}
+
+
+class BlocksDownloadScheduler(DownloadScheduler):
+  """
+    Blocks are ordered by height and are requested only from peers which advertised
+    height not lower than heights of requested blocks.
+  """
+  window_size = 16
+
+  def __init__(self, send_to_network):
+    DownloadScheduler.__init__(self, self._request_blocks)
+    self.send_to_network = send_to_network
+
+  def can_serve(self, node, orders):
+    return node.get("height", -1) >= max(orders)
+
+  def _request_blocks(self, node_params, block_hashes):
+    self.send_to_network({"action":"give blocks", "block_hashes": bytes(b"".join(block_hashes)),
+                          "num": len(block_hashes), "id":str(uuid4()), "node":node_params })
+
+
+class TXOsDownloadScheduler(DownloadScheduler):
+  """
+    Outputs are requested in order they were asked for, in windows not larger than
+    requests served by "give txos" handlers. Any peer can serve any output, so outputs
+    which were not delivered in time are requested from other peers.
+  """
+  window_size = 30
+  default_budget = 4
+  max_budget = 16
+  timeout = 10
+
+  def __init__(self, send_to_network):
+    DownloadScheduler.__init__(self, self._request_txos)
+    self.send_to_network = send_to_network
+    self.counter = 0
+
+  def add(self, item, order=None):
+    if order==None:
+      order, self.counter = self.counter, self.counter+1
+    DownloadScheduler.add(self, item, order)
+
+  def _request_txos(self, node_params, txos_hashes):
+    self.send_to_network({"action":"give txos", "txos_hashes": b"".join(txos_hashes),
+                          "num": len(txos_hashes), "id":str(uuid4()), "node":node_params })
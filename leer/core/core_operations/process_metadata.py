@@ -29,10 +29,10 @@ def process_tip_info(message, node_info, rtx, core):
   node_info.update({"node":node, "height":height, "tip_hash":tip_hash, 
                     "prev_hash":prev_hash, "total_difficulty":total_difficulty, 
                     "last_update":time()})
-  if (height > core.storage_space.blockchain.current_height(rtx=rtx)) and (total_difficulty > core.storage_space.headers_storage.get(our_tip_hash, rtx=rtx).total_difficulty):
+  if (height > core.storage_space.blockchain.current_height(rtx=rtx)) and (total_difficulty > core.storage_space.blockchain.current_total_difficulty(rtx=rtx)):
     #Now there are two options: better headers are unknown or headers are known, but blocks are unknown or bad
     if not core.storage_space.headers_storage.has(tip_hash, rtx=rtx):
-      send_find_common_root(core.storage_space.headers_storage.get(our_tip_hash, rtx=rtx), node, send = core.send_to_network)
+      send_find_common_root(core.storage_space.blockchain.current_tip_header(rtx=rtx), node, send = core.send_to_network)
       #TODO check prev hash first
     else: #header is known
       header = core.storage_space.headers_storage.get(tip_hash, rtx=rtx)
@@ -149,8 +149,8 @@ def process_find_common_root_response(message, node_info, rtx, core):
                                 request_num,
                                 message["node"], send = core.send_to_network )
       if height-common_root_height>request_num:
-        our_tip = core.storage_space.headers_storage.get(core.storage_space.blockchain.current_tip(rtx=rtx), rtx=rtx)
-        if our_tip.hash != node_info["common_root"]["root"]: #It's indeed reorg
+        our_tip_hash = core.storage_space.blockchain.current_tip(rtx=rtx)
+        if our_tip_hash != node_info["common_root"]["root"]: #It's indeed reorg
             node_info["common_root"]["long_reorganization"]= core.storage_space.headers_storage.get(node_info["common_root"]["root"], rtx=rtx).height+request_num
 
 metadata_handlers = {"take tip info":process_tip_info, 
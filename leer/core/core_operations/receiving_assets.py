@@ -1,10 +1,11 @@
 from time import time
 from functools import partial
 
-from leer.core.utils import DOSException
+from leer.core.utils import DOSException, Reader
 from leer.core.primitives.block import Block
-from leer.core.primitives.header import Header
-from leer.core.lubbadubdub.ioput import IOput
+from leer.core.primitives.header import Header, precompute_headers_hashes
+from leer.core.lubbadubdub.ioput import IOput, verify_outputs_batch
+from leer.core.lubbadubdub import verification_pool
 from leer.core.primitives.transaction_skeleton import TransactionSkeleton
 
 from leer.core.core_operations.sending_assets import notify_all_nodes_about_tx
@@ -15,12 +16,16 @@ from leer.core.core_operations.sending_metadata import send_tip_info
 def process_new_headers(message, node_info, wtx, core):
   dupplication_header_dos = False #TODO grammatical typo?
   try:
-    serialized_headers = message["headers"]
+    serialized_headers = Reader(message["headers"])
     num = message["num"]
-    header = None
+    headers = []
     for i in range(num):
       header = Header()
-      serialized_headers = header.deserialize_raw(serialized_headers)
+      header.deserialize_raw(serialized_headers)
+      headers.append(header)
+    precompute_headers_hashes(headers)
+    header = None
+    for i, header in enumerate(headers):
       if not core.storage_space.headers_storage.has(header.hash, rtx=wtx):
         core.storage_space.headers_manager.add_header(header, wtx=wtx)
         if not i%20:
@@ -49,11 +54,12 @@ def process_new_headers(message, node_info, wtx, core):
 
 def process_new_blocks(message, wtx, core):
   try:
-    serialized_blocks = message["blocks"]
+    serialized_blocks = Reader(message["blocks"])
     num = message["num"]
     for i in range(num):
       block = Block(storage_space=core.storage_space)
-      serialized_blocks = block.deserialize_raw(serialized_blocks)
+      block.deserialize_raw(serialized_blocks)
+      core.blocks_scheduler.received(block.hash)
       core.storage_space.blockchain.add_block(block, wtx=wtx, no_update=True)
       if not i%5:
           core.storage_space.blockchain.update(wtx=wtx, reason="downloaded new blocks")
@@ -72,14 +78,24 @@ def process_new_txos(message, wtx, core):
     txos_lengths = message["txos_lengths"]
     txos_hashes = [txos_hashes[i*65:(i+1)*65] for i in range(0,num)]
     txos_lengths = [int.from_bytes(txos_lengths[i*2:(i+1)*2], "big") for i in range(0,num)]
+    utxos = []
+    reader = Reader(serialized_utxos)
     for i in range(num):
       txo_len, txo_hash = txos_lengths[i], txos_hashes[i]
+      core.txos_scheduler.received(txo_hash)
       if txo_hash in core.storage_space.txos_storage.mempool:
-        serialized_utxos = serialized_utxos[txo_len:]
+        reader.skip(txo_len)
         continue
       utxo = IOput()
-      serialized_utxos = utxo.deserialize_raw(serialized_utxos)
-      core.storage_space.txos_storage.mempool[utxo.serialized_index]=utxo
+      utxo.deserialize_raw(reader, verify=False)
+      utxos.append(utxo)
+    # outputs are verified by chunks in pool, the rest (if pool is not available) in batch here
+    verification_pool.submit([utxo.serialize() for utxo in utxos])
+    results = verify_outputs_batch(utxos)
+    for utxo, valid in zip(utxos, results):
+      if valid:
+        core.storage_space.txos_storage.mempool[utxo.serialized_index]=utxo
+    assert all(results), "Nonvalid output"
     core.storage_space.blockchain.update(wtx=wtx, reason="downloaded new txos")
   except Exception as e:
     raise DOSException() #TODO add info
@@ -4,10 +4,12 @@ from leer.core.core_operations.sending_assets import send_headers, send_blocks
 
 
 def send_tip_info(node_info, rtx, core, our_tip_hash=None ):
-  our_height = core.storage_space.blockchain.current_height(rtx=rtx)
-  our_tip_hash = our_tip_hash if our_tip_hash else core.storage_space.blockchain.current_tip(rtx=rtx)
-  our_prev_hash = core.storage_space.headers_storage.get(our_tip_hash, rtx=rtx).prev
-  our_td = core.storage_space.headers_storage.get(our_tip_hash, rtx=rtx).total_difficulty
+  tip = core.storage_space.chain_state.tip(rtx=rtx)
+  our_height = tip.height
+  our_tip_hash = our_tip_hash if our_tip_hash else tip.hash
+  our_header = tip.header if our_tip_hash==tip.hash else core.storage_space.headers_storage.get(our_tip_hash, rtx=rtx)
+  our_prev_hash = our_header.prev
+  our_td = our_header.total_difficulty
 
   core.send_to_network({"action":"take tip info", "height":our_height, "tip":our_tip_hash, "prev_hash":our_prev_hash, "total_difficulty":our_td, "id":uuid4(), "node": node_info["node"] })
   node_info["sent_tip"]=our_tip_hash
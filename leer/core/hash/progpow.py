@@ -1,4 +1,7 @@
 from hashlib import sha256
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing, os
 import progpow
 import functools
 
@@ -18,12 +21,64 @@ def partial_hash(_bytes):
     m1.update(seed1)
     return m1.digest()
 
-@functools.lru_cache(maxsize=256)
-def progpow_hash(header_height, serialized_header_without_nonce, nonce_bytes, version="0.9.2"):
+def _progpow_hash(header_height, serialized_header_without_nonce, nonce_bytes, version):
     check_handlers(version)
     ph = partial_hash(serialized_header_without_nonce)
     return handlers[version].hash(header_height, ph, int.from_bytes(nonce_bytes, "big"))
 
+@functools.lru_cache(maxsize=256)
+def progpow_hash(header_height, serialized_header_without_nonce, nonce_bytes, version="0.9.2"):
+    key = (header_height, serialized_header_without_nonce, nonce_bytes, version)
+    if key in precomputed:
+      return precomputed[key]
+    return _progpow_hash(*key)
+
+
+'''
+  Hashes of batches (for instance, headers received from network) are calculated in parallel
+  in pool of processes. Each worker keeps its own handlers (and so contexts) between tasks.
+  Results are stored in `precomputed` and are returned by following `progpow_hash` calls.
+'''
+max_precomputed = 4096
+min_parallel_batch = 8
+precomputed = OrderedDict() # (height, serialized_header_without_nonce, nonce_bytes, version) -> hash
+pool = None
+
+def _hash_chunk(chunk):
+    return [_progpow_hash(*item) for item in chunk]
+
+def _get_pool():
+    global pool
+    if not pool:
+      # spawn: workers should not inherit handlers (and threads) of parent process
+      pool = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("spawn"))
+    return pool
+
+def precompute_hashes(items):
+    '''
+      Calculate hashes for list of (header_height, serialized_header_without_nonce, nonce_bytes, version)
+      in pool of processes. Small batches and batches which can not be processed in pool are skipped:
+      they will be calculated by `progpow_hash` itself.
+    '''
+    global pool
+    items = [item for item in set(items) if not item in precomputed]
+    if len(items)<min_parallel_batch:
+      return
+    items.sort(key=lambda item: item[0]) # neighbouring heights share context
+    workers = os.cpu_count() or 1
+    chunk_size = -(-len(items)//workers)
+    chunks = [items[i:i+chunk_size] for i in range(0, len(items), chunk_size)]
+    try:
+      results = list(_get_pool().map(_hash_chunk, chunks))
+    except Exception:
+      pool = None # pool is broken, it will be recreated on the next batch
+      return
+    for chunk, hashes in zip(chunks, results):
+      for item, _hash in zip(chunk, hashes):
+        precomputed[item] = _hash
+    while len(precomputed)>max_precomputed:
+      precomputed.popitem(last=False)
+
 @functools.lru_cache(maxsize=5)
 def seed_hash(header_height, version="0.9.2"):
   check_handlers(version)
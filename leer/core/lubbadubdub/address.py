@@ -1,6 +1,7 @@
 import functools
 from secp256k1_zkp import PublicKey, ALL_FLAGS
 import hashlib, base64
+from leer.core.utils import Reader
 
 class Excess:
     '''
@@ -80,11 +81,11 @@ class Excess:
 
     def deserialize_raw(self, serialized_data):
         self.drop_cached()
-        consumed = b""
-        if len(serialized_data)<65:
+        reader = Reader.of(serialized_data)
+        start = reader.offset
+        if len(reader)<65:
           raise Exception("Not enough bytes to encode recovery signature")
-        rec_sig, serialized_data = serialized_data[:65], serialized_data[65:]
-        consumed += rec_sig
+        rec_sig = reader.read(65)
         unrelated = PublicKey(flags=ALL_FLAGS)
         if rec_sig[0] & 128 ==0:
           self.version = 0
@@ -94,16 +95,14 @@ class Excess:
           self.version = 1
           rec_sig = (rec_sig[0] - 128).to_bytes(1,"big") + rec_sig[1:]
           self.recoverable_signature = unrelated.ecdsa_recoverable_deserialize_raw(rec_sig)
-          if len(serialized_data)<2:
+          if len(reader)<2:
             raise Exception("Not enough bytes to encode message len")
-          mlen_ser, serialized_data = serialized_data[:2], serialized_data[2:]
-          mlen = int.from_bytes(mlen_ser, 'big')
-          if len(serialized_data)<mlen:
+          mlen = reader.read_int(2)
+          if len(reader)<mlen:
             raise Exception("Not enough bytes to encode message") 
-          self.message, serialized_data = serialized_data[:mlen], serialized_data[mlen:]
-          consumed += mlen_ser+self.message
-        self.serialized = consumed
-        return serialized_data      
+          self.message = reader.read(mlen)
+        self.serialized = reader.since(start)
+        return reader.residue(serialized_data)
 
     @property
     def index(self):
@@ -2,12 +2,15 @@ import struct
 import hashlib
 
 from secp256k1_zkp import PrivateKey, PedersenCommitment, RangeProof, BulletProof
+from secp256k1_zkp._libsecp256k1 import ffi, lib
 
 from leer.core.lubbadubdub.constants import default_generator, default_generator_ser, generators
 from leer.core.parameters.constants import dev_reward_serialized_address
 from leer.core.lubbadubdub.address import Address, Excess
 from leer.core.lubbadubdub.utils import encrypt, decrypt
 from leer.core.storage.verification_cache import verification_cache
+from leer.core.utils import Reader
+from leer.core.lubbadubdub import verification_pool
 
 dev_reward_address = Excess.from_serialized(dev_reward_serialized_address)
 
@@ -149,19 +152,22 @@ class IOput:
     self._serialized_apc = None
     self.deserialize_raw(serialized_output)
 
-  def deserialize_raw(self, serialized_output):  
-    """ Decode output from serialized representation. Return residue of data after serialization"""
+  def deserialize_raw(self, serialized_output, verify=True):  
+    """
+      Decode output from serialized representation. Return residue of data after serialization.
+      Bulletproof outputs are verified during decoding unless `verify` is False
+      (in that case they should be verified later, for instance by `verify_outputs_batch`).
+    """
     self.serialized = None
     self._serialized_apc = None
-    consumed = b""
+    reader = Reader.of(serialized_output)
+    start = reader.offset
 
-    if len(serialized_output)<145:
+    if len(reader)<145:
         raise Exception("Serialized output doesn't contain enough bytes for constant length parameters")
 
-    compact_data, serialized = serialized_output[:82], serialized_output[82:]
     (self.version, self.block_version, self.lock_height,
-      self.generator, self.relay_fee, self.apc) = struct.unpack("> H H L 33s Q 33s", compact_data) 
-    consumed+=compact_data
+      self.generator, self.relay_fee, self.apc) = struct.unpack("> H H L 33s Q 33s", reader.read(82)) 
 
     if self.generator in generators:
       self.authorized_pedersen_commitment = PedersenCommitment(commitment=self.apc, raw=True, value_generator = generators[self.generator])
@@ -169,29 +175,23 @@ class IOput:
       raise NotImplemented
 
     self.address = Address()
+    self.address.deserialize_raw(reader)
     
-    _serialized = self.address.deserialize_raw(serialized)
-    consumed += serialized[:len(serialized)-len(_serialized)]
-    serialized = _serialized
-    
-    if len(serialized)<2:
+    if len(reader)<2:
         raise Exception("Serialized output doesn't contain enough bytes for encrypted message length")
-    consumed+=serialized[:2]
-    (encrypted_message_len,), serialized = struct.unpack("> H", serialized[:2]) , serialized[2:]
-    if len(serialized)<encrypted_message_len:
+    encrypted_message_len = reader.read_int(2)
+    if len(reader)<encrypted_message_len:
         raise Exception("Serialized output doesn't contain enough bytes for encrypted message")
-    self.encrypted_message, serialized = serialized[:encrypted_message_len], serialized[encrypted_message_len:]
-    consumed += self.encrypted_message
+    self.encrypted_message = reader.read(encrypted_message_len)
 
-    if len(serialized)<2:
+    if len(reader)<2:
         raise Exception("Serialized output doesn't contain enough bytes for rangeproof length")
-    consumed+=serialized[:2]
-    (range_proof_len,), serialized = struct.unpack("> H", serialized[:2]), serialized[2:]
-    if len(serialized)<range_proof_len: 
+    range_proof_len = reader.read_int(2)
+    if len(reader)<range_proof_len: 
         raise Exception("Serialized output doesn't contain enough bytes for rangeproof")
 
     self._calc_unauthorized_pedersen()  
-    ser_rp, serialized = serialized[:range_proof_len], serialized[range_proof_len:]
+    ser_rp = reader.read(range_proof_len)
     if self.version in [0,1]:
       self.rangeproof = RangeProof(proof=ser_rp, 
           pedersen_commitment=self.unauthorized_pedersen_commitment, 
@@ -201,17 +201,17 @@ class IOput:
           pedersen_commitment=self.unauthorized_pedersen_commitment, 
           additional_data = self.signed_part())      
 
-    consumed += ser_rp
-
-    info=self.info()
-    self.serialized = consumed
-    return serialized
+    if verify or not self.version==2:
+      info=self.info()
+    self.serialized = reader.since(start)
+    return reader.residue(serialized_output)
 
 
   def deserialize_with_context(self, serialized_output):
-    residue = self.deserialize_raw(serialized_output)
-    self.address_excess_num_index, residue = residue[:5], residue[5:]
-    return residue
+    reader = Reader.of(serialized_output)
+    self.deserialize_raw(reader)
+    self.address_excess_num_index = reader.read(5)
+    return reader.residue(serialized_output)
 
   def detect_value(self, inputs_info):
     try:
@@ -408,13 +408,11 @@ class IOput:
       return verification_cache[self.serialize()]
     except KeyError:
       pass
-    result = True
-
     try:
-      assert self.address.verify(), "Bad address"
-      assert self.generator in generators, "Bad generator"
-    except AssertionError as e:
-      result = False
+      return verification_pool.collect(self.serialize())
+    except KeyError:
+      pass
+    result = self._verify_address_and_generator()
 
     if result:
       if self.version==1 or self.version==0:
@@ -433,6 +431,14 @@ class IOput:
     verification_cache[self.serialize()] = result
     return result
 
+  def _verify_address_and_generator(self):
+    try:
+      assert self.address.verify(), "Bad address"
+      assert self.generator in generators, "Bad generator"
+    except AssertionError as e:
+      return False
+    return True
+
   def info(self):
     """
       Returns dictionary with params extracted from proof:
@@ -461,3 +467,81 @@ class IOput:
       str(self.relay_fee), 
       ('0x'+self.blinding_key.serialize()[:8]) if self.blinding_key else 'unknown', )
     return s
+
+
+max_bulletproofs_batch = 64 # bigger batches do not fit default scratch space
+
+def _batch_verify_bulletproofs(bulletproofs):
+  """
+    Verify bulletproofs of the same length with one multi-exponentiation.
+    BulletProof.batch_verify of secp256k1_zkp passes NULL min values and one value generator
+    instead of array and fails for any batch, so the library function is called directly.
+  """
+  n = len(bulletproofs)
+  keep_alive = []
+  proofs = ffi.new("unsigned char *[]", n)
+  min_values = ffi.new("uint64_t *[]", n)
+  commits = ffi.new("secp256k1_pedersen_commitment *[]", n)
+  value_generators = ffi.new("secp256k1_generator []", n)
+  ads = ffi.new("unsigned char *[]", n)
+  adls = ffi.new("size_t []", n)
+  for i, bp in enumerate(bulletproofs):
+    keep_alive += [ffi.new("unsigned char[]", bp.proof), ffi.new("uint64_t *", 0), ffi.new("unsigned char[]", bp.additional_data)]
+    proofs[i], min_values[i], ads[i] = keep_alive[-3:]
+    adls[i] = len(bp.additional_data)
+    commits[i] = bp.pedersen_commitment.commitment
+    value_generators[i] = bp.pedersen_commitment.value_generator.generator[0]
+  example = bulletproofs[0]
+  return bool(lib.secp256k1_bulletproof_rangeproof_verify_multi(
+            example.ctx, BulletProof.scratch['base'],
+            example.pedersen_commitment.blinding_generator.bulletproof_generators,
+            proofs, n, len(example.proof), min_values, commits, 1, 64,
+            value_generators, ads, adls))
+
+def _verify_bulletproofs_bisect(outputs, results):
+  if len(outputs)==1:
+    results[outputs[0].serialize()] = outputs[0].verify()
+    return
+  if _batch_verify_bulletproofs([output.rangeproof for output in outputs]):
+    for output in outputs:
+      results[output.serialize()] = True
+    return
+  half = len(outputs)//2
+  _verify_bulletproofs_bisect(outputs[:half], results)
+  _verify_bulletproofs_bisect(outputs[half:], results)
+
+def verify_outputs_batch(outputs):
+  """
+    Verify list of outputs, return list of results (the same as `IOput.verify` of each output).
+    Bulletproofs of the same length and generator are verified in batches, failed batches
+    are bisected to find invalid outputs. Rangeproofs of old versions are verified one by one.
+    Results are stored in verification cache.
+  """
+  results, to_verify = {}, {}
+  for output in outputs:
+    s = output.serialize()
+    if s in results or s in to_verify:
+      continue
+    try:
+      results[s] = verification_cache[s]
+      continue
+    except KeyError:
+      pass
+    try:
+      results[s] = verification_pool.collect(s)
+      continue
+    except KeyError:
+      pass
+    to_verify[s] = output
+  groups = {}
+  for s, output in to_verify.items():
+    if output.version==2 and output._verify_address_and_generator():
+      groups.setdefault((output.generator, len(output.rangeproof.proof)), []).append(output)
+    else:
+      results[s] = output.verify()
+  for group in groups.values():
+    for i in range(0, len(group), max_bulletproofs_batch):
+      _verify_bulletproofs_bisect(group[i:i+max_bulletproofs_batch], results)
+  for s in to_verify:
+    verification_cache[s] = results[s]
+  return [results[output.serialize()] for output in outputs]
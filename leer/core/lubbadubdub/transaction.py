@@ -7,7 +7,7 @@ from secp256k1_zkp import PrivateKey, PublicKey, PedersenCommitment, RangeProof,
 from leer.core.lubbadubdub.offset_utils import sum_offset
 from leer.core.lubbadubdub.constants import default_generator, default_generator_ser, generators
 from leer.core.lubbadubdub.address import Address, Excess, excess_from_private_key
-from leer.core.lubbadubdub.ioput import IOput
+from leer.core.lubbadubdub.ioput import IOput, verify_outputs_batch
 from leer.core.storage.txos_storage import TXOsStorage
 
 
@@ -319,8 +319,8 @@ class Transaction:
     dev_reward_num = 0
     output_apcs = []
 
+    assert all(verify_outputs_batch(self.outputs)), "Nonvalid output"
     for output in self.outputs:
-        assert output.verify(), "Nonvalid output"
         _o_index =output.serialized_index
         output_apcs.append(_o_index[:33])
         if output.is_coinbase:
@@ -477,7 +477,7 @@ class Transaction:
 
     if block_height > 0:
       prev_block_props = {'height': self.txos_storage.storage_space.blockchain.current_height(rtx=rtx), 
-                        'timestamp': self.txos_storage.storage_space.headers_storage.get(self.txos_storage.storage_space.blockchain.current_tip(rtx=rtx), rtx=rtx).timestamp}
+                        'timestamp': self.txos_storage.storage_space.blockchain.current_tip_header(rtx=rtx).timestamp}
     else:
       prev_block_props = {'height':0, 'timestamp':0}
     excess_lookup_partial = partial(excess_lookup, rtx=rtx, tx=self, excesses_storage = self.excesses_storage)
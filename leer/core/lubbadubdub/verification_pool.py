@@ -0,0 +1,108 @@
+from concurrent.futures import ProcessPoolExecutor
+from collections import deque
+import multiprocessing, os
+from leer.core.storage.verification_cache import verification_cache
+
+'''
+  Non-context verification of outputs (address signature and rangeproof) is the most
+  expensive part of block validation. Serialized outputs are submitted to pool of processes
+  as soon as they are downloaded and again (if cached results expired) before blocks which
+  contain them are applied. `IOput.verify` takes the result from `collect` instead of
+  verifying the output in the core loop. Results of chunks which were not collected are moved
+  to verification cache on the next `submit` or `collect`, so only chunks in work are pending.
+'''
+chunk_size = 32 # outputs of chunk are verified with batch verification of bulletproofs
+max_pending = 65536
+pending = {} # serialized output -> future of its chunk
+chunks = {} # future -> list of serialized outputs
+done = deque() # finished futures, appended by pool thread (verification cache is used only by core thread)
+pool = None
+
+def _verify_chunk(serialized_outputs):
+  from leer.core.lubbadubdub.ioput import IOput, verify_outputs_batch
+  outputs, results = [], []
+  for serialized_output in serialized_outputs:
+    try:
+      output = IOput()
+      output.deserialize_raw(serialized_output, verify=False)
+      outputs.append(output)
+      results.append(None)
+    except Exception:
+      results.append(False)
+  verified = iter(verify_outputs_batch(outputs))
+  return [next(verified) if result==None else result for result in results]
+
+def _move_done():
+  global pool
+  while done:
+    future = done.popleft()
+    chunk = chunks.pop(future, None)
+    if chunk==None: # already collected
+      continue
+    for s in chunk:
+      pending.pop(s, None)
+    try:
+      results = future.result()
+    except Exception:
+      pool = None
+      continue
+    for s, result in zip(chunk, results):
+      verification_cache[s] = result
+
+def _get_pool():
+  global pool
+  if not pool:
+    # spawn: workers should not inherit state (and threads) of core process
+    pool = ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=multiprocessing.get_context("spawn"))
+  return pool
+
+def submit(serialized_outputs):
+  '''
+    Start verification of serialized outputs in pool of processes. Outputs which are already
+    verified or submitted are skipped. Does not wait for results.
+  '''
+  global pool
+  _move_done()
+  serialized, seen = [], set()
+  for s in serialized_outputs:
+    if s in pending or s in seen:
+      continue
+    try:
+      verification_cache[s]
+      continue
+    except KeyError:
+      pass
+    serialized.append(s)
+    seen.add(s)
+  serialized = serialized[:max(0, max_pending-len(pending))]
+  for i in range(0, len(serialized), chunk_size):
+    chunk = serialized[i:i+chunk_size]
+    try:
+      future = _get_pool().submit(_verify_chunk, chunk)
+    except Exception:
+      pool = None # pool is broken, it will be recreated on the next batch
+      return
+    chunks[future] = chunk
+    for s in chunk:
+      pending[s] = future
+    future.add_done_callback(done.append)
+
+def collect(serialized_output):
+  '''
+    Wait for verification of submitted output and move results of its chunk to verification cache.
+    Raises KeyError if output was not submitted or if verification in pool failed.
+  '''
+  global pool
+  _move_done()
+  future = pending[serialized_output]
+  chunk = chunks.pop(future)
+  for s in chunk:
+    pending.pop(s)
+  try:
+    results = future.result()
+  except Exception:
+    pool = None
+    raise KeyError(serialized_output)
+  for s, result in zip(chunk, results):
+    verification_cache[s] = result
+  return verification_cache[serialized_output]
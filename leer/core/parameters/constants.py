@@ -3,10 +3,12 @@ max_target_increase = 1.2
 max_target_decrease = 0.8
 initial_target = 2**248
 minimal_target = 2**248
+target_span = 20 # number of blocks used for next target calculation
 
 COIN = 100000000
 initial_reward = 600*COIN
 reward_decrease_halflife = 2100000 # in blocks
+reward_span = 1024 # number of blocks whose votes are used for next reward calculation
 dev_reward_serialized_address = b'\x01\xd13s^\x80\xe5=\xad\x97P\xd6\x04\x1f\x9aw\x8d2\xb4\x87\x1b\xf6\x95\xfe\x07\xf6\xb3>\x96\xf6\x0e~\xddw\x81I?5\x8d\xe2\x89\xe2d\xd1z\x8b\xfd\xee\x91\xb8\x90\x0b\xeb~/\xd8\xe2\x9d\x96\xeb\xb1\x9b\xa4\x82\x86'
 dev_reward_minimum = int(0.2*COIN) # if calculated reward is less than dev_reward_minimum it should not be created: dust prevention
 dev_reward_maximal_share = 0.03
@@ -5,18 +5,45 @@ from leer.core.utils import encode_target, decode_target
 from leer.core.parameters.constants import *
 from math import exp, ceil
 
+def _ancestor(_hash, height, headers_storage, rtx):
+  '''
+    Header of ancestor of block `_hash` with `height`.
+    Raises KeyError if it is unreachable (for instance, heights in the chain are inconsistent).
+  '''
+  try:
+    ancestor_hash = headers_storage.storage_space.headers_manager.find_ancestor_with_height(_hash, height, rtx=rtx)
+    ancestor = headers_storage.get(ancestor_hash, rtx=rtx)
+  except Exception:
+    raise KeyError(_hash)
+  if not ancestor.height==height:
+    raise KeyError(_hash)
+  return ancestor
+
 def next_target(_hash, headers_storage, rtx):
-  span = 20
+  '''
+    Target is average target of last `target_span` blocks multiplied by ratio of
+    average block period to `block_time` (capped by max_target_increase/decrease).
+    Targets are taken from targets window of header, for headers without aggregates
+    they are collected by walking `prev` links. Note, summation order is the same in both cases.
+  '''
+  span = target_span
   if not headers_storage.has(_hash, rtx=rtx):
     raise
   header = headers_storage.get(_hash, rtx=rtx)
   if header.height<=span:
     return decode_target(*encode_target(initial_target))
+  if header.targets_window!=None:
+    window = header.targets_window
+    targets = [decode_target(window[2*i], window[2*i+1]) for i in range(span)]
+    runner = _ancestor(_hash, header.height-span, headers_storage, rtx=rtx)
+  else:
+    targets, runner = [], header
+    for i in range(span):
+      targets.append(runner.target)
+      runner = headers_storage.get(runner.prev, rtx=rtx)
   average_target =0
-  runner = header
-  for i in range(span):
-    average_target +=runner.target/span
-    runner = headers_storage.get(runner.prev, rtx=rtx)
+  for t in targets:
+    average_target +=t/span
   average_period = (header.timestamp - runner.timestamp)/span
   target = average_target * max(min(average_period/block_time, max_target_increase), max_target_decrease)
   if target > minimal_target:
@@ -25,7 +52,12 @@ def next_target(_hash, headers_storage, rtx):
   return target
 
 def next_reward(_hash, headers_storage, rtx):
-  span = 1024
+  '''
+    Subsidy and dev reward are determined by votes of last `reward_span` blocks.
+    Sums of votes are differences of running sums of header and its ancestor `reward_span` blocks back,
+    for headers without aggregates they are summed by walking `prev` links.
+  '''
+  span = reward_span
   if _hash == b"\x00"*32:# 'prev' of genesis
     return max_reward(0), 0
   if not headers_storage.has(_hash, rtx=rtx):
@@ -33,13 +65,18 @@ def next_reward(_hash, headers_storage, rtx):
   header = headers_storage.get(_hash, rtx=rtx)
   if header.height<=span:
     return max_reward(header.height+1), 0
-  runner = header
-  subsidy_summ = 0
-  dev_reward_summ = 0
-  for i in range(span):
-    subsidy_summ += runner.votedata.miner_subsidy_vote_int
-    dev_reward_summ += runner.votedata.dev_reward_vote_int
-    runner = headers_storage.get(runner.prev, rtx=rtx)
+  if header.subsidy_votes_sum!=None:
+    runner = _ancestor(_hash, header.height-span, headers_storage, rtx=rtx)
+    subsidy_summ = header.subsidy_votes_sum - runner.subsidy_votes_sum
+    dev_reward_summ = header.dev_reward_votes_sum - runner.dev_reward_votes_sum
+  else:
+    runner = header
+    subsidy_summ = 0
+    dev_reward_summ = 0
+    for i in range(span):
+      subsidy_summ += runner.votedata.miner_subsidy_vote_int
+      dev_reward_summ += runner.votedata.dev_reward_vote_int
+      runner = headers_storage.get(runner.prev, rtx=rtx)
   subsidy = int(max_reward(header.height+1) * (subsidy_summ/(255.*span)))
   calc_dev_reward = int( subsidy * dev_reward_maximal_share * dev_reward_summ/(255.*span))
   if calc_dev_reward<dev_reward_minimum:
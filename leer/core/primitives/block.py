@@ -10,6 +10,7 @@ from leer.core.lubbadubdub.offset_utils import sum_offset
 from time import time
 from leer.core.parameters.dynamic import next_reward, next_target
 from leer.core.parameters.constants import initial_target
+from leer.core.utils import Reader
 import functools
 
 class Block():
@@ -59,9 +60,10 @@ class Block():
 
 
   def deserialize_raw(self, serialized):
-    serialized = self.header.deserialize_raw(serialized)
-    serialized = self.transaction_skeleton.deserialize_raw(serialized, storage_space=self.storage_space)
-    return serialized
+    reader = Reader.of(serialized)
+    self.header.deserialize_raw(reader)
+    self.transaction_skeleton.deserialize_raw(reader, storage_space=self.storage_space)
+    return reader.residue(serialized)
 
   def non_context_verify(self, rtx):
     '''
@@ -86,8 +88,8 @@ class Block():
                                      excesses_storage=self.storage_space.excesses_storage,
                                      block_height=self.header.height, block_version = self.header.version, rtx=rtx, non_context = True)
     # stage 3 => should be moved to blockchain
-    #commitment_root, txos_root = self.storage_space.txos_storage.apply_block_tx_get_merkles_and_rollback(tx)
-    #excesses_root = self.storage_space.excesses_storage.apply_block_tx_get_merkles_and_rollback(tx)
+    #commitment_root, txos_root = self.storage_space.txos_storage.get_merkles_after_block_tx(tx)
+    #excesses_root = self.storage_space.excesses_storage.get_merkle_after_block_tx(tx)
     #assert [commitment_root, txos_root, excesses_root]==self.header.merkles
 
     # This is context validation too??? TODO
@@ -139,16 +141,14 @@ def build_tx_from_skeleton(tx_skeleton, txos_storage, excesses_storage, block_he
 #To setup utils
 def generate_genesis(tx, storage_space, wtx):
     '''
-        1. spend inputs and add outputs and excesses from tx to storage
-        2. calc new mercles
-        3. generate header
-        4. rollback outputs
+        1. calc new mercles as if inputs were spent and outputs and excesses were added to storage
+        2. generate header
     '''
     storage = storage_space.txos_storage
     excesses = storage_space.excesses_storage
 
-    exc_merkle = excesses.apply_block_tx_get_merkles_and_rollback(tx, wtx=wtx) # it should be calced first, since we nned to calc address_excess_num_index
-    merkles = storage.apply_block_tx_get_merkles_and_rollback(tx, wtx=wtx) + [exc_merkle]
+    exc_merkle = excesses.get_merkle_after_block_tx(tx, rtx=wtx) # it should be calced first, since we nned to calc address_excess_num_index
+    merkles = storage.get_merkles_after_block_tx(tx, rtx=wtx) + [exc_merkle]
     popow = PoPoW([])
     votedata = VoteData()
     target = initial_target
@@ -172,33 +172,32 @@ def generate_block_template(tx, storage_space, wtx, get_tx_from_mempool = True,
           get_tx_from_mempool [optional, default True]: if get_tx_from_mempool, transaction from mempool will be merged to block_transaction. If this merge will produce invalid tx (for instance tx from mempool spends the same inputs as tx with coinbase), tx from mempool will be discarded.
 
         Inner logic:
-        1. apply block_tx to txos_storage and excesses_storage
-        2. calc new merkles
-        3. generate header with new merkles
-        4. generate block by appending tx_skeleton and new header
-        5. rollback block_tx
+        1. calc new merkles as if block_tx was applied to txos_storage and excesses_storage
+        2. generate header with new merkles
+        3. generate block by appending tx_skeleton and new header
     '''
 
     storage = storage_space.txos_storage
     excesses = storage_space.excesses_storage
-    current_block = storage_space.blocks_storage.get(storage_space.blockchain.current_tip(rtx=wtx), rtx=wtx)
+    current_tip = storage_space.chain_state.tip(rtx=wtx) # header and hash of tip are cached, no need to read the whole block
     if get_tx_from_mempool:
       try:
         tx = tx.merge(storage_space.mempool_tx.give_tx(), rtx=wtx)
       except:
         pass
 
-    exc_merkle = excesses.apply_block_tx_get_merkles_and_rollback(tx, wtx=wtx) # it should be calced first, since we nned to calc address_excess_num_index
-    merkles = storage.apply_block_tx_get_merkles_and_rollback(tx, wtx=wtx) + [exc_merkle]
+    exc_merkle = excesses.get_merkle_after_block_tx(tx, rtx=wtx) # it should be calced first, since we nned to calc address_excess_num_index
+    merkles = storage.get_merkles_after_block_tx(tx, rtx=wtx) + [exc_merkle]
 
-    popow = current_block.header.next_popow()
-    supply = current_block.header.supply + tx.minted_value - tx.calc_new_outputs_fee() 
-    height = current_block.header.height+1
+    popow = PoPoW()
+    popow.generate_from_prev(current_tip.header.popow, current_tip.hash)
+    supply = current_tip.header.supply + tx.minted_value - tx.calc_new_outputs_fee() 
+    height = current_tip.height+1
     votedata = VoteData()
-    target = next_target(current_block.hash, storage_space.headers_storage, rtx=wtx)    
-    full_offset = sum_offset(current_block.header.full_offset,tx.mixer_offset)
+    target = next_target(current_tip.hash, storage_space.headers_storage, rtx=wtx)    
+    full_offset = sum_offset(current_tip.header.full_offset,tx.mixer_offset)
     if not timestamp:
-      timestamp = max(int(time()), storage_space.headers_storage.get(storage_space.blockchain.current_tip(rtx=wtx), rtx=wtx).timestamp+1)
+      timestamp = max(int(time()), current_tip.header.timestamp+1)
     header=Header(height = height, supply=supply, full_offset=full_offset, merkles=merkles, popow=popow, votedata=votedata, timestamp=timestamp, target=target, version=int(1), nonce=b"\x00"*16)
     
     tx_skeleton = TransactionSkeleton(tx=tx)
@@ -233,7 +232,6 @@ class ContextBlock(Block):
     return ser
 
   @classmethod
-  @functools.lru_cache(maxsize=10)
   def from_serialized(cls, serialized_block, storage_space):
     b = cls(storage_space=storage_space)
     b.deserialize(serialized_block)
@@ -243,11 +241,12 @@ class ContextBlock(Block):
     self.deserialize_raw(serialized)
 
   def deserialize_raw(self, serialized):
-    ser = super(ContextBlock, self).deserialize_raw(serialized)
-    self.invalid, ser = bool(ser[0]), ser[1:]
-    reason_len, ser = int.from_bytes(ser[:2], 'big'), ser[2:]
-    self.reason, ser = ser[:reason_len].decode('utf-8'), ser[reason_len:]
-    return ser
+    reader = Reader.of(serialized)
+    super(ContextBlock, self).deserialize_raw(reader)
+    self.invalid = bool(reader.read_int(1))
+    reason_len = reader.read_int(2)
+    self.reason = reader.read(reason_len).decode('utf-8')
+    return reader.residue(serialized)
     
   def __str__(self):
     return "ContextBlock< hash: %s..., height: %d, inputs: %d, outputs %d, valid: %s, reason %s>"%(self.header.hash[:6], self.header.height
@@ -1,7 +1,8 @@
 import hashlib
-from leer.core.utils import encode_target, decode_target
-from leer.core.hash.progpow import progpow_hash, partial_hash
+from leer.core.utils import encode_target, decode_target, Reader
+from leer.core.hash.progpow import progpow_hash, partial_hash, precompute_hashes
 from leer.version import NETSTATUS
+from leer.core.parameters.constants import target_span
 
 class PoPoW:
   # We use compact version of PoPoW (https://eprint.iacr.org/2017/963.pdf) here
@@ -37,16 +38,16 @@ class PoPoW:
 
   def deserialize_raw(self, serialized_popow):
     # This function derserializes popow and returns unused serialized data
+    reader = Reader.of(serialized_popow)
     self.pointers=[]
-    if len(serialized_popow)<1:
+    if len(reader)<1:
       raise Exception("Not enough bytes in PoPoW to store length")
-    _len, serialized_popow = serialized_popow[0], serialized_popow[1:]
+    _len = reader.read_int(1)
     for i in range(_len):
-      if len(serialized_popow)<32:
+      if len(reader)<32:
         raise Exception("Not enough bytes in PoPoW to store %d pointer"%i)
-      pointer,serialized_popow = serialized_popow[:32], serialized_popow[32:]
-      self.pointers.append(pointer)
-    return serialized_popow
+      self.pointers.append(reader.read(32))
+    return reader.residue(serialized_popow)
 
   def check_self_consistency(self):
     # 1. Check that all levels are consistent, except last one (genesis)
@@ -118,13 +119,13 @@ class VoteData:
     self.deserialize_raw(serialized)
 
   def deserialize_raw(self, serialized):
-    if len(serialized)<5:
+    reader = Reader.of(serialized)
+    if len(reader)<5:
       raise Exception("Not enough bytes for deserialization")
     self.forks_vector, \
     self.dev_reward_vote, \
-    self.miner_subsidy_vote, \
-    serialized = serialized[:3], serialized[3:4], serialized[4:5], serialized[5:]
-    return serialized
+    self.miner_subsidy_vote = reader.read(3), reader.read(1), reader.read(1)
+    return reader.residue(serialized)
 
 
 class Header:
@@ -184,38 +185,39 @@ class Header:
     self.deserialize_raw(serialized)
 
   def deserialize_raw(self, serialized):
-    if len(serialized)<1:
+    reader = Reader.of(serialized)
+    if len(reader)<1:
       raise Exception("Not enough bytes for version deserialization")
-    self.version, serialized = serialized[0], serialized[1:]
-    if len(serialized)<4:
+    self.version = reader.read_int(1)
+    if len(reader)<4:
       raise Exception("Not enough bytes for height deserialization")
-    self.height, serialized = int.from_bytes(serialized[:4], "big"), serialized[4:]
+    self.height = reader.read_int(4)
     self.popow = PoPoW()
-    serialized = self.popow.deserialize_raw(serialized)
+    self.popow.deserialize_raw(reader)
     self.votedata = VoteData()
-    serialized = self.votedata.deserialize_raw(serialized)
-    if len(serialized)<162:
+    self.votedata.deserialize_raw(reader)
+    if len(reader)<162:
       raise Exception("Not enough bytes for merkle roots deserialization")
-    self.merkles, serialized = [serialized[:65],serialized[65:97],serialized[97:162]], serialized[162:]
-    if len(serialized)<8:
+    self.merkles = [reader.read(65), reader.read(32), reader.read(65)]
+    if len(reader)<8:
       raise Exception("Not enough bytes for supply deserialization")
-    self.supply, serialized = int.from_bytes(serialized[:8], "big"), serialized[8:]
-    if len(serialized)<32:
+    self.supply = reader.read_int(8)
+    if len(reader)<32:
       raise Exception("Not enough bytes for full_offset deserialization")
-    self.full_offset, serialized = int.from_bytes(serialized[:32], "big"), serialized[32:]
-    if len(serialized)<5:
+    self.full_offset = reader.read_int(32)
+    if len(reader)<5:
       raise Exception("Not enough bytes for timestamp deserialization")
-    self.timestamp, serialized = int.from_bytes(serialized[:5], "big"), serialized[5:]
-    if len(serialized)<5:
+    self.timestamp = reader.read_int(5)
+    if len(reader)<5:
       raise Exception("Not enough bytes for target deserialization")
-    self.target, serialized = decode_target(serialized[0],serialized[1]), serialized[2:]
-    if len(serialized)<4:
+    self.target = decode_target(reader.read_int(1), reader.read_int(1))
+    if len(reader)<4:
       raise Exception("Not enough bytes for extension bytes deserialization")
-    self.extension_bytes, serialized = serialized[:4], serialized[4:]
-    if len(serialized)<8:
+    self.extension_bytes = reader.read(4)
+    if len(reader)<8:
       raise Exception("Not enough bytes for nonce deserialization")
-    self.nonce, serialized = serialized[:8], serialized[8:]
-    return serialized
+    self.nonce = reader.read(8)
+    return reader.residue(serialized)
     
 
   def check_self_consistency(self):
@@ -230,8 +232,15 @@ class Header:
   def hash(self):
     if not NETSTATUS=="Testnet4":
       raise NotImplemented
+    return progpow_hash(*self.hash_params)
+
+  @property
+  def hash_params(self):
+    '''
+      Arguments of progpow_hash for this header.
+    '''
     progpow_version = "0.9.2" if self.height<20000 else "0.9.3"
-    return progpow_hash(self.height, self.template, self.nonce, version=progpow_version)
+    return (self.height, self.template, self.nonce, progpow_version)
 
   @property
   def partial_hash(self):
@@ -265,6 +274,13 @@ class Header:
             self.nonce == h.nonce)
 
 
+def precompute_headers_hashes(headers):
+  '''
+    Calculate hashes of `headers` in parallel, so that following `header.hash` calls are cheap.
+  '''
+  precompute_hashes([header.hash_params for header in headers])
+
+
 class ContextHeader(Header):
   def __init__(self, header=None):
     if header:
@@ -291,6 +307,25 @@ class ContextHeader(Header):
     '''
     self.coins_to_be_mint = 0 
     self.total_difficulty = 0 
+    '''
+      Running aggregates for next_reward and next_target (see leer.core.parameters.dynamic):
+      sums of votes of all blocks from genesis to this one and encoded targets of last `target_span` blocks
+      (this one first). They are None for headers saved by old versions and for headers
+      whose previous header has no aggregates.
+    '''
+    self.subsidy_votes_sum = None
+    self.dev_reward_votes_sum = None
+    self.targets_window = None
+
+  def set_aggregates(self, prev):
+    '''
+      Calculate running aggregates from aggregates of `prev` ContextHeader (None for genesis).
+    '''
+    if prev and prev.subsidy_votes_sum==None:
+      return
+    self.subsidy_votes_sum = (prev.subsidy_votes_sum if prev else 0) + self.votedata.miner_subsidy_vote_int
+    self.dev_reward_votes_sum = (prev.dev_reward_votes_sum if prev else 0) + self.votedata.dev_reward_vote_int
+    self.targets_window = (self.encoded_target + (prev.targets_window if prev else b""))[:2*target_span]
 
   def serialize_with_context(self):
     ser = super(ContextHeader, self).serialize()
@@ -306,6 +341,11 @@ class ContextHeader(Header):
     ser += reason.encode('utf-8')
     ser += self.coins_to_be_mint.to_bytes(8,"big")
     ser += self.total_difficulty.to_bytes(32,"big")
+    if self.subsidy_votes_sum!=None:
+      ser += self.subsidy_votes_sum.to_bytes(8,"big")
+      ser += self.dev_reward_votes_sum.to_bytes(8,"big")
+      ser += len(self.targets_window).to_bytes(1,"big")
+      ser += self.targets_window
     return ser
 
   def deserialize(self, serialized):
@@ -314,17 +354,22 @@ class ContextHeader(Header):
   def deserialize_raw(self, serialized):
     #TODO exceptions for not enough bytes
     # No urgency: we never should get contextHeader from other nodes
-    ser = super(ContextHeader, self).deserialize_raw(serialized)
-    desc_num, ser = int.from_bytes(ser[:1], 'big'), ser[1:]
+    reader = Reader.of(serialized)
+    super(ContextHeader, self).deserialize_raw(reader)
+    desc_num = reader.read_int(1)
     for desc in range(desc_num):
-      d, ser = ser[:32], ser[32:]
-      self.descendants.add(d)
-    self.connected_to_genesis, self.invalid, ser = bool(ser[0]), bool(ser[1]), ser[2:]
-    reason_len, ser = int.from_bytes(ser[:2], 'big'), ser[2:]
-    self.reason, ser = ser[:reason_len].decode('utf-8'), ser[reason_len:]
-    self.coins_to_be_mint, ser = int.from_bytes(ser[:8], "big"), ser[8:]
-    self.total_difficulty, ser = int.from_bytes(ser[:32], "big"), ser[32:]
-    return ser
+      self.descendants.add(reader.read(32))
+    self.connected_to_genesis, self.invalid = bool(reader.read_int(1)), bool(reader.read_int(1))
+    reason_len = reader.read_int(2)
+    self.reason = reader.read(reason_len).decode('utf-8')
+    self.coins_to_be_mint = reader.read_int(8)
+    self.total_difficulty = reader.read_int(32)
+    if len(reader):
+      self.subsidy_votes_sum = reader.read_int(8)
+      self.dev_reward_votes_sum = reader.read_int(8)
+      window_len = reader.read_int(1)
+      self.targets_window = reader.read(window_len)
+    return reader.residue(serialized)
     
 
 
@@ -2,6 +2,7 @@ from leer.core.lubbadubdub.constants import default_generator, default_generator
 from leer.core.lubbadubdub.ioput import IOput
 from leer.core.lubbadubdub.address import Excess
 from leer.core.parameters.constants import output_creation_fee
+from leer.core.utils import Reader
 
 
 class TransactionSkeleton:
@@ -81,69 +82,66 @@ class TransactionSkeleton:
       
 
   def deserialize_raw(self, serialized, storage_space=None):
-    if len(serialized)<1:
+    reader = Reader.of(serialized)
+    if len(reader)<1:
       raise Exception("Not enough bytes for tx skeleton version marker")
-    serialized, ser_version = serialized[1:], serialized[0]
+    ser_version = reader.read_int(1)
     rich_format = ser_version & 1
     self.version = ser_version >> 1
     if not self.version in [0]:
       raise Exception("Unknown tx_sceleton version")
-    if len(serialized)<2:
+    if len(reader)<2:
       raise Exception("Not enough bytes for tx skeleton inputs len")
-    serialized, _len_i = serialized[2:], int.from_bytes(serialized[:2], "big")
-    if len(serialized)<2:
+    _len_i = reader.read_int(2)
+    if len(reader)<2:
       raise Exception("Not enough bytes for tx skeleton outputs len")
-    serialized, _len_o = serialized[2:], int.from_bytes(serialized[:2], "big")
+    _len_o = reader.read_int(2)
 
-    if len(serialized)<2:
+    if len(reader)<2:
       raise Exception("Not enough bytes for tx skeleton additional excesses len")
-    serialized, _len_ae = serialized[2:], int.from_bytes(serialized[:2], "big")
+    _len_ae = reader.read_int(2)
 
     serialized_index_len = IOput().index_len
-    for i in range(_len_i):
-      if len(serialized)<serialized_index_len:
-        raise Exception("Not enough bytes for tx skeleton' input index %d len"%i)
-      _input_index, serialized  = serialized[:serialized_index_len], serialized[serialized_index_len:]
-      self.input_indexes.append(_input_index)
-    for i in range(_len_o):
-      if len(serialized)<serialized_index_len:
-        raise Exception("Not enough bytes for tx skeleton' output index %d len"%i)
-      _output_index, serialized  = serialized[:serialized_index_len], serialized[serialized_index_len:]
-      self.output_indexes.append(_output_index)
-
-    for i in range(_len_o):
-        if len(serialized)<4:
-          raise Exception("Not enough bytes for tx skeleton' output relay fee %d len"%i)
-        ser_relay_fee, serialized  = serialized[:4], serialized[4:]
-        self.output_relay_fees.append(int.from_bytes(ser_relay_fee, "big"))
+    if len(reader)<serialized_index_len*_len_i:
+      raise Exception("Not enough bytes for tx skeleton' input index %d len"%(len(reader)//serialized_index_len))
+    data = reader.read(serialized_index_len*_len_i)
+    self.input_indexes += [data[i*serialized_index_len:(i+1)*serialized_index_len] for i in range(_len_i)]
+    if len(reader)<serialized_index_len*_len_o:
+      raise Exception("Not enough bytes for tx skeleton' output index %d len"%(len(reader)//serialized_index_len))
+    data = reader.read(serialized_index_len*_len_o)
+    self.output_indexes += [data[i*serialized_index_len:(i+1)*serialized_index_len] for i in range(_len_o)]
+
+    if len(reader)<4*_len_o:
+      raise Exception("Not enough bytes for tx skeleton' output relay fee %d len"%(len(reader)//4))
+    data = reader.read(4*_len_o)
+    self.output_relay_fees += [int.from_bytes(data[i*4:(i+1)*4], "big") for i in range(_len_o)]
 
     for i in range(_len_ae):
       e = Excess()
-      serialized  = e.deserialize_raw(serialized)
+      e.deserialize_raw(reader)
       self.additional_excesses.append(e)
     for i in range(_len_i):
       e = Excess()
-      serialized  = e.deserialize_raw(serialized)
+      e.deserialize_raw(reader)
       self.updated_excesses[self.input_indexes[i]]=e
-    if len(serialized)<32:
+    if len(reader)<32:
       raise Exception("Not enough bytes for mixer offset")
-    self.mixer_offset, serialized = int.from_bytes(serialized[:32], "big"), serialized[32:]
+    self.mixer_offset = reader.read_int(32)
 
     if not self.verify():
       #TODO consider renmaing verify to validate_excesses or make exception text more general
       raise Exception("Additional excesses are not signed properly")
 
     if rich_format and storage_space:
-      txouts_num_serialized, serialized = serialized[:2], serialized[2:]
-      txouts_num = int.from_bytes(txouts_num_serialized, "big")
+      txouts_num = reader.read_int(2)
       for _ in range(txouts_num):
         output = IOput()
-        serialized = output.deserialize_raw(serialized)
+        output.deserialize_raw(reader)
         if not (output.serialized_index in self.output_indexes):
           raise Exception("Unknown output in rich txskel data") 
         storage_space.txos_storage.mempool[output.serialized_index]=output
 
-    return serialized
+    return reader.residue(serialized)
 
   def verify(self):
     #We cannot verify sum to zero by tx_scel, since tx_scel doesn't contain address_excesses
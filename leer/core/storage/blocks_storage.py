@@ -1,10 +1,13 @@
 from leer.core.storage.txos_storage import TXOsStorage
 from leer.core.primitives.block import Block, ContextBlock
 import shutil, os, time, lmdb, math
-import functools
+from collections import OrderedDict
+from copy import copy
+from leer.core.utils import Reader
 
 class BlocksStorage:
   __shared_states = {}
+  max_pruned_rollbacks = 16
   def __init__(self, storage_space, wtx):
     path = storage_space.path
     if not path in self.__shared_states:
@@ -15,18 +18,33 @@ class BlocksStorage:
     self.storage_space = storage_space
     self.storage_space.register_blocks_storage(self)
     self.download_queue = []
+    if not hasattr(self, 'cache'):
+      self.cache = BlocksCache()
     
-  @functools.lru_cache(maxsize=3)
   def get(self, _hash, rtx):
+    cblock = self.cache.get(_hash, rtx=rtx)
+    if cblock:
+      return cblock
     serialized_context_block = self.storage.get_by_hash(_hash, rtx=rtx)
     if not serialized_context_block:
       raise KeyError(_hash)
-    cblock = ContextBlock.from_serialized(serialized_context_block, self.storage_space)
+    cblock = ContextBlock.from_serialized(bytes(serialized_context_block), self.storage_space)
+    self.cache.put(_hash, cblock, len(serialized_context_block), rtx=rtx)
     return cblock
 
   def put(self, _hash, block, wtx):
+    self.cache.invalidate(_hash, wtx=wtx)
     self.storage.put(_hash, block.serialize_with_context(), wtx=wtx)
 
+  def invalidate_cache(self, wtx):
+    '''
+      Should be called if blocks are written to db bypassing this object (for instance, on snapshot import).
+    '''
+    self.cache.invalidate_all(wtx=wtx)
+
+  def cache_stats(self):
+    return self.cache.stats()
+
   def has(self, _hash, rtx):
     return self.storage.has(_hash, rtx=rtx)  
 
@@ -51,18 +69,42 @@ class BlocksStorage:
     serialized_rollback = self.storage.get_rollback_object(_hash, rtx=rtx)
     rb=RollBack()
     rb.deserialize_raw(serialized_rollback)
+    self._resolve_pruned_inputs(rb, rtx=rtx)
     return rb
 
-  def pop_rollback_object(self, _hash, wtx):
-    serialized_rollback = self.storage.pop_rollback_object(_hash, wtx=wtx)
+  def pop_rollback_object(self, _hash, wtx, height=None):
+    serialized_rollback = self.storage.pop_rollback_object(_hash, wtx=wtx, height=height)
     rb=RollBack()
     rb.deserialize_raw(serialized_rollback)
+    self._resolve_pruned_inputs(rb, rtx=wtx)
     return rb
 
-  def put_rollback_object(self, _hash, rollback, wtx):
-    self.storage.put_rollback_object(_hash, rollback.serialize(), wtx=wtx)
-
-
+  def put_rollback_object(self, _hash, rollback, wtx, height=None):
+    compact = self.storage_space.txos_storage.confirmed.saves_pruned()
+    self.storage.put_rollback_object(_hash, rollback.serialize(compact=compact), wtx=wtx, height=height)
+    if height!=None:
+      self.prune_rollback_objects(height, wtx=wtx)
+
+  def _resolve_pruned_inputs(self, rb, rtx):
+    if rb.pruned_inputs and rb.pruned_inputs[0][0][2]==None: # compact rollback object
+      nums = [(_t[0], _c[0]) for _t, _c in rb.pruned_inputs]
+      rb.pruned_inputs = self.storage_space.txos_storage.confirmed.get_revert_objs(nums, rtx=rtx)
+
+  def prune_rollback_objects(self, height, wtx):
+    '''
+      Rollback objects are kept only for last `rollback_depth` blocks (see StorageSpace). Older ones are
+      deleted not more than `max_pruned_rollbacks` at once, so that shrinking of depth does not stall
+      application of a block.
+    '''
+    if self.storage_space.rollback_depth==None:
+      return
+    self.storage.delete_rollback_objects_up_to(height-self.storage_space.rollback_depth, self.max_pruned_rollbacks, wtx=wtx)
+
+  def rollback_horizon(self, rtx):
+    '''
+      Height of last block rollback object of which was deleted (-1 if none).
+    '''
+    return self.storage.rollback_horizon(rtx=rtx)
 
   def _ask_for_txout(self, txout):
     if not txout in self.download_queue:
@@ -73,9 +115,82 @@ class BlocksStorage:
     self.download_queue = []
 
   def forget_block(self, _hash, wtx):
+    self.cache.invalidate(_hash, wtx=wtx)
     self.storage.delete_block_by_hash(_hash, wtx=wtx)
 
 
+class BlocksCache:
+  '''
+    LRU cache of decoded ContextBlocks (header and transaction skeleton) keyed by hash, bounded by
+    total length of serialized blocks. It is shared by all transactions. `get` returns a shallow copy,
+    so transaction built by caller (block.tx) and context fields do not get to the cache;
+    header and skeleton are shared and should not be modified.
+
+    Written and forgotten blocks are evicted and marked dirty with id of write transaction.
+    Lmdb assigns id of last committed transaction plus one to write transaction and id of last
+    committed transaction to read transaction, so only transaction with greater id definitely sees
+    committed changes: until then the block is read from db and is not cached.
+  '''
+  max_bytes = 16*1024*1024
+  max_dirty = 4096
+
+  def __init__(self):
+    self.blocks = OrderedDict() # hash -> (block, size)
+    self.size = 0
+    self.dirty = {} # hash -> id of transaction which changed block
+    self.all_dirty = None # id of transaction which changed blocks bypassing the cache
+    self.hits, self.misses = 0, 0
+
+  def _is_dirty(self, _hash, rtx):
+    txn_id = rtx.id()
+    if self.all_dirty!=None:
+      if txn_id<=self.all_dirty:
+        return True
+      self.all_dirty = None
+    if _hash in self.dirty:
+      if txn_id<=self.dirty[_hash]:
+        return True
+      self.dirty.pop(_hash)
+    return False
+
+  def get(self, _hash, rtx):
+    _hash = bytes(_hash)
+    if not _hash in self.blocks or self._is_dirty(_hash, rtx):
+      self.misses += 1
+      return None
+    self.hits += 1
+    self.blocks.move_to_end(_hash)
+    return copy(self.blocks[_hash][0])
+
+  def put(self, _hash, block, size, rtx):
+    _hash = bytes(_hash)
+    if _hash in self.blocks or self._is_dirty(_hash, rtx):
+      return
+    self.blocks[_hash] = (copy(block), size)
+    self.size += size
+    while self.size > self.max_bytes:
+      _, (_, evicted_size) = self.blocks.popitem(last=False)
+      self.size -= evicted_size
+
+  def invalidate(self, _hash, wtx):
+    _hash = bytes(_hash)
+    if _hash in self.blocks:
+      self.size -= self.blocks.pop(_hash)[1]
+    if len(self.dirty)>self.max_dirty:
+      # transactions with lower id are already committed or aborted
+      self.dirty = {h: txn_id for h, txn_id in self.dirty.items() if txn_id>=wtx.id()}
+    self.dirty[_hash] = wtx.id()
+
+  def invalidate_all(self, wtx):
+    self.blocks = OrderedDict()
+    self.size = 0
+    self.all_dirty = wtx.id()
+
+  def stats(self):
+    return {'blocks': len(self.blocks), 'bytes': self.size, 'max_bytes': self.max_bytes,
+            'hits': self.hits, 'misses': self.misses}
+
+
 
 class RollBack:
   def __init__(self):
@@ -90,20 +205,24 @@ class RollBack:
     return len(_bytes).to_bytes(2,"big")+_bytes
 
   def deserialize_bytes_raw(self, serialized):
-    _slen, serialized = serialized[:2], serialized[2:]
-    _len = int.from_bytes(_slen, "big")
-    _bytes, serialized = serialized[:_len], serialized[_len:]
-    return _bytes, serialized
+    reader = Reader.of(serialized)
+    _bytes = reader.read(reader.read_int(2))
+    return _bytes, reader.residue(serialized)
 
-  def serialize(self):
-    # each pruned input is (TXOS[num, _index, obj], Commitment[num, _index, obj])
+  def serialize(self, compact=True):
+    # version 1: each pruned input is (TXOS[num, _index, obj], Commitment[num, _index, obj])
     # num is serialized 5bytes integer, other members have arbitrary size
+    # version 2 (compact): each pruned input is only (TXOS num, Commitment num), indexes and objects
+    # are taken from pruned dbs of trees on rollback (see BlocksStorage.pop_rollback_object)
     serialized_pruned_inputs=b""
     serialized_pruned_inputs+=len(self.pruned_inputs).to_bytes(2,"big")
     for _t, _c in self.pruned_inputs:
       for _i in [_t,_c]:
         num, _index, obj = _i
-        serialized_pruned_inputs += num.to_bytes(5,"big") + self.serialize_bytes(_index) + self.serialize_bytes(obj)
+        if compact:
+          serialized_pruned_inputs += num.to_bytes(5,"big")
+        else:
+          serialized_pruned_inputs += num.to_bytes(5,"big") + self.serialize_bytes(_index) + self.serialize_bytes(obj)
 
     serialized_excess_updates=b""
     serialized_excess_updates+=len(self.updated_excesses).to_bytes(2,"big")
@@ -114,7 +233,7 @@ class RollBack:
     serialized_nums = self.num_of_added_outputs.to_bytes(2,"big") + self.num_of_added_excesses.to_bytes(2,"big")
     serialized_burdens_len = len(self.burdens).to_bytes(2,"big")
     serialized_burdens = serialized_burdens_len + b"".join([i[0] for i in self.burdens])
-    version=b"\x01"
+    version=b"\x02" if compact else b"\x01"
     serialized_state_id = self.serialize_bytes(self.prev_state)
     summary_len = len(serialized_pruned_inputs)+len(serialized_nums) + len(serialized_burdens)+len(version)+len(serialized_state_id) + len(serialized_excess_updates)
     serialized = summary_len.to_bytes(4,"big") + \
@@ -127,44 +246,44 @@ class RollBack:
     return serialized
 
   def deserialize_raw(self, serialized):
-    _slen, serialized = serialized[:4], serialized[4:]
-    _len = int.from_bytes(_slen, "big")
-    data, residue = serialized[:_len], serialized[_len:]
-    version, data = data[:1], data[1:]
-    if not version==b"\x01":
+    reader = Reader.of(serialized)
+    _len = reader.read_int(4)
+    end = reader.offset + _len
+    version = reader.read(1)
+    if not version in [b"\x01", b"\x02"]:
       raise
-    _s_pruned_inputs_num, data = data[:2], data[2:]
-    pruned_inputs_num = int.from_bytes(_s_pruned_inputs_num, "big")
+    pruned_inputs_num = reader.read_int(2)
     for i in range(pruned_inputs_num):
-      _snum, data = data[:5], data[5:]
-      _num = int.from_bytes(_snum, "big")
-      _index, data = self.deserialize_bytes_raw(data)
-      _obj, data = self.deserialize_bytes_raw(data)
+      if version==b"\x02":
+        self.pruned_inputs.append([[reader.read_int(5), None, None], [reader.read_int(5), None, None]])
+        continue
+      _num = reader.read_int(5)
+      _index, _ = self.deserialize_bytes_raw(reader)
+      _obj, _ = self.deserialize_bytes_raw(reader)
       _txout = [_num,_index,_obj]
-      _snum, data = data[:5], data[5:]
-      _num = int.from_bytes(_snum, "big")
-      _index, data = self.deserialize_bytes_raw(data)
-      _obj, data = self.deserialize_bytes_raw(data)
+      _num = reader.read_int(5)
+      _index, _ = self.deserialize_bytes_raw(reader)
+      _obj, _ = self.deserialize_bytes_raw(reader)
       _comm = [_num,_index,_obj]
       self.pruned_inputs.append([_txout, _comm])
-    _no, _ne, data = data[:2], data[2:4], data[4:]
-    self.num_of_added_outputs = int.from_bytes(_no,"big")
-    self.num_of_added_excesses = int.from_bytes(_ne, "big")
-    _s_updates_num, data = data[:2], data[2:]
-    updates_num = int.from_bytes(_s_updates_num, "big")
+    self.num_of_added_outputs = reader.read_int(2)
+    self.num_of_added_excesses = reader.read_int(2)
+    updates_num = reader.read_int(2)
     for i in range(updates_num):
-      _snum, data = data[:5], data[5:]
-      _index, data = self.deserialize_bytes_raw(data)
-      _obj, data = self.deserialize_bytes_raw(data)
+      _snum = reader.read(5)
+      _index, _ = self.deserialize_bytes_raw(reader)
+      _obj, _ = self.deserialize_bytes_raw(reader)
       self.updated_excesses.append((_snum, _index, _obj))
-    _s_burdens_num, data = data[:2], data[2:]
-    burdens_num = int.from_bytes(_s_burdens_num, "big")
+    burdens_num = reader.read_int(2)
     for i in range(burdens_num):
-      next_burden, data= data[:65], data[65:]
-      self.burdens.append((next_burden, None))
-    self.prev_state, data = self.deserialize_bytes_raw(data)
-    return residue
+      self.burdens.append((reader.read(65), None))
+    self.prev_state, _ = self.deserialize_bytes_raw(reader)
+    reader.offset = end
+    return reader.residue(serialized)
+
 
+def _h(height):
+  return height.to_bytes(4,'big')
 
 class BlocksDiscStorage:
   def __init__(self, dir_path, env, wtx):
@@ -173,6 +292,8 @@ class BlocksDiscStorage:
     self.env = env
     self.main_db = self.env.open_db(b'blocks_main_db', txn=wtx, dupsort=False) # block_hash -> serialized_contextblock
     self.revert_db = self.env.open_db(b'blocks_revert_db', txn=wtx, dupsort=False) # block_hash -> object_for_reverting
+    self.revert_heights_db = self.env.open_db(b'blocks_revert_heights_db', txn=wtx, dupsort=False) # height -> block_hash
+    self.meta_db = self.env.open_db(b'blocks_meta_db', txn=wtx, dupsort=False) # b'rollback_horizon' -> height
 
   def put(self, _hash, serialized_block, wtx):
     p1=wtx.put( bytes(_hash), bytes(serialized_block), db=self.main_db, dupdata=False, overwrite=True)
@@ -186,12 +307,32 @@ class BlocksDiscStorage:
   def get_rollback_object(self, _hash, rtx):
     return rtx.get(bytes(_hash), db=self.revert_db)
 
-  def pop_rollback_object(self, _hash, wtx):
+  def pop_rollback_object(self, _hash, wtx, height=None):
+    if height!=None and wtx.get(_h(height), db=self.revert_heights_db)==bytes(_hash):
+      wtx.delete(_h(height), db=self.revert_heights_db)
     return wtx.pop(bytes(_hash), db=self.revert_db)
 
-  def put_rollback_object(self, _hash, serialized_rollback_object, wtx):
+  def put_rollback_object(self, _hash, serialized_rollback_object, wtx, height=None):
+    if height!=None:
+      wtx.put(_h(height), bytes(_hash), db=self.revert_heights_db)
     return wtx.put(bytes(_hash), bytes(serialized_rollback_object), db=self.revert_db)
 
+  def delete_rollback_objects_up_to(self, height, max_num, wtx):
+    deleted = 0
+    cursor = wtx.cursor(db=self.revert_heights_db)
+    cursor.first()
+    while cursor.key() and int.from_bytes(cursor.key(), 'big') <= height and deleted<max_num:
+      wtx.put(b'rollback_horizon', cursor.key(), db=self.meta_db)
+      wtx.delete(cursor.value(), db=self.revert_db)
+      deleted += 1
+      if not cursor.delete():
+        break
+    return deleted
+
+  def rollback_horizon(self, rtx):
+    height = rtx.get(b'rollback_horizon', db=self.meta_db)
+    return int.from_bytes(height, 'big') if height else -1
+
   def has(self, _hash, rtx):
     return bool(self.get_by_hash(_hash, rtx=rtx))
 
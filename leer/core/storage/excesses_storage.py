@@ -1,4 +1,5 @@
 from leer.core.storage.merkle_storage import MMR
+from leer.core.storage.points_summation import parse_pubkey, serialize_pubkey, sum_points
 from secp256k1_zkp import PedersenCommitment, PublicKey
 from leer.core.lubbadubdub.address import Excess
 import hashlib
@@ -7,16 +8,19 @@ from leer.core.utils import sha256
 
 class ExcessMMR(MMR):
       def sum(self, x1,x2):
-        # each index is 33 bytes for commitments and 32 for hash
-        pubkey1, hash1 = x1[:33], x1[33:65]
-        pubkey2, hash2 = x2[:33], x2[33:65]
-        pubkey1, pubkey2 = PublicKey(pubkey=pubkey1, raw=True), PublicKey(pubkey=pubkey2, raw=True)
-        # consider pubkey1+pubkey2
-        pk= PublicKey()
-        pk.combine([pubkey1.public_key, pubkey2.public_key])
-        first_part = pk.serialize()
-        second_part = sha256(hash1+hash2)
-        return first_part+second_part
+        return self._encode_node(self.sum_level([(self._decode_node(x1), self._decode_node(x2))])[0])
+
+      def sum_level(self, pairs):
+        # pubkeys are summed as points on curve in parsed form, hashes are concantenated and hashed
+        points = sum_points([(pubkey1, pubkey2) for (pubkey1, hash1), (pubkey2, hash2) in pairs])
+        return [(point, sha256(hash1+hash2)) for point, ((pubkey1, hash1), (pubkey2, hash2)) in zip(points, pairs)]
+
+      def _decode_node(self, value):
+        # each index is 33 bytes for pubkey and 32 for hash
+        return parse_pubkey(value[:33]), value[33:65]
+
+      def _encode_node(self, node):
+        return serialize_pubkey(node[0])+node[1]
 
 
 
@@ -33,7 +37,8 @@ class ExcessesStorage():
       if not path in self.__shared_states:
         self.__shared_states[path]={}
       self.__dict__ = self.__shared_states[path]
-      self.excesses = ExcessMMR("excesses", path, wtx=wtx, env=storage_space.env, clear_only=False)
+      self.excesses = ExcessMMR("excesses", path, wtx=wtx, env=storage_space.env, clear_only=False,
+                                node_storage=storage_space.mmr_node_storage.get("excesses", "lmdb"))
       self.storage_space = storage_space
       storage_space.register_excesses_storage(self)
       
@@ -59,7 +64,29 @@ class ExcessesStorage():
        if not excess_index[:33]==address_index[:33]: #First 33 bytes - serialized pubkey
          raise Exception("Wrong excess update") #Never should get here, since tx is already checked, but this check is cheap
        return num_index_ser, excess_index, excess
-      
+
+    def update_spent_addresses_with_excesses(self, updates, wtx):
+       '''
+         Batched version of update_spent_address_with_excess: `updates` is list of (num_index_ser, new_excess).
+       '''
+       olds = self.excesses.update_index_by_num_many(wtx, [(num_index_ser, new_excess.index, new_excess.serialize()) for num_index_ser, new_excess in updates], unique=True)
+       rollback_updates = []
+       for (num_index_ser, new_excess), (old_excess_index, old_excess) in zip(updates, olds):
+         if not new_excess.index[:33]==old_excess_index[:33]: #First 33 bytes - serialized pubkey
+           raise Exception("Wrong excess update") #Never should get here, since tx is already checked, but this check is cheap
+         rollback_updates.append((num_index_ser, old_excess_index, old_excess))
+       return rollback_updates
+
+    def rollback_serialized_excesses_to_addresses(self, rollback_updates, wtx):
+       '''
+         Batched version of rollback_serialized_excess_to_address: `rollback_updates` is list of
+         (num_index_ser, address_index, serialized_address).
+       '''
+       olds = self.excesses.update_index_by_num_many(wtx, rollback_updates)
+       for (num_index_ser, address_index, serialized_address), (excess_index, excess) in zip(rollback_updates, olds):
+         if not excess_index[:33]==address_index[:33]: #First 33 bytes - serialized pubkey
+           raise Exception("Wrong excess update") #Never should get here, since tx is already checked, but this check is cheap
+
 
     #def __contains__(self, serialized_index, ):
     #  return bool(self.excesses.get_by_hash(serialized_index))
@@ -81,36 +108,51 @@ class ExcessesStorage():
     def get_root(self, rtx):
       return self.excesses.get_root(rtx=rtx)
 
-    def apply_block_tx_get_merkles_and_rollback(self, tx, wtx):
-      initial_state = self.get_state(rtx=wtx)
-      initial_root = self.get_root(rtx=wtx)
-      num_of_added_excesses, rollback_updates = self.apply_block_tx(tx, b"Excess validation temporal state", wtx)
-      root = self.get_root(rtx=wtx)
-      self.rollback(num_of_added_excesses, initial_state, rollback_updates, wtx)
-      assert initial_root==self.get_root(rtx=wtx), "Database was corrupted during excesses apply_block_tx_get_merkles_and_rollback"
-      return root
-
-    def apply_block_tx(self, tx, new_state, wtx):
+    def get_proof(self, serialized_indexes, rtx):
+      '''
+        Merkle proof for excesses (or addresses of unspent outputs) with `serialized_indexes`.
+      '''
+      return self.excesses.get_multi_proof(serialized_indexes, rtx=rtx)
+
+    def verify_proof(self, root, serialized_indexes, proof):
+      return self.excesses.verify_multi_proof(root, serialized_indexes, proof)
+
+    def get_merkle_after_block_tx(self, tx, rtx):
+      '''
+        Calculate root which excesses tree will have after applying tx. Tree is not modified,
+        however (as apply_block_tx does) address_excess_num_index is set to outputs.
+      '''
+      excesses = self.excesses.view(rtx)
       for _o in tx.outputs:
-          num = self.append_utxo(_o, wtx=wtx)
-          _o.address_excess_num_index = num #storing num_index of stored address excess
+          _o.address_excess_num_index = excesses.append(_o.address.index)
       for _e in tx.additional_excesses:
-          self.append_additional_excess(_e, wtx=wtx)
-      rollback_updates = []
+          excesses.append(_e.index, unique=True)
       for _i in tx.inputs:
-          ind= _i.serialized_index
-          rb = self.update_spent_address_with_excess(_i.address_excess_num_index, tx.updated_excesses[ind], wtx=wtx)
-          rollback_updates.append(rb)
+          new_excess = tx.updated_excesses[_i.serialized_index]
+          old_excess_index = excesses.update_index_by_num(_i.address_excess_num_index, new_excess.index, unique=True)
+          if not new_excess.index[:33]==old_excess_index[:33]: #First 33 bytes - serialized pubkey
+            raise Exception("Wrong excess update") #Never should get here, since tx is already checked, but this check is cheap
+      return excesses.get_root()
+
+    def apply_block_tx(self, tx, new_state, wtx):
+      nums = self.excesses.append_many(wtx=wtx, objects=[(_o.address.index, b"") for _o in tx.outputs])
+      for _o, num in zip(tx.outputs, nums):
+          _o.address_excess_num_index = num #storing num_index of stored address excess
+      self.excesses.append_many(wtx=wtx, objects=[(_e.index, _e.serialize()) for _e in tx.additional_excesses], unique=True)
+      updates = [(_i.address_excess_num_index, tx.updated_excesses[_i.serialized_index]) for _i in tx.inputs]
+      rollback_updates = self.update_spent_addresses_with_excesses(updates, wtx=wtx)
       self.set_state(new_state, wtx=wtx)
       return len(tx.additional_excesses)+len(tx.outputs), rollback_updates
 
     def rollback(self, num_of_added_excesses, prev_state, rollback_updates, wtx):
       self.excesses.remove(num_of_added_excesses, wtx=wtx)
       self.set_state(prev_state, wtx=wtx)
+      updates = []
       for rb in rollback_updates:
         if rb[2]==None and int.from_bytes(rb[0],"big")<14100:
           rb = (rb[0], rb[1], b"")
-        self.rollback_serialized_excess_to_address(rb[0], rb[1], rb[2], wtx=wtx)
+        updates.append(rb)
+      self.rollback_serialized_excesses_to_addresses(updates, wtx=wtx)
 
     def get_state(self, rtx):
       return self.excesses.get_state(rtx=rtx)
@@ -1,5 +1,7 @@
 from leer.core.primitives.header import Header, ContextHeader
-import shutil, os, time, lmdb, math
+import shutil, os, time, lmdb, math, copy
+from collections import OrderedDict
+from contextlib import contextmanager
 
 class HeadersStorage:
 
@@ -11,24 +13,76 @@ class HeadersStorage:
         self.__shared_states[path]={}
     self.__dict__ = self.__shared_states[path]
     self.storage = HeadersDiscStorage(path, env=storage_space.env, wtx=wtx)
+    self.cache = HeadersCache()
+    self.working_set, self.batch_txn = None, None # see `batch`
     self.storage_space = storage_space
     self.storage_space.register_headers_storage(self)
 
+  def _in_batch(self, rtx):
+    return self.working_set!=None and rtx is self.batch_txn
+
+  @contextmanager
+  def batch(self, wtx):
+    '''
+      Headers put (or updated) inside batch are kept in working set in memory, are visible
+      to `get` and `has` with the same `wtx` and are written to db once on exit. Nested batches
+      are joined to the outermost one. On exception working set is discarded.
+    '''
+    if self.working_set!=None:
+      yield
+      return
+    self.working_set, self.batch_txn = OrderedDict(), wtx
+    try:
+      yield
+      working_set = self.working_set
+      self.working_set = None
+      for _hash, header in working_set.items():
+        self.put(_hash, header, wtx=wtx)
+    finally:
+      self.working_set, self.batch_txn = None, None
+
   def get(self, _hash, rtx):
+    if self._in_batch(rtx) and bytes(_hash) in self.working_set:
+      return _copy_header(self.working_set[bytes(_hash)])
+    ch = self.cache.get(_hash, rtx=rtx)
+    if ch:
+      return ch
     serialized_header = self.storage.get_by_hash(_hash, rtx=rtx)
     if not serialized_header:
       raise KeyError(_hash)
     ch=ContextHeader()
     ch.deserialize(serialized_header)
+    self.cache.put(_hash, ch, len(serialized_header))
     return ch
 
   def put(self, _hash, header, wtx):
-    self.storage.put(header.height, header.hash, header.serialize_with_context(), wtx=wtx)
+    if self._in_batch(wtx):
+      self.working_set[bytes(_hash)] = _copy_header(header)
+      return
+    serialized_header = header.serialize_with_context()
+    self.cache.write(_hash, header, len(serialized_header), wtx=wtx)
+    self.storage.put(header.height, _hash, serialized_header, wtx=wtx)
 
   def update(self, _hash, header, wtx):
-    self.storage.update(header.hash, header.serialize_with_context(), wtx=wtx)
+    if self._in_batch(wtx):
+      self.working_set[bytes(_hash)] = _copy_header(header)
+      return
+    serialized_header = header.serialize_with_context()
+    self.cache.write(_hash, header, len(serialized_header), wtx=wtx)
+    self.storage.update(_hash, serialized_header, wtx=wtx)
+
+  def invalidate_cache(self, wtx):
+    '''
+      Should be called if headers are written to db bypassing this object (for instance, on snapshot import).
+    '''
+    self.cache.invalidate_all(wtx=wtx)
+
+  def cache_stats(self):
+    return self.cache.stats()
 
   def has(self, _hash, rtx):
+    if self._in_batch(rtx) and bytes(_hash) in self.working_set:
+      return True
     return bool(self.storage.get_by_hash(_hash, rtx=rtx))
       
   def get_headers_at_height(self, height, rtx):
@@ -42,6 +96,137 @@ class HeadersStorage:
   def get_headers_hashes_at_height(self, height, rtx):
     return self.storage.get_hashes_by_height(height,rtx=rtx)
 
+  def set_main_chain(self, height, _hash, wtx):
+    self.storage.put_main_chain(height, _hash, wtx=wtx)
+
+  def unset_main_chain(self, height, wtx):
+    self.storage.remove_main_chain(height, wtx=wtx)
+
+  def get_main_chain_hash(self, height, rtx):
+    '''
+      Hash of block with `height` in main chain, None if height is above tip.
+    '''
+    return self.storage.get_main_chain(height, rtx=rtx)
+
+  def main_chain_index_is_empty(self, rtx):
+    return not rtx.stat(self.storage.main_chain_db)['entries']
+
+  def add_tip(self, _hash, header, wtx):
+    self.storage.put_tip(_tip_key(_hash, header), wtx=wtx)
+
+  def remove_tip(self, _hash, header, wtx):
+    self.storage.remove_tip(_tip_key(_hash, header), wtx=wtx)
+
+  def has_tip(self, _hash, header, rtx):
+    return self.storage.has_tip(_tip_key(_hash, header), rtx=rtx)
+
+  def best_tip(self, rtx):
+    '''
+      (hash, height) of indexed tip with highest (height, hash), None if index is empty.
+    '''
+    key = self.storage.get_last_tip(rtx=rtx)
+    if not key:
+      return None
+    return key[4:], int.from_bytes(key[:4], 'big')
+
+  def tips_index_is_empty(self, rtx):
+    return not rtx.stat(self.storage.tips_db)['entries']
+
+  def set_skip(self, _hash, skip_hash, wtx):
+    self.storage.put_skip(_hash, skip_hash, wtx=wtx)
+
+  def get_skip(self, _hash, rtx):
+    return self.storage.get_skip(_hash, rtx=rtx)
+
+
+def _copy_header(header):
+  ch = copy.copy(header)
+  ch.descendants = set(header.descendants)
+  return ch
+
+def _tip_key(_hash, header):
+  # Blockchain follows the highest chain, so tips are ordered by height
+  return __(header.height) + bytes(_hash)
+
+
+class HeadersCache:
+  '''
+    LRU cache of decoded ContextHeaders keyed by hash, bounded by total length of serialized headers.
+    Cached headers are never given out: `get` returns a copy (with its own set of descendants),
+    so caller may modify it (as mark_subchain_invalid does) without affecting the cache.
+
+    Headers written by write transaction are dirty: they are evicted from the cache and kept
+    in `pending`, which is visible only to this transaction. Since lmdb increments transaction id
+    only on commit, transaction with greater id means that pending headers are committed and
+    may be moved to the cache; another transaction with the same id means that they are aborted
+    (or belong to parent transaction), in this case they are dropped but stay dirty.
+  '''
+  max_bytes = 32*1024*1024
+
+  def __init__(self):
+    self.headers = OrderedDict() # hash -> (header, size)
+    self.size = 0
+    self.txn, self.txn_id = None, None
+    self.pending = {} # hash -> (header, size)
+    self.dirty = set() # None means that all headers are dirty
+    self.hits, self.misses = 0, 0
+
+  def get(self, _hash, rtx):
+    _hash = bytes(_hash)
+    if rtx is self.txn and _hash in self.pending:
+      header = self.pending[_hash][0]
+    elif _hash in self.headers:
+      self.headers.move_to_end(_hash)
+      header = self.headers[_hash][0]
+    else:
+      self.misses += 1
+      return None
+    self.hits += 1
+    return _copy_header(header)
+
+  def put(self, _hash, header, size):
+    _hash = bytes(_hash)
+    if self.dirty==None or _hash in self.dirty or _hash in self.headers:
+      return
+    self._insert(_hash, _copy_header(header), size)
+
+  def _insert(self, _hash, header, size):
+    self.headers[_hash] = (header, size)
+    self.size += size
+    while self.size > self.max_bytes:
+      _, (_, evicted_size) = self.headers.popitem(last=False)
+      self.size -= evicted_size
+
+  def _start_txn(self, wtx):
+    if wtx is self.txn:
+      return
+    if self.txn_id==None or wtx.id()>self.txn_id:
+      if self.dirty!=None:
+        for _hash, (header, size) in self.pending.items():
+          self._insert(_hash, header, size)
+      self.dirty = set()
+    self.pending = {}
+    self.txn, self.txn_id = wtx, wtx.id()
+
+  def write(self, _hash, header, size, wtx):
+    _hash = bytes(_hash)
+    self._start_txn(wtx)
+    if _hash in self.headers:
+      self.size -= self.headers.pop(_hash)[1]
+    if self.dirty!=None:
+      self.dirty.add(_hash)
+      self.pending[_hash] = (_copy_header(header), size)
+
+  def invalidate_all(self, wtx):
+    self._start_txn(wtx)
+    self.headers, self.size = OrderedDict(), 0
+    self.pending, self.dirty = {}, None
+
+  def stats(self):
+    requests = self.hits + self.misses
+    return {'hits': self.hits, 'misses': self.misses, 'hit_rate': self.hits/requests if requests else 0.,
+            'entries': len(self.headers), 'bytes': self.size}
+
 
 def __(x):
   return (x).to_bytes(4,'big')
@@ -53,6 +238,9 @@ class HeadersDiscStorage:
     self.env = env
     self.main_db = self.env.open_db(b'headers_main_db', txn=wtx, dupsort=False)
     self.height_db = self.env.open_db(b'headers_height_db', txn=wtx, dupsort=True)
+    self.main_chain_db = self.env.open_db(b'headers_main_chain_db', txn=wtx, dupsort=False) # height -> hash of main chain block
+    self.skip_db = self.env.open_db(b'headers_skip_db', txn=wtx, dupsort=False) # hash -> hash of ancestor at skip_height
+    self.tips_db = self.env.open_db(b'headers_tips_db', txn=wtx, dupsort=False) # height|hash of valid leafs -> b""
 
   def put(self, height, _hash, serialized_header, wtx):
     p1=wtx.put( bytes(_hash), bytes(serialized_header), db=self.main_db, dupdata=False, overwrite=True)
@@ -74,5 +262,33 @@ class HeadersDiscStorage:
       cursor = rtx.cursor(db=self.height_db)
       assert cursor.set_key(__(height))
       return list(cursor.iternext_dup())
-  
 
+  def put_main_chain(self, height, _hash, wtx):
+    wtx.put(__(height), bytes(_hash), db=self.main_chain_db, overwrite=True)
+
+  def remove_main_chain(self, height, wtx):
+    wtx.delete(__(height), db=self.main_chain_db)
+
+  def get_main_chain(self, height, rtx):
+    return rtx.get(__(height), db=self.main_chain_db)
+
+  def put_skip(self, _hash, skip_hash, wtx):
+    wtx.put(bytes(_hash), bytes(skip_hash), db=self.skip_db, overwrite=True)
+
+  def get_skip(self, _hash, rtx):
+    return rtx.get(bytes(_hash), db=self.skip_db)
+
+  def put_tip(self, key, wtx):
+    wtx.put(key, b"", db=self.tips_db, overwrite=True)
+
+  def remove_tip(self, key, wtx):
+    wtx.delete(key, db=self.tips_db)
+
+  def has_tip(self, key, rtx):
+    return rtx.get(key, db=self.tips_db)!=None
+
+  def get_last_tip(self, rtx):
+    cursor = rtx.cursor(db=self.tips_db)
+    if not cursor.last():
+      return None
+    return cursor.key()
@@ -1,4 +1,6 @@
 from collections import OrderedDict
+from contextlib import contextmanager, ExitStack
+from leer.core.storage.node_storage import LMDBNodeStorage, FlatFileNodeStorage
 import os, lmdb, math
 
 
@@ -24,11 +26,20 @@ class MMR:
 
   Boundary case: tree with zero leafs has root equal to `'\\x00'*default_index_size`
 
-  Inner structure contains 4 lmdb databases: leaf_db, node_db, order_db, reverse_order_db.
+  Inner structure contains 3 lmdb databases: leaf_db, order_db, reverse_order_db and node storage.
   order_db: 		sequence_num -> index
   reverse_order_db: 	index -> sequence_num
   leaf_db: 		index -> object
-  node_db: 		(level,sequence_num) -> tree_node_index
+  node storage: 	(level,sequence_num) -> tree_node_index
+  Node storage is either lmdb node_db (`node_storage="lmdb"`) or flat files, one per level,
+  with records of `node_size` bytes (`node_storage="flat_file"`), see node_storage.py.
+  Nodes can always be recalculated from leafs, it is done when node storage is changed or inconsistent.
+
+  If `prune_horizon` is set, pruned (discarded or cleared) leafs are collapsed `prune_horizon` blocks
+  after pruning (see `journal_pruned` and `settle_pruned`): their objects are evicted from pruned_db and
+  each subtree which contains only such leafs is replaced by its root. Roots of collapsed subtrees
+  are stored in collapsed_db: (level, sequence_num) -> node, leafs and nodes below them are deleted.
+  Pruning in blocks deeper than horizon can not be reverted.
 
   3 remove-like operations are supported:
     remove(n)  - removes n elements from the end of the list. Cannot be undone.
@@ -43,8 +54,14 @@ class MMR:
 
   Special value is leaf db with index `b'state'. It is used to store identifier of current MMR state on disc.
     `set_state` and `get_state` write and read this value
+
+  Inside `cached_nodes(wtx)` context tree nodes (level>0) and number of leafs are cached in memory
+  for write transaction `wtx`, node storage is updated only on context exit.
+
+  Authentication paths of leafs (merkle proofs) are given by `get_proof` and `get_multi_proof`
+  and checked against root by `verify_proof` and `verify_multi_proof`.
   """
-  def __init__(self, name, dir_path, env, wtx, waterline_depth=16, default_index_size=65, discard_only=False, clear_only=False, save_pruned=True):
+  def __init__(self, name, dir_path, env, wtx, waterline_depth=16, default_index_size=65, discard_only=False, clear_only=False, save_pruned=True, node_storage="lmdb", node_size=None, prune_horizon=None):
     self.index={}
     self.dir_path = dir_path
     self.name = bytes(name.encode("utf-8"))
@@ -52,22 +69,73 @@ class MMR:
     self.discard_only = discard_only
     self.clear_only = clear_only
     self.save_pruned = save_pruned # Do not really delete data from db for debug purposes
+    self.prune_horizon = prune_horizon
 
 
     self.env = env
     self.leaf_db = self.env.open_db(self.name+b'leaf_db', txn=wtx)
-    self.node_db = self.env.open_db(self.name+b'node_db', txn=wtx)
     self.order_db = self.env.open_db(self.name+b'order_db', txn=wtx)
     self.reverse_order_db = self.env.open_db(self.name+b'reverse_order_db', txn=wtx, dupsort=True)
     if self.save_pruned:
         self.pruned_db = self.env.open_db(self.name+b'pruned_db', txn=wtx)
         self.pruned_ro_db = self.env.open_db(self.name+b'pruned_ro_db', txn=wtx, dupsort=True)
+    self.collapsed_db = self.env.open_db(self.name+b'collapsed_db', txn=wtx)
+    self.pruned_journal_db = self.env.open_db(self.name+b'pruned_journal_db', txn=wtx) # height -> sequence_nums
+    self.node_cache = None
+    if node_storage=="lmdb":
+      self.node_storage = LMDBNodeStorage(self.name, env, wtx)
+    elif node_storage=="flat_file":
+      self.node_storage = FlatFileNodeStorage(os.path.join(dir_path, name+"_nodes"), node_size or default_index_size, self.leaf_db, wtx)
+      self.node_storage.rebuild = self._rebuild_nodes
+    else:
+      raise Exception("Unknown node storage %s"%node_storage)
+    stored_node_storage = wtx.get(b'node_storage', db=self.leaf_db)
+    if (not self.node_storage.consistent) or (stored_node_storage or LMDBNodeStorage.name)!=self.node_storage.name:
+      self._rebuild_nodes(wtx)
+      wtx.put(b'node_storage', self.node_storage.name, db=self.leaf_db)
+
+  @contextmanager
+  def cached_nodes(self, wtx):
+    """
+      Write-back cache of tree nodes for write transaction `wtx`. Nodes read and written
+      in `wtx` are kept in dict and dirty ones are flushed to node storage in one sorted pass
+      on exit. Cache is flushed even if exception is raised inside context: leafs are already
+      changed in `wtx`, which may be committed by caller, so nodes should be changed with them.
+      Nested contexts for the same transaction reuse outer cache.
+    """
+    if self.node_cache:
+      if not self.node_cache.wtx is wtx:
+        raise Exception("Node cache is already used by another transaction")
+      yield self.node_cache
+      return
+    self.node_cache = NodeCache(wtx)
+    try:
+      yield self.node_cache
+    finally:
+      try:
+        self.node_cache.flush(self.node_storage)
+        self.node_storage.sync(wtx)
+      finally:
+        self.node_cache = None
+
+  def _node_cache(self, rtx):
+    if self.node_cache and self.node_cache.wtx is rtx:
+      return self.node_cache
+    return None
 
   def _get_node(self, level, sequence_num, rtx):
     if level==0:
           return rtx.get( _(sequence_num), db=self.order_db)
     else:
-        return rtx.get(_(level-1)+_(sequence_num), db=self.node_db)
+        cache = self._node_cache(rtx)
+        if not cache:
+          return self.node_storage.get(level, sequence_num, rtx=rtx)
+        key = (level, sequence_num)
+        if not key in cache.nodes:
+          if sequence_num >= cache.truncations.get(level, sequence_num+1):
+            return None
+          cache.nodes[key] = self.node_storage.get(level, sequence_num, rtx=rtx)
+        return cache.nodes[key]
 
   def get_by_hash(self, _hash, rtx):
     return rtx.get(_hash, db=self.leaf_db)
@@ -84,6 +152,18 @@ class MMR:
       raise
     return rtx.get(_hash, db=self.pruned_db)
 
+  def get_pruned_by_num(self, num, rtx):
+    '''
+      Returns prune object [num, index, obj] (the same as discard and clear return) of leaf which
+      was pruned but not collapsed yet.
+    '''
+    if not self.save_pruned:
+      raise
+    _index = rtx.get(_(num), db=self.pruned_db)
+    if _index==None:
+      raise KeyError(num)
+    return [num, _index, rtx.get(_index, db=self.pruned_db)]
+
   def find_by_hash(self, _hash, rtx):
     '''
       In contrast with get_by_hash, find_by_hash tries to find result both in existing and pruned(if saved) dbs.
@@ -94,13 +174,60 @@ class MMR:
     return r1
 
   def _set_node(self, level, sequence_num, value, wtx):
-    wtx.put(_(level-1)+_(sequence_num), value, db=self.node_db)
+    cache = self._node_cache(wtx)
+    if cache:
+      cache.set((level, sequence_num), value)
+    else:
+      self.node_storage.put(level, sequence_num, value, wtx=wtx)
 
   def _del_node(self, level, sequence_num, wtx):
-    wtx.delete(_(level-1)+_(sequence_num), db=self.node_db)
+    cache = self._node_cache(wtx)
+    if cache:
+      cache.set((level, sequence_num), None)
+    else:
+      self.node_storage.delete(level, sequence_num, wtx=wtx)
+
+  def _truncate_level(self, level, length, wtx):
+    """
+      Delete all nodes on `level` (level>0) with sequence_num >= `length`.
+    """
+    cache = self._node_cache(wtx)
+    if cache:
+      cache.truncate(level, length)
+    else:
+      self.node_storage.truncate(level, length, wtx=wtx)
+
+  def _rebuild_nodes(self, wtx):
+    """
+      Recalculate all nodes from leafs and roots of collapsed subtrees.
+    """
+    self.node_storage.clear(wtx)
+    collapsed_roots = {}
+    for key, value in wtx.cursor(db=self.collapsed_db):
+      if len(key)==10 and int.from_bytes(key[:5], 'big'): # leafs (level 0) are still in order_db
+        level, sequence_num = int.from_bytes(key[:5], 'big'), int.from_bytes(key[5:], 'big')
+        self._set_node(level, sequence_num, value, wtx=wtx)
+        collapsed_roots[level] = collapsed_roots.get(level, []) + [sequence_num]
+    leafs = [int.from_bytes(key, 'big') for key in wtx.cursor(db=self.order_db).iternext(values=False)]
+    self._update_paths(0, leafs, wtx=wtx, known_nodes=collapsed_roots)
+    self.node_storage.sync(wtx)
 
   def num_of_elements(self, rtx):
-    return rtx.stat(db=self.order_db)['entries']
+    cache = self._node_cache(rtx)
+    if not cache:
+      return rtx.stat(db=self.order_db)['entries'] + self._num_of_collapsed_leafs(rtx=rtx)
+    if cache.num_of_elements == None:
+      cache.num_of_elements = rtx.stat(db=self.order_db)['entries'] + self._num_of_collapsed_leafs(rtx=rtx)
+    return cache.num_of_elements
+
+  def _num_of_collapsed_leafs(self, rtx):
+    num = rtx.get(b'leafs', db=self.collapsed_db)
+    return int.from_bytes(num, 'big') if num else 0
+
+  def _change_num_of_elements(self, delta, wtx):
+    cache = self._node_cache(wtx)
+    if cache and not cache.num_of_elements == None:
+      cache.num_of_elements += delta
 
   def _get_max_level(self, rtx):
     try:
@@ -109,91 +236,146 @@ class MMR:
       #if num_of_elements ==0, math.log raise ValueError
       raise ValueError("getting root level of empty tree")
 
+  def _calculate_parents(self, sequence_nums, get_child):
+    """
+      Calculate nodes with `sequence_nums` (on one level) from their children.
+      `get_child(sequence_num)` returns child node either serialized or decoded (by `_decode_node`).
+      Nodes with both children are calculated by one `sum_level` call, lonely child is
+      copied up. Returns dict sequence_num -> node (serialized or decoded).
+    """
+    nodes, pairs = {}, []
+    for sequence_num in sequence_nums:
+      left, right = get_child(2*sequence_num), get_child(2*sequence_num+1)
+      if left and right:
+        pairs.append((sequence_num, self._decoded_node(left), self._decoded_node(right)))
+      else:
+        nodes[sequence_num] = left or right or b"" # just copy value up
+    sums = self.sum_level([(left, right) for sequence_num, left, right in pairs])
+    for (sequence_num, left, right), node in zip(pairs, sums):
+      nodes[sequence_num] = node
+    return nodes
+
+  def _decoded_node(self, node):
+    return self._decode_node(node) if isinstance(node, bytes) else node
+
+  def _serialized_node(self, node):
+    return node if isinstance(node, bytes) else self._encode_node(node)
+
   def _update_path(self, level, sequence_num, wtx):
     """
       This function should be called when node on level `level` with sequence_num `sequence_num` changes.
       It updates all nodes above
     """
+    self._update_paths(level, [sequence_num], wtx=wtx)
+
+  def _update_paths(self, level, sequence_nums, wtx, known_nodes={}):
+    """
+      Batched version of `_update_path`: updates all nodes above changed nodes on level `level`.
+      Nodes are recalculated level by level, each dirty node only once.
+      `known_nodes` (level -> sequence_nums) are nodes which are already set and should be
+      taken into account as changed on their level.
+    """
     try:
       mxlvl = self._get_max_level(rtx=wtx)
     except ValueError:
       return
-    if level == mxlvl and sequence_num==0:
-      #already at the root, nothing to update
-      pass
-    else:
-      neighbour_index = (sequence_num//2)*2 if (sequence_num%2) else (sequence_num//2)*2+1
-      neighbour = self._get_node(level, neighbour_index, rtx=wtx)
-      we = self._get_node(level, sequence_num, rtx=wtx)
-      if neighbour and we:
-        if sequence_num%2:
-          new_value = self.sum(neighbour, we)
-        else:
-          new_value = self.sum(we, neighbour)
-      else:
-        new_value = we if we else neighbour# just copy value up
-      self._set_node(level+1, sequence_num//2, new_value, wtx=wtx)
-      self._update_path(level+1, sequence_num//2, wtx=wtx)
+    dirty, nodes = set(sequence_nums), {}
+    while level < mxlvl and len(dirty):
+      def get_child(sequence_num):
+        if sequence_num in nodes:
+          return nodes[sequence_num] # calculated on previous step, possibly still decoded
+        return self._get_node(level, sequence_num, rtx=wtx)
+      dirty = sorted(set([sequence_num//2 for sequence_num in dirty]))
+      nodes = self._calculate_parents(dirty, get_child)
+      for sequence_num in dirty:
+        self._set_node(level+1, sequence_num, self._serialized_node(nodes[sequence_num]), wtx=wtx)
+      level += 1
+      dirty = set(dirty).union(known_nodes.get(level, []))
 
   def append(self, wtx, obj_index=None, obj=None):
-      num = wtx.stat(db=self.order_db)['entries']
-      #TODO actually we probably may use append=True flag for order_db
-      wtx.put( _(num), bytes(obj_index), db=self.order_db)
-      wtx.put( bytes(obj_index), _(num), db=self.reverse_order_db)
-      wtx.put(bytes(obj_index), bytes(obj), db=self.leaf_db)
-      self._update_path(0, num, wtx=wtx)
-      return _(num)
+      return self.append_many(wtx, [(obj_index, obj)])[0]
+
+  def append_many(self, wtx, objects, unique=False):
+      """
+        Append list of (obj_index, obj) pairs. All leafs are written first, after that nodes above
+        are updated in one pass. Returns list of serialized sequence nums of appended leafs.
+        If `unique` is set, KeyError is raised (before any writing) if any index is already in tree.
+      """
+      objects = [(bytes(obj_index), bytes(obj)) for obj_index, obj in objects]
+      if unique:
+        indexes = set([obj_index for obj_index, obj in objects])
+        if len(indexes)<len(objects):
+          raise KeyError("Not unique")
+        for obj_index in indexes:
+          if wtx.get(obj_index, db=self.reverse_order_db):
+            raise KeyError("Not unique")
+      start_num = self.num_of_elements(rtx=wtx)
+      nums = list(range(start_num, start_num+len(objects)))
+      for num, (obj_index, obj) in zip(nums, objects):
+        wtx.put( _(num), obj_index, db=self.order_db, append=True)
+        wtx.put( obj_index, _(num), db=self.reverse_order_db)
+        wtx.put( obj_index, obj, db=self.leaf_db)
+      self._change_num_of_elements(len(nums), wtx=wtx)
+      self._update_paths(0, nums, wtx=wtx)
+      return [_(num) for num in nums]
 
   def has_index(self, rtx, obj_index):
       index = rtx.get( bytes(obj_index), db=self.reverse_order_db)
       return bool(index)
 
   def append_unique(self, wtx, obj_index=None, obj=None):
-      index = wtx.get( bytes(obj_index), db=self.reverse_order_db)
-      if index:
-        raise KeyError("Not unique")
-      self.append(wtx=wtx, obj_index=obj_index, obj=obj)
+      return self.append_many(wtx, [(obj_index, obj)], unique=True)[0]
 
   def update_index_by_num(self, wtx, num_index_ser, obj_index, obj):
-      old_index = wtx.get( num_index_ser, db=self.order_db)
-      wtx.put( num_index_ser, bytes(obj_index), db=self.order_db)
-      wtx.delete( bytes(old_index), num_index_ser, db=self.reverse_order_db)
-      wtx.put( bytes(obj_index), num_index_ser, db=self.reverse_order_db)
-      if not wtx.get(bytes(old_index), db=self.reverse_order_db):
-        #no leafs with the same index      
-        old_obj = wtx.pop(bytes(old_index), db=self.leaf_db)
-      else:
-        old_obj = wtx.get(bytes(old_index), db=self.leaf_db)
-      wtx.put(bytes(obj_index), bytes(obj) , db=self.leaf_db)
-      self._update_path(0, int.from_bytes(num_index_ser,"big"), wtx=wtx)
-      return old_index, old_obj
+      return self.update_index_by_num_many(wtx, [(num_index_ser, obj_index, obj)])[0]
 
   def update_index_by_num_unique(self, wtx, num_index_ser, obj_index, obj):
-      nindex = wtx.get( bytes(obj_index), db=self.reverse_order_db)
-      if nindex:
-        raise KeyError("Not unique")
-      return self.update_index_by_num(wtx, num_index_ser, obj_index, obj)
-
-      
-    
+      return self.update_index_by_num_many(wtx, [(num_index_ser, obj_index, obj)], unique=True)[0]
+
+  def update_index_by_num_many(self, wtx, updates, unique=False):
+      """
+        Set new index and obj for leafs with serialized sequence nums.
+        `updates` is list of (num_index_ser, obj_index, obj). Returns list of (old_index, old_obj).
+      """
+      olds, nums = [], []
+      for num_index_ser, obj_index, obj in updates:
+        if unique and wtx.get( bytes(obj_index), db=self.reverse_order_db):
+          raise KeyError("Not unique")
+        old_index = wtx.get( num_index_ser, db=self.order_db)
+        wtx.put( num_index_ser, bytes(obj_index), db=self.order_db)
+        wtx.delete( bytes(old_index), num_index_ser, db=self.reverse_order_db)
+        wtx.put( bytes(obj_index), num_index_ser, db=self.reverse_order_db)
+        if not wtx.get(bytes(old_index), db=self.reverse_order_db):
+          #no leafs with the same index      
+          old_obj = wtx.pop(bytes(old_index), db=self.leaf_db)
+        else:
+          old_obj = wtx.get(bytes(old_index), db=self.leaf_db)
+        wtx.put(bytes(obj_index), bytes(obj) , db=self.leaf_db)
+        olds.append((old_index, old_obj))
+        nums.append(int.from_bytes(num_index_ser,"big"))
+      self._update_paths(0, nums, wtx=wtx)
+      return olds
 
   def remove(self, num, wtx, set_of_indexes=None):
     """
      Remove `num_of_elements` from right end.
      If `set_of_elements` specified check before remove that all elements are in set.
+     Nodes above removed leafs are deleted level by level, remaining path is updated once.
     """
+    if not num:
+      return []
     start_n = self.num_of_elements(rtx=wtx)-1
+    end_n = start_n-num+1
     mxlvl = self._get_max_level(rtx=wtx) 
     cache = {}
     if set_of_indexes:
-        for el_n in range(start_n, start_n-num, -1):
+        for el_n in range(start_n, end_n-1, -1):
           el=wtx.get(_(el_n),db=self.order_db)
           cache[el_n] = el
           if not el in set_of_indexes:
             raise #TODO
     removed_objects = []
-    el_n = start_n
-    for el_n in range(start_n, start_n-num, -1):
+    for el_n in range(start_n, end_n-1, -1):
         if not el_n in cache:
           el=wtx.get(_(el_n),db=self.order_db)
           cache[el_n] = el
@@ -204,11 +386,11 @@ class MMR:
         else:
           obj = wtx.get( cache[el_n], db=self.leaf_db)
         removed_objects.append(obj)
-        #TODO we can make this much faster for bulk deletion by not updating
-        # each path separately
-        for l in range(1,mxlvl+1):
-          self._del_node(l, el_n//(2**l), wtx=wtx) 
-    self._update_path(0, el_n-1, wtx=wtx)
+    self._change_num_of_elements(-num, wtx=wtx)
+    for l in range(1,mxlvl+1):
+      self._truncate_level(l, end_n//(2**l), wtx=wtx)
+    if end_n:
+      self._update_paths(0, [end_n-1], wtx=wtx)
     return removed_objects
 
   def discard(self, _index, wtx):
@@ -216,61 +398,159 @@ class MMR:
       Discard leaf, that means delete obj by index(for saving space), but keep its index.
       Returns object which can be used to revert discarding.
     '''
+    return self.discard_many([_index], wtx=wtx)[0]
+
+  def discard_many(self, indexes, wtx):
     #TODO: check wether both children are discarded (thus we can discard childs and keep only parent index)
     if self.clear_only:
       raise
-    num = int.from_bytes(wtx.get( bytes(_index), db=self.reverse_order_db), 'big')
-    #wtx.put( _(num), b"", db=self.order_db)
-    obj = wtx.pop( bytes(_index), db=self.leaf_db)
-    if self.save_pruned:
-        wtx.put(_(num), bytes(_index), db=self.pruned_db) 
-        wtx.put(bytes(_index), obj, db=self.pruned_db)       
-    self._update_path(0, num, wtx=wtx)
-    return [num, _index, obj]
+    prune_objs = []
+    for _index in indexes:
+      num = int.from_bytes(wtx.get( bytes(_index), db=self.reverse_order_db), 'big')
+      #wtx.put( _(num), b"", db=self.order_db)
+      obj = wtx.pop( bytes(_index), db=self.leaf_db)
+      if self.save_pruned:
+          wtx.put(_(num), bytes(_index), db=self.pruned_db) 
+          wtx.put(bytes(_index), obj, db=self.pruned_db)       
+      prune_objs.append([num, _index, obj])
+    self._update_paths(0, [prune_obj[0] for prune_obj in prune_objs], wtx=wtx)
+    return prune_objs
 
   def revert_discarding(self, prune_obj, wtx):
     '''
       Revert discarding by object which is returned by discard
     '''
-    num, obj_index, obj = prune_obj
-    wtx.put( _(num), bytes(obj_index), db=self.order_db)
-    wtx.put( bytes(obj_index), _(num), db=self.reverse_order_db)
-    wtx.put(bytes(obj_index), bytes(obj), db=self.leaf_db) 
-    if self.save_pruned:
-        wtx.pop(_(num), db=self.pruned_db) 
-        wtx.pop(bytes(obj_index), db=self.pruned_db)        
-    self._update_path(0, num, wtx=wtx)  
+    self.revert_discarding_many([prune_obj], wtx=wtx)
+
+  def revert_discarding_many(self, prune_objs, wtx):
+    for num, obj_index, obj in prune_objs:
+      wtx.put( _(num), bytes(obj_index), db=self.order_db)
+      wtx.put( bytes(obj_index), _(num), db=self.reverse_order_db)
+      wtx.put(bytes(obj_index), bytes(obj), db=self.leaf_db) 
+      if self.save_pruned:
+          wtx.pop(_(num), db=self.pruned_db) 
+          wtx.pop(bytes(obj_index), db=self.pruned_db)        
+    self._update_paths(0, [prune_obj[0] for prune_obj in prune_objs], wtx=wtx)
 
   def clear(self, _index, wtx):
     '''
       Clear leaf, that means delete information (index and object), 
       but keep place. Returns prune object by which it can be easily unpruned
     '''
+    return self.clear_many([_index], wtx=wtx)[0]
+
+  def clear_many(self, indexes, wtx):
     if self.discard_only:
       raise
-    num = int.from_bytes(wtx.pop( bytes(_index), db=self.reverse_order_db), 'big')
-    wtx.put( _(num), b"", db=self.order_db)
-    obj = wtx.pop( bytes(_index), db=self.leaf_db)
-    if self.save_pruned:
-        wtx.put(_(num), bytes(_index), db=self.pruned_db) 
-        wtx.put(bytes(_index), obj, db=self.pruned_db) 
-        wtx.put(bytes(_index), _(num), db=self.pruned_ro_db)           
-    self._update_path(0, num, wtx=wtx)
-    return [num, _index, obj]
+    prune_objs = []
+    for _index in indexes:
+      num = int.from_bytes(wtx.pop( bytes(_index), db=self.reverse_order_db), 'big')
+      wtx.put( _(num), b"", db=self.order_db)
+      obj = wtx.pop( bytes(_index), db=self.leaf_db)
+      if self.save_pruned:
+          wtx.put(_(num), bytes(_index), db=self.pruned_db) 
+          wtx.put(bytes(_index), obj, db=self.pruned_db) 
+          wtx.put(bytes(_index), _(num), db=self.pruned_ro_db)           
+      prune_objs.append([num, _index, obj])
+    self._update_paths(0, [prune_obj[0] for prune_obj in prune_objs], wtx=wtx)
+    return prune_objs
 
   def revert_clearing(self, prune_obj, wtx):
     '''
       revert_clearing takes object which clear function returns and reverts clear operation.
     '''
-    num, obj_index, obj = prune_obj
-    wtx.put( _(num), bytes(obj_index), db=self.order_db)
-    wtx.put( bytes(obj_index), _(num), db=self.reverse_order_db)
-    wtx.put(bytes(obj_index), bytes(obj), db=self.leaf_db)  
-    if self.save_pruned:
-        wtx.pop(_(num), db=self.pruned_db) 
-        wtx.pop(bytes(obj_index), db=self.pruned_db) 
-        wtx.pop(bytes(obj_index), db=self.pruned_ro_db)   
-    self._update_path(0, num, wtx=wtx) 
+    self.revert_clearing_many([prune_obj], wtx=wtx)
+
+  def revert_clearing_many(self, prune_objs, wtx):
+    for num, obj_index, obj in prune_objs:
+      wtx.put( _(num), bytes(obj_index), db=self.order_db)
+      wtx.put( bytes(obj_index), _(num), db=self.reverse_order_db)
+      wtx.put(bytes(obj_index), bytes(obj), db=self.leaf_db)  
+      if self.save_pruned:
+          wtx.pop(_(num), db=self.pruned_db) 
+          wtx.pop(bytes(obj_index), db=self.pruned_db) 
+          wtx.pop(bytes(obj_index), db=self.pruned_ro_db)   
+    self._update_paths(0, [prune_obj[0] for prune_obj in prune_objs], wtx=wtx)
+
+  def journal_pruned(self, height, sequence_nums, wtx):
+    """
+      Remember sequence nums of leafs pruned in block at `height`, they will be collapsed
+      by `settle_pruned` `prune_horizon` blocks later. Does nothing if horizon is not set.
+    """
+    if self.prune_horizon==None or not len(sequence_nums):
+      return
+    wtx.put(_(height), b"".join([_(num) for num in sequence_nums]), db=self.pruned_journal_db)
+
+  def unjournal_pruned(self, height, wtx):
+    """
+      Should be called before reverting pruning made in block at `height`.
+    """
+    if height <= self.settled_height(rtx=wtx):
+      raise Exception("Pruning at height %d is already settled and can not be reverted"%height)
+    wtx.delete(_(height), db=self.pruned_journal_db)
+
+  def settled_height(self, rtx):
+    """
+      Height of last block pruning in which was collapsed (-1 if none).
+    """
+    height = rtx.get(b'settled_height', db=self.collapsed_db)
+    return int.from_bytes(height, 'big') if height else -1
+
+  def settle_below(self, height, wtx):
+    """
+      Mark pruning at `height` and below as settled without collapsing, so it can not be reverted.
+      Journaled leafs will be collapsed by next `settle_pruned` which passes `height`.
+    """
+    if height > self.settled_height(rtx=wtx):
+      wtx.put(b'settled_height', _(height), db=self.collapsed_db)
+
+  def settle_pruned(self, height, wtx):
+    """
+      Should be called after block at `height` is applied: collapses leafs pruned
+      in blocks at `height-prune_horizon` and earlier.
+    """
+    if self.prune_horizon==None:
+      return
+    settled_height = height-self.prune_horizon
+    if settled_height <= self.settled_height(rtx=wtx):
+      return
+    sequence_nums = []
+    cursor = wtx.cursor(db=self.pruned_journal_db)
+    cursor.first()
+    while cursor.key() and int.from_bytes(cursor.key(), 'big') <= settled_height:
+      nums = cursor.value()
+      sequence_nums += [int.from_bytes(nums[i:i+5], 'big') for i in range(0, len(nums), 5)]
+      if not cursor.delete():
+        break
+    wtx.put(b'settled_height', _(settled_height), db=self.collapsed_db)
+    self._collapse_leafs(sequence_nums, wtx=wtx)
+
+  def _collapse_leafs(self, sequence_nums, wtx):
+    """
+      Evict pruned objects of leafs and merge them with already collapsed neighbours:
+      if both children of node are collapsed, node becomes collapsed instead of them.
+    """
+    collapsed_leafs = 0
+    for num in sorted(sequence_nums):
+      if self.save_pruned:
+        pruned_index = wtx.pop(_(num), db=self.pruned_db)
+        if pruned_index:
+          wtx.delete(pruned_index, db=self.pruned_db)
+          wtx.delete(pruned_index, _(num), db=self.pruned_ro_db)
+      level, sequence_num = 0, num
+      while wtx.get(_(level)+_(sequence_num^1), db=self.collapsed_db)!=None:
+        wtx.delete(_(level)+_(sequence_num^1), db=self.collapsed_db)
+        for child in [sequence_num, sequence_num^1]:
+          if level:
+            self._del_node(level, child, wtx=wtx)
+          else:
+            obj_index = wtx.pop(_(child), db=self.order_db)
+            if obj_index:
+              wtx.delete(obj_index, _(child), db=self.reverse_order_db)
+            collapsed_leafs += 1
+        level, sequence_num = level+1, sequence_num//2
+      wtx.put(_(level)+_(sequence_num), self._get_node(level, sequence_num, rtx=wtx), db=self.collapsed_db)
+    wtx.put(b'leafs', (self._num_of_collapsed_leafs(rtx=wtx)+collapsed_leafs).to_bytes(5, 'big'), db=self.collapsed_db)
 
   def sum(self, x1, x2):
     """
@@ -278,6 +558,20 @@ class MMR:
     """
     pass
 
+  def sum_level(self, pairs):
+    """
+      Sum each (left, right) pair of decoded nodes from one tree level, returns list of decoded sums.
+      Subclasses with expensive summation may redefine it together with `_decode_node` and
+      `_encode_node` to keep nodes in parsed form between levels.
+    """
+    return [self.sum(left, right) for left, right in pairs]
+
+  def _decode_node(self, value):
+    return value
+
+  def _encode_node(self, node):
+    return node
+
 
   def get_root(self, rtx):
     try:
@@ -286,11 +580,235 @@ class MMR:
       #empty tree (TODO custom exception)
       return b"\x00"*self.default_index_size
 
+  def get_index_by_num(self, num_index_ser, rtx):
+    """
+      Leaf index at serialized sequence num: b"" for cleared leaf, None if there is no such leaf.
+    """
+    return rtx.get(num_index_ser, db=self.order_db)
+
+  def get_proof(self, obj_index, rtx):
+    """
+      Authentication path of leaf with `obj_index`, see `get_multi_proof`.
+    """
+    return self.get_multi_proof([obj_index], rtx=rtx)
+
+  def get_multi_proof(self, obj_indexes, rtx):
+    """
+      Proof for a few leafs at once, raises KeyError if any index is not in tree.
+    """
+    sequence_nums = []
+    for obj_index in obj_indexes:
+      num_index_ser = rtx.get(bytes(obj_index), db=self.reverse_order_db)
+      if not num_index_ser:
+        raise KeyError(obj_index)
+      sequence_nums.append(int.from_bytes(num_index_ser, 'big'))
+    return self.get_multi_proof_by_nums(sequence_nums, rtx=rtx)
+
+  def get_multi_proof_by_nums(self, sequence_nums, rtx):
+    """
+      Proof for leafs at `sequence_nums` (whatever they contain, cleared leaf proves that place is empty).
+      Proof is dict with keys:
+        `num_of_elements` - number of leafs in tree (it determines tree shape);
+        `sequence_nums` - proven leafs;
+        `nodes` - list of (level, sequence_num, node) siblings of nodes on paths from proven leafs to root.
+      Siblings which are on other paths or can be calculated from them are not included (thus common
+      parts of paths are shared), as well as nodes with no leafs below. For one leaf it is
+      one node per level, so proof costs O(log n) reads.
+    """
+    num_of_elements = self.num_of_elements(rtx=rtx)
+    for num in sequence_nums:
+      if num>=num_of_elements or self.get_index_by_num(_(num), rtx=rtx)==None:
+        raise KeyError("Unknown leaf %d"%num)
+    nodes = []
+    known = set(sequence_nums)
+    for level in range(self._get_max_level(rtx=rtx)):
+      for sequence_num in sorted(set([num^1 for num in known]) - known):
+        if sequence_num*2**level < num_of_elements:
+          nodes.append((level, sequence_num, self._get_node(level, sequence_num, rtx=rtx) or b""))
+      known = set([num//2 for num in known])
+    return {'num_of_elements': num_of_elements, 'sequence_nums': list(sequence_nums), 'nodes': nodes}
+
+  def verify_proof(self, root, leaf, proof):
+    return self.verify_multi_proof(root, [leaf], proof)
+
+  def verify_multi_proof(self, root, leafs, proof):
+    """
+      Check that tree with `root` contains `leafs` (indexes) at places from `proof`.
+      Does not use db, only `sum_level` of the tree.
+    """
+    num_of_elements, sequence_nums = proof['num_of_elements'], proof['sequence_nums']
+    if not num_of_elements or not len(leafs)==len(sequence_nums):
+      return False
+    known = {}
+    for num, leaf in zip(sequence_nums, leafs):
+      if num>=num_of_elements or known.get(num, bytes(leaf))!=bytes(leaf):
+        return False
+      known[num] = bytes(leaf)
+    siblings = dict([((level, sequence_num), bytes(node)) for level, sequence_num, node in proof['nodes']])
+    def get_child(level, sequence_num, known):
+      if sequence_num in known:
+        return known[sequence_num]
+      if sequence_num*2**level >= num_of_elements:
+        return None
+      return siblings[(level, sequence_num)]
+    try:
+      for level in range(math.ceil(math.log(num_of_elements,2))):
+        parents = set([num//2 for num in known])
+        known = self._calculate_parents(parents, lambda sequence_num, level=level, known=known: get_child(level, sequence_num, known))
+      return self._serialized_node(known[0])==bytes(root)
+    except Exception: # missed sibling or node which can not be decoded
+      return False
+
+  def view(self, rtx):
+    """
+      Returns read-only "what-if" view of the tree, see MMRView.
+    """
+    return MMRView(self, rtx)
+
   def set_state(self, state, wtx):
     wtx.put(b'state', state, db=self.leaf_db)
+    if not self._node_cache(wtx): # otherwise will be synced on cache flush
+      self.node_storage.sync(wtx)
 
 
   def get_state(self, rtx):
     return rtx.get(b'state', db=self.leaf_db)
 
 
+class NodeCache:
+  """
+    In-memory nodes of MMR for one write transaction: `nodes` maps (level, sequence_num) to value,
+    `dirty` is set of keys which should be written on flush, `truncations` maps level to length
+    to which it should be truncated before writing.
+  """
+  def __init__(self, wtx):
+    self.wtx = wtx
+    self.nodes = {}
+    self.dirty = set()
+    self.truncations = {}
+    self.num_of_elements = None
+
+  def set(self, key, value):
+    self.nodes[key] = value
+    self.dirty.add(key)
+
+  def truncate(self, level, length):
+    self.truncations[level] = min(length, self.truncations.get(level, length))
+    for key in [key for key in self.nodes if key[0]==level and key[1]>=length]:
+      self.nodes.pop(key)
+      self.dirty.discard(key)
+
+  def flush(self, node_storage):
+    node_storage.write(self.truncations, [(key, self.nodes[key]) for key in sorted(self.dirty)], wtx=self.wtx)
+    self.dirty = set()
+    self.truncations = {}
+
+
+class MMRView:
+  """
+    In-memory diff over MMR on disc. Appends, clears and index updates are applied only to
+    the view, the tree itself (and db) is not touched. `get_root` calculates root of the
+    resulting tree recalculating only nodes above changed leafs; other nodes are read from db.
+    Presence of indexes is tracked approximately: index which was removed in view
+    is considered absent even if there are other leafs with the same index on disc.
+  """
+  def __init__(self, tree, rtx):
+    self.tree = tree
+    self.rtx = rtx
+    self.initial_num_of_elements = tree.num_of_elements(rtx=rtx)
+    self.num_of_elements = self.initial_num_of_elements
+    self.leafs = {} # sequence_num -> index
+    self.added = {} # index -> number of leafs with this index added in view
+    self.sequence_nums = {} # index -> sequence_num of leaf added in view
+    self.removed = set()
+
+  def has_index(self, obj_index):
+    obj_index = bytes(obj_index)
+    if self.added.get(obj_index, 0):
+      return True
+    return (not obj_index in self.removed) and self.tree.has_index(self.rtx, obj_index)
+
+  def _add_index(self, obj_index, sequence_num):
+    self.added[obj_index] = self.added.get(obj_index, 0) + 1
+    self.sequence_nums[obj_index] = sequence_num
+
+  def _remove_index(self, obj_index):
+    if self.added.get(obj_index, 0):
+      self.added[obj_index] -= 1
+    else:
+      self.removed.add(obj_index)
+
+  def _sequence_num(self, obj_index):
+    if self.added.get(obj_index, 0):
+      return self.sequence_nums[obj_index]
+    num_index_ser = self.rtx.get(obj_index, db=self.tree.reverse_order_db)
+    if (not num_index_ser) or (obj_index in self.removed):
+      raise KeyError("Unknown index")
+    return int.from_bytes(num_index_ser, 'big')
+
+  def append(self, obj_index, unique=False):
+    obj_index = bytes(obj_index)
+    if unique and self.has_index(obj_index):
+      raise KeyError("Not unique")
+    num = self.num_of_elements
+    self.leafs[num] = obj_index
+    self._add_index(obj_index, num)
+    self.num_of_elements += 1
+    return _(num)
+
+  def clear(self, obj_index):
+    if self.tree.discard_only:
+      raise
+    obj_index = bytes(obj_index)
+    num = self._sequence_num(obj_index)
+    self.leafs[num] = b""
+    self._remove_index(obj_index)
+
+  def discard(self, obj_index):
+    # Discarding does not change indexes, we only check that leaf exists
+    if self.tree.clear_only:
+      raise
+    self._sequence_num(bytes(obj_index))
+
+  def update_index_by_num(self, num_index_ser, obj_index, unique=False):
+    obj_index = bytes(obj_index)
+    if unique and self.has_index(obj_index):
+      raise KeyError("Not unique")
+    num = int.from_bytes(num_index_ser, 'big')
+    old_index = self._get_node(0, num, {})
+    self.leafs[num] = obj_index
+    self._remove_index(old_index)
+    self._add_index(obj_index, num)
+    return old_index
+
+  def _get_node(self, level, sequence_num, nodes):
+    if level==0 and sequence_num in self.leafs:
+      return self.leafs[sequence_num]
+    if sequence_num in nodes:
+      return nodes[sequence_num]
+    if sequence_num*2**level >= self.initial_num_of_elements:
+      # there are no leafs below on disc
+      return None
+    return self.tree._get_node(level, sequence_num, rtx=self.rtx)
+
+  def get_root(self):
+    if not self.num_of_elements:
+      return b"\x00"*self.tree.default_index_size
+    mxlvl = math.ceil(math.log(self.num_of_elements,2))
+    nodes = {} # recalculated nodes of current level
+    dirty = set(self.leafs)
+    for level in range(mxlvl):
+      dirty = set([sequence_num//2 for sequence_num in dirty])
+      nodes = self.tree._calculate_parents(dirty, lambda sequence_num, level=level, nodes=nodes: self._get_node(level, sequence_num, nodes))
+    return self.tree._serialized_node(self._get_node(mxlvl, 0, nodes))
+
+
+@contextmanager
+def cached_nodes(wtx, *trees):
+  """
+    Enter `cached_nodes` context for a few trees at once.
+  """
+  with ExitStack() as stack:
+    for tree in trees:
+      stack.enter_context(tree.cached_nodes(wtx))
+    yield
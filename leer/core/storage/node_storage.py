@@ -0,0 +1,320 @@
+import os, mmap, json
+
+
+def _(x):
+  return (x).to_bytes(5,'big')
+
+GENERATION_KEY = b'node_storage_generation'
+
+class LMDBNodeStorage:
+  '''
+    Tree nodes (level>0) in lmdb node_db: (level-1, sequence_num) -> node.
+    Nodes are updated in the same transaction as leafs, thus storage is always consistent.
+  '''
+  name = b'lmdb'
+
+  def __init__(self, name, env, wtx):
+    self.node_db = env.open_db(name+b'node_db', txn=wtx)
+    self.consistent = True
+
+  def get(self, level, sequence_num, rtx):
+    return rtx.get(_(level-1)+_(sequence_num), db=self.node_db)
+
+  def put(self, level, sequence_num, value, wtx):
+    wtx.put(_(level-1)+_(sequence_num), value, db=self.node_db)
+
+  def delete(self, level, sequence_num, wtx):
+    wtx.delete(_(level-1)+_(sequence_num), db=self.node_db)
+
+  def truncate(self, level, length, wtx):
+    '''
+      Delete all nodes on `level` with sequence_num >= `length`.
+    '''
+    prefix = _(level-1)
+    cursor = wtx.cursor(db=self.node_db)
+    if not cursor.set_range(prefix+_(length)):
+      return
+    while cursor.key()[:5]==prefix:
+      if not cursor.delete():
+        break
+
+  def write(self, truncations, nodes, wtx):
+    '''
+      Apply `truncations` (dict level -> length) and then write `nodes` (list of ((level, sequence_num), value)).
+    '''
+    for level in sorted(truncations):
+      self.truncate(level, truncations[level], wtx=wtx)
+    for (level, sequence_num), value in nodes:
+      if value==None:
+        self.delete(level, sequence_num, wtx=wtx)
+      else:
+        self.put(level, sequence_num, value, wtx=wtx)
+
+  def clear(self, wtx):
+    wtx.drop(self.node_db, delete=False)
+
+  def sync(self, wtx):
+    pass
+
+
+class PendingWrite:
+  '''
+    Changes of flat files made by write transaction `wtx` which is not known to be committed yet.
+    `lengths` are lengths of levels before transaction, `records` are original records
+    overwritten by transaction (only those which were inside original lengths).
+    If `full_rewrite` is set, files were cleared and original records are not saved.
+  '''
+  def __init__(self, wtx, generation, lengths):
+    self.wtx = wtx
+    self.generation = generation
+    self.lengths = dict(lengths)
+    self.records = {}
+    self.synced = False
+    self.full_rewrite = False
+
+
+class FlatFileNodeStorage:
+  '''
+    Tree nodes (level>0) in flat files, one file per level accessed through mmap.
+    Each record is 1 flag byte (0 - no node, 1 - empty node, 2 - node) and `node_size` bytes of node.
+    Files grow by doubling, `truncate` shrinks them when they become sparse.
+
+    Files are not a part of lmdb transaction, so consistency is tracked by generation:
+     - first write in each write transaction increments generation number stored in `leaf_db`
+       (in the same transaction) and marks meta file as dirty;
+     - `sync` (called on MMR.set_state) flushes files and marks meta file as clean with current generation;
+     - original records overwritten by not yet committed transaction are kept in memory. When the next
+       write transaction starts, generation in db shows whether previous one was committed, if not
+       original records are restored. Read transactions which do not see new generation get original records.
+    On start files are trusted only if meta file is clean and has the same generation as db,
+    otherwise `consistent` is False and nodes should be rebuilt from leafs (see MMR._rebuild_nodes).
+
+    Only one instance per directory exists (state is shared as in other storages).
+  '''
+  name = b'flat_file'
+  __shared_states = {}
+  min_records = 256
+
+  def __init__(self, path, node_size, leaf_db, rtx):
+    path = os.path.abspath(path)
+    if not path in self.__shared_states:
+      self.__shared_states[path]={}
+    self.__dict__ = self.__shared_states[path]
+    if 'maps' in self.__dict__:
+      return
+    self.path = path
+    self.node_size = node_size
+    self.record_size = node_size+1
+    self.leaf_db = leaf_db
+    self.files, self.maps = {}, {}
+    self.lengths = {} # level -> number of records
+    self.pending = None
+    self.rebuild = None # hook which recalculates all nodes in write transaction, set by tree
+    self._seen = (None, None)
+    if not os.path.exists(path):
+      os.makedirs(path)
+    meta = self._read_meta()
+    self.consistent = bool(meta) and meta['clean'] and meta['generation']==self._generation(rtx)
+    if self.consistent:
+      self.lengths = {int(level):length for level, length in meta['lengths'].items()}
+
+  def _generation(self, rtx):
+    generation = rtx.get(GENERATION_KEY, db=self.leaf_db)
+    return int.from_bytes(generation, 'big') if generation else 0
+
+  def _read_meta(self):
+    try:
+      with open(os.path.join(self.path, 'meta'), 'r') as f:
+        return json.load(f)
+    except (IOError, ValueError):
+      return None
+
+  def _write_meta(self, generation, clean):
+    meta = {'generation':generation, 'clean':clean, 'lengths':self.lengths}
+    tmp_path = os.path.join(self.path, 'meta.tmp')
+    with open(tmp_path, 'w') as f:
+      json.dump(meta, f)
+      f.flush()
+      os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(self.path, 'meta'))
+
+  def _capacity(self, level):
+    return len(self.maps[level]) // self.record_size if level in self.maps else 0
+
+  def _resize(self, level, capacity):
+    if level in self.maps:
+      self.maps.pop(level).close()
+    if not level in self.files:
+      file_path = os.path.join(self.path, 'level_%d'%level)
+      # content of file for level without records is obsolete
+      self.files[level] = open(file_path, 'r+b' if self.lengths.get(level, 0) else 'w+b')
+    self.files[level].truncate(capacity*self.record_size)
+    if capacity:
+      self.maps[level] = mmap.mmap(self.files[level].fileno(), capacity*self.record_size)
+
+  def _map(self, level):
+    if not level in self.maps and self.lengths.get(level, 0):
+      if not level in self.files:
+        self.files[level] = open(os.path.join(self.path, 'level_%d'%level), 'r+b')
+      self.maps[level] = mmap.mmap(self.files[level].fileno(), 0)
+    return self.maps.get(level, None)
+
+  def _read_record(self, level, sequence_num):
+    if sequence_num >= self.lengths.get(level, 0):
+      return bytes(self.record_size)
+    offset = sequence_num*self.record_size
+    return self._map(level)[offset:offset+self.record_size]
+
+  def _write_record(self, level, sequence_num, record):
+    self._map(level)
+    if sequence_num >= self._capacity(level):
+      self._resize(level, max(2*self._capacity(level), sequence_num+1, self.min_records))
+    offset = sequence_num*self.record_size
+    self.maps[level][offset:offset+self.record_size] = record
+
+  def _decode_record(self, record):
+    flag = record[0]
+    if flag==0:
+      return None
+    if flag==1:
+      return b""
+    return bytes(record[1:])
+
+  def _encode_record(self, value):
+    if value==None:
+      return bytes(self.record_size)
+    if not len(value):
+      return b"\x01"+bytes(self.node_size)
+    if not len(value)==self.node_size:
+      raise Exception("Wrong node size: %d instead of %d"%(len(value), self.node_size))
+    return b"\x02"+bytes(value)
+
+  def _sees_pending(self, rtx):
+    if not self._seen[0] is rtx:
+      self._seen = (rtx, self._generation(rtx)==self.pending.generation)
+    return self._seen[1]
+
+  def get(self, level, sequence_num, rtx):
+    if self.pending and (not rtx is self.pending.wtx) and (not self._sees_pending(rtx)):
+      # rtx does not see pending transaction: return original record
+      if self.pending.full_rewrite:
+        raise Exception("Nodes are being rebuilt in another transaction")
+      if (level, sequence_num) in self.pending.records:
+        return self._decode_record(self.pending.records[(level, sequence_num)])
+      if sequence_num >= self.pending.lengths.get(level, 0):
+        return None
+    return self._decode_record(self._read_record(level, sequence_num))
+
+  def _resolve_pending(self, wtx):
+    '''
+      Called in new write transaction: previous one is already either committed or aborted.
+    '''
+    pending, self.pending = self.pending, None
+    self._seen = (None, None)
+    if self._generation(wtx)==pending.generation:
+      return
+    # previous transaction was aborted
+    if pending.full_rewrite:
+      self.consistent = False
+      self.rebuild(wtx)
+      return
+    for level in list(self.lengths):
+      length = pending.lengths.get(level, 0)
+      if self.lengths[level] > length:
+        self._map(level)[length*self.record_size:self.lengths[level]*self.record_size] = bytes((self.lengths[level]-length)*self.record_size)
+    for (level, sequence_num), record in pending.records.items():
+      self._write_record(level, sequence_num, record)
+    self.lengths = dict(pending.lengths)
+    self._flush()
+    self._write_meta(self._generation(wtx), clean=True)
+
+  def _begin_write(self, wtx):
+    if self.pending and self.pending.wtx is wtx:
+      if self.pending.synced:
+        self._write_meta(self.pending.generation, clean=False)
+        self.pending.synced = False
+      return
+    if self.pending:
+      self._resolve_pending(wtx)
+      if self.pending and self.pending.wtx is wtx: # pending is rebuild in this transaction
+        return
+    generation = self._generation(wtx)+1
+    wtx.put(GENERATION_KEY, generation.to_bytes(8, 'big'), db=self.leaf_db)
+    self.pending = PendingWrite(wtx, generation, self.lengths)
+    self._seen = (None, None)
+    self._write_meta(generation, clean=False)
+
+  def _save_original(self, level, sequence_num):
+    key = (level, sequence_num)
+    if self.pending.full_rewrite or key in self.pending.records:
+      return
+    if sequence_num < self.pending.lengths.get(level, 0):
+      self.pending.records[key] = self._read_record(level, sequence_num)
+
+  def put(self, level, sequence_num, value, wtx):
+    self._begin_write(wtx)
+    self._save_original(level, sequence_num)
+    self._write_record(level, sequence_num, self._encode_record(value))
+    self.lengths[level] = max(self.lengths.get(level, 0), sequence_num+1)
+
+  def delete(self, level, sequence_num, wtx):
+    '''
+      Mark node as absent, space is not reclaimed (except for nodes at the end, see `truncate`).
+    '''
+    if sequence_num < self.lengths.get(level, 0):
+      self.put(level, sequence_num, None, wtx=wtx)
+
+  def truncate(self, level, length, wtx):
+    '''
+      Delete all nodes on `level` with sequence_num >= `length`.
+    '''
+    current_length = self.lengths.get(level, 0)
+    if length >= current_length:
+      return
+    self._begin_write(wtx)
+    for sequence_num in range(length, min(current_length, self.pending.lengths.get(level, 0))):
+      self._save_original(level, sequence_num)
+    self._map(level)[length*self.record_size:current_length*self.record_size] = bytes((current_length-length)*self.record_size)
+    self.lengths[level] = length
+    if self._capacity(level) > 4*max(length, self.min_records):
+      self._resize(level, 2*max(length, self.min_records))
+
+  def write(self, truncations, nodes, wtx):
+    '''
+      Apply `truncations` (dict level -> length) and then write `nodes` (list of ((level, sequence_num), value)).
+    '''
+    for level in sorted(truncations):
+      self.truncate(level, truncations[level], wtx=wtx)
+    for (level, sequence_num), value in nodes:
+      self.put(level, sequence_num, value, wtx=wtx)
+
+  def clear(self, wtx):
+    self._begin_write(wtx)
+    self.pending.full_rewrite = True
+    self.pending.records = {}
+    for level in list(self.lengths):
+      self._resize(level, 0)
+    self.lengths = {}
+
+  def _flush(self):
+    for level in self.maps:
+      self.maps[level].flush()
+
+  def sync(self, wtx):
+    '''
+      Make files durable and mark them as consistent with generation written by `wtx`.
+    '''
+    if not self.pending or not self.pending.wtx is wtx or self.pending.synced:
+      return
+    self._flush()
+    self._write_meta(self.pending.generation, clean=True)
+    self.pending.synced = True
+    self.consistent = True
+
+  def close(self):
+    for level in self.maps:
+      self.maps[level].close()
+    for level in self.files:
+      self.files[level].close()
+    self.maps, self.files = {}, {}
+    self.__shared_states.pop(self.path)
@@ -0,0 +1,56 @@
+'''
+  Batched summation of curve points for CommitmentMMR and ExcessMMR.
+
+  High-level secp256k1_zkp objects create new secp256k1 context on each instantiation
+  which is much more expensive than point addition itself. Here all operations use one
+  module-wide context and points are kept in parsed `secp256k1_point` form: trees parse
+  node once, sum it as many times as needed and serialize only for writing to db.
+'''
+from secp256k1_zkp import NO_FLAGS, EC_COMPRESSED
+from secp256k1_zkp._libsecp256k1 import ffi, lib
+
+_ctx = lib.secp256k1_context_create(NO_FLAGS) # parsing and serialization do not need precomputed tables
+
+
+def parse_commitment(serialized_commitment):
+  commitment = ffi.new('secp256k1_pedersen_commitment *')
+  if not lib.secp256k1_pedersen_commitment_parse(_ctx, commitment, serialized_commitment):
+    raise Exception("invalid pedersen commitment")
+  point = ffi.new('secp256k1_point *')
+  lib.secp256k1_points_cast_pedersen_commitment_to_point(commitment, point)
+  return point
+
+def serialize_commitment(point):
+  commitment = ffi.new('secp256k1_pedersen_commitment *')
+  lib.secp256k1_points_cast_point_to_pedersen_commitment(point, commitment)
+  buff = ffi.new('unsigned char [33]')
+  assert lib.secp256k1_pedersen_commitment_serialize(_ctx, buff, commitment)
+  return bytes(ffi.buffer(buff, 33))
+
+def parse_pubkey(serialized_pubkey):
+  pubkey = ffi.new('secp256k1_pubkey *')
+  if not lib.secp256k1_ec_pubkey_parse(_ctx, pubkey, serialized_pubkey, len(serialized_pubkey)):
+    raise Exception("invalid public key")
+  point = ffi.new('secp256k1_point *')
+  lib.secp256k1_points_cast_pubkey_to_point(_ctx, pubkey, point)
+  return point
+
+def serialize_pubkey(point):
+  pubkey = ffi.new('secp256k1_pubkey *')
+  lib.secp256k1_points_cast_point_to_pubkey(point, pubkey)
+  buff = ffi.new('unsigned char [33]')
+  outlen = ffi.new('size_t *', 33)
+  assert lib.secp256k1_ec_pubkey_serialize(_ctx, buff, outlen, pubkey, EC_COMPRESSED)
+  return bytes(ffi.buffer(buff, 33))
+
+def sum_points(pairs):
+  '''
+    Sum each pair of parsed points from `pairs`, returns list of parsed sums.
+  '''
+  result = []
+  for point1, point2 in pairs:
+    point = ffi.new('secp256k1_point *')
+    if not lib.secp256k1_points_combine(point, [point1, point2], 2):
+      raise Exception("failed to combine points")
+    result.append(point)
+  return result
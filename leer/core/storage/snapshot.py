@@ -0,0 +1,225 @@
+'''
+  Snapshot of blockchain state for fast bootstrap.
+
+  Snapshot is a consistent copy (made in one read transaction) of databases which describe state
+  at some tip: leafs of commitments, txos and excesses trees (tree nodes are not copied, they are
+  rebuilt on import), utxo index, burdens, headers and the tip block itself.
+
+  File format: `MAGIC` and 2 bytes of version followed by chunks. Each chunk is
+  1 byte of type, 4 bytes of payload length, payload and sha256(payload). Chunks:
+    META    - json with tip hash, height and merkle roots, always first;
+    RECORDS - 1 byte of db name length, db name and records of this db:
+              2 bytes of key length, 4 bytes of value length, key and value.
+              Records are in db order (so they can be appended to db without search),
+              records of one db may be split over a few chunks;
+    BLOCK   - serialized (with context) tip block;
+    END     - sha256 of concatenation of checksums of all previous chunks, always last.
+
+  Import replaces state of node: copied databases are dropped and bulk-loaded, tree nodes
+  are rebuilt and roots are checked against merkles of the tip header. Blocks up to the
+  snapshot tip can not be rolled back since there are no rollback objects for them.
+'''
+import hashlib, json, os
+from leer.core.storage.node_storage import GENERATION_KEY
+
+MAGIC = b"LEERSNAP"
+VERSION = 1
+CHUNK_SIZE = 1<<20
+META, RECORDS, BLOCK, END = 0, 1, 2, 3
+
+LOCAL_KEYS = [b'node_storage', GENERATION_KEY] # leaf_db keys which describe node storage of this node
+
+def _trees(storage_space):
+  confirmed = storage_space.txos_storage.confirmed
+  return [confirmed.commitments, confirmed.txos, storage_space.excesses_storage.excesses]
+
+def _state_dbs(storage_space):
+  '''
+    List of (name, db) which are copied to snapshot.
+  '''
+  dbs = []
+  for tree in _trees(storage_space):
+    dbs += [(tree.name+b'leaf_db', tree.leaf_db), (tree.name+b'order_db', tree.order_db),
+            (tree.name+b'reverse_order_db', tree.reverse_order_db)]
+    if tree.save_pruned:
+      dbs += [(tree.name+b'pruned_db', tree.pruned_db), (tree.name+b'pruned_ro_db', tree.pruned_ro_db)]
+    dbs += [(tree.name+b'collapsed_db', tree.collapsed_db), (tree.name+b'pruned_journal_db', tree.pruned_journal_db)]
+  dbs.append((b'burden_main_db', storage_space.txos_storage.confirmed.burden.main_db))
+  if getattr(storage_space, 'utxo_index', None):
+    dbs.append((b'utxoi_main_db', storage_space.utxo_index.main_db))
+  headers = storage_space.headers_storage.storage
+  dbs += [(b'headers_main_db', headers.main_db), (b'headers_height_db', headers.height_db),
+          (b'headers_main_chain_db', headers.main_chain_db), (b'headers_skip_db', headers.skip_db),
+          (b'headers_tips_db', headers.tips_db)]
+  return dbs
+
+
+class SnapshotWriter:
+  def __init__(self, f):
+    self.f = f
+    self.digest = hashlib.sha256()
+    self.f.write(MAGIC+VERSION.to_bytes(2, 'big'))
+
+  def write_chunk(self, chunk_type, payload):
+    checksum = hashlib.sha256(payload).digest()
+    self.f.write(bytes([chunk_type]) + len(payload).to_bytes(4, 'big') + payload + checksum)
+    self.digest.update(checksum)
+
+  def write_records(self, name, records):
+    '''
+      Write `records` (iterable of (key, value) in db order) as RECORDS chunks.
+    '''
+    prefix = bytes([len(name)])+name
+    chunk, size = [prefix], len(prefix)
+    for key, value in records:
+      chunk.append(len(key).to_bytes(2, 'big') + len(value).to_bytes(4, 'big') + key + value)
+      size += len(chunk[-1])
+      if size >= CHUNK_SIZE:
+        self.write_chunk(RECORDS, b"".join(chunk))
+        chunk, size = [prefix], len(prefix)
+    if len(chunk)>1:
+      self.write_chunk(RECORDS, b"".join(chunk))
+
+  def close(self):
+    self.write_chunk(END, self.digest.digest())
+
+
+def read_chunks(f):
+  '''
+    Generator of (chunk_type, payload) with checked checksums.
+  '''
+  header = f.read(len(MAGIC)+2)
+  if not header[:len(MAGIC)]==MAGIC:
+    raise Exception("Not a snapshot file")
+  if not int.from_bytes(header[len(MAGIC):], 'big')==VERSION:
+    raise Exception("Unknown snapshot version %d"%int.from_bytes(header[len(MAGIC):], 'big'))
+  digest = hashlib.sha256()
+  while True:
+    chunk_header = f.read(5)
+    if not len(chunk_header)==5:
+      raise Exception("Snapshot file is truncated")
+    chunk_type, length = chunk_header[0], int.from_bytes(chunk_header[1:], 'big')
+    payload, checksum = f.read(length), f.read(32)
+    if not len(payload)==length or not hashlib.sha256(payload).digest()==checksum:
+      raise Exception("Snapshot chunk checksum mismatch")
+    if chunk_type==END:
+      if not payload==digest.digest():
+        raise Exception("Snapshot chunks are reordered or missed")
+      return
+    digest.update(checksum)
+    yield chunk_type, payload
+
+def parse_records(payload):
+  '''
+    Returns db name and list of (key, value) from RECORDS chunk payload.
+  '''
+  name_len = payload[0]
+  name, pos = payload[1:1+name_len], 1+name_len
+  records = []
+  while pos < len(payload):
+    key_len, value_len = int.from_bytes(payload[pos:pos+2], 'big'), int.from_bytes(payload[pos+2:pos+6], 'big')
+    pos += 6
+    records.append((payload[pos:pos+key_len], payload[pos+key_len:pos+key_len+value_len]))
+    pos += key_len+value_len
+  if not pos==len(payload):
+    raise Exception("Malformed snapshot records")
+  return name, records
+
+
+def load_records(db, records, wtx, last_record=None):
+  '''
+    Append `records` to the end of `db`. Records should be sorted and go after `last_record`
+    (last record of previous chunk of the same db). Returns last loaded record.
+  '''
+  dupsort = db.flags(wtx)['dupsort']
+  for record in records:
+    if last_record and not (record>last_record if dupsort else record[0]>last_record[0]):
+      raise Exception("Records in snapshot are not sorted")
+    last_record = record
+  consumed, added = wtx.cursor(db=db).putmulti(records, dupdata=dupsort, append=True)
+  if not added==len(records):
+    raise Exception("Can not load records from snapshot")
+  return last_record
+
+
+def export_snapshot(storage_space, path, rtx):
+  '''
+    Write snapshot of state at current tip visible in `rtx` to `path`.
+  '''
+  tip = storage_space.blockchain.current_tip(rtx=rtx)
+  header = storage_space.headers_storage.get(tip, rtx=rtx)
+  meta = {'tip': tip.hex(), 'height': header.height, 'merkles': [merkle.hex() for merkle in header.merkles]}
+  leaf_dbs = [tree.name+b'leaf_db' for tree in _trees(storage_space)]
+  tmp_path = path+'.tmp'
+  with open(tmp_path, 'wb') as f:
+    writer = SnapshotWriter(f)
+    writer.write_chunk(META, json.dumps(meta).encode())
+    for name, db in _state_dbs(storage_space):
+      records = rtx.cursor(db=db).iternext(keys=True, values=True)
+      if name in leaf_dbs:
+        records = ((key, value) for key, value in records if not key in LOCAL_KEYS)
+      writer.write_records(name, records)
+    writer.write_chunk(BLOCK, storage_space.blocks_storage.storage.get_by_hash(tip, rtx=rtx))
+    writer.close()
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(tmp_path, path)
+  return meta
+
+def import_snapshot(storage_space, path, wtx, expected_tip):
+  '''
+    Replace state by snapshot from `path`. Snapshot should be made at trusted block `expected_tip`:
+    headers and state are taken from file, so they are only checked against hash of this block.
+    Any inconsistency raises exception, in this case `wtx` should be aborted.
+  '''
+  if not expected_tip:
+    raise Exception("Snapshot tip is not set: snapshot can not be trusted")
+  dbs = dict(_state_dbs(storage_space))
+  trees = _trees(storage_space)
+  with open(path, 'rb') as f:
+    chunks = read_chunks(f)
+    chunk_type, payload = next(chunks)
+    if not chunk_type==META:
+      raise Exception("Snapshot does not start with meta")
+    meta = json.loads(payload.decode())
+    tip = bytes.fromhex(meta['tip'])
+    if not tip==expected_tip:
+      raise Exception("Snapshot is made at block %s instead of expected %s"%(tip.hex(), expected_tip.hex()))
+    local_keys = [[(key, wtx.get(key, db=tree.leaf_db)) for key in LOCAL_KEYS] for tree in trees]
+    storage_space.headers_storage.invalidate_cache(wtx=wtx)
+    storage_space.blocks_storage.invalidate_cache(wtx=wtx)
+    for db in dbs.values():
+      wtx.drop(db, delete=False)
+    last_records = {}
+    block = None
+    for chunk_type, payload in chunks:
+      if chunk_type==RECORDS:
+        name, records = parse_records(payload)
+        if not name in dbs:
+          raise Exception("Unknown db %s in snapshot"%name)
+        last_records[name] = load_records(dbs[name], records, wtx=wtx, last_record=last_records.get(name, None))
+      elif chunk_type==BLOCK:
+        block = payload
+      else:
+        raise Exception("Unexpected snapshot chunk %d"%chunk_type)
+  if not block:
+    raise Exception("Snapshot does not contain tip block")
+  storage_space.blocks_storage.storage.put(tip, block, wtx=wtx)
+  for tree, keys in zip(trees, local_keys):
+    for key, value in keys:
+      if value!=None:
+        wtx.put(key, value, db=tree.leaf_db)
+    tree._rebuild_nodes(wtx)
+  for tree in trees[:2]: # there are no rollback objects for blocks below snapshot tip
+    tree.settle_below(meta['height'], wtx=wtx)
+  if not storage_space.blockchain.current_tip(rtx=wtx)==tip:
+    raise Exception("Snapshot state is not at snapshot tip")
+  header = storage_space.headers_storage.get(tip, rtx=wtx)
+  if not header.hash==tip:
+    raise Exception("Snapshot tip header does not coinside with expected tip")
+  if not header.height==meta['height'] or not [merkle.hex() for merkle in header.merkles]==meta['merkles']:
+    raise Exception("Snapshot meta does not coinside with tip header")
+  roots = [trees[0].get_root(rtx=wtx), trees[1].get_root(rtx=wtx), trees[2].get_root(rtx=wtx)]
+  if not roots==header.merkles:
+    raise Exception("Merkle roots of snapshot state do not coinside with tip header merkles")
+  return meta
@@ -8,8 +8,11 @@ class StorageSpace:
     In the future it will be literally a combination of all storages in one physical storage,
     thus truly atomic updates will be possible
   '''
-  def __init__(self, path):
+  def __init__(self, path, mmr_node_storage={}, prune_horizon=None, rollback_depth=None):
     self.path = path
+    self.mmr_node_storage = mmr_node_storage # tree name ("commitments", "txos", "excesses") -> "lmdb" or "flat_file"
+    self.prune_horizon = prune_horizon # number of blocks after which spent outputs are collapsed in txos and commitments trees
+    self.rollback_depth = rollback_depth # number of last blocks which can be rolled back, rollback objects of older blocks are deleted
     if not os.path.exists(path): 
         os.makedirs(self.path) #TODO catch
     _25GB = int(25 * 1e9)
@@ -33,6 +36,9 @@ class StorageSpace:
   def register_blockchain(self, blockchain):
     self.blockchain = blockchain
 
+  def register_chain_state(self, chain_state):
+    self.chain_state = chain_state
+
   def register_mempool_tx(self, mempool_tx):
     self.mempool_tx = mempool_tx
 
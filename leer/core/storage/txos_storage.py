@@ -1,5 +1,6 @@
 from leer.core.storage.merkle_storage import MMR
 from leer.core.storage.key_value_storage import KeyValueStorage
+from leer.core.storage.points_summation import parse_commitment, serialize_commitment, sum_points
 from secp256k1_zkp import PedersenCommitment, PublicKey
 from leer.core.lubbadubdub.ioput import IOput
 from leer.core.utils import sha256
@@ -10,17 +11,19 @@ import os
 
 class CommitmentMMR(MMR):
       def sum(self, x1,x2):
+        return self._encode_node(self.sum_level([(self._decode_node(x1), self._decode_node(x2))])[0])
+
+      def sum_level(self, pairs):
+        # commitments are summed as points on curve in parsed form, hashes are concantenated and hashed
+        points = sum_points([(comm1, comm2) for (comm1, hash1), (comm2, hash2) in pairs])
+        return [(point, sha256(hash1+hash2)) for point, ((comm1, hash1), (comm2, hash2)) in zip(points, pairs)]
+
+      def _decode_node(self, value):
         # each index is 33 bytes for commitments and 32 for hash
-        comm1, hash1 = x1[:33], x1[33:65]
-        comm2, hash2 = x2[:33], x2[33:65]
-        comm1, comm2 = PedersenCommitment(commitment=comm1, raw=True), PedersenCommitment(commitment=comm2, raw=True)
-        #XXX we definetely need sum of pedersen commitments on libsecp256 level.
-        pk= PublicKey()
-        pk.combine([comm1.to_public_key().public_key, comm2.to_public_key().public_key])
-        sm = pk.to_pedersen_commitment()
-        first_part = sm.serialize()
-        second_part = sha256(hash1+hash2)
-        return first_part+second_part
+        return parse_commitment(value[:33]), value[33:65]
+
+      def _encode_node(self, node):
+        return serialize_commitment(node[0])+node[1]
 
 class TXOMMR(MMR):
       def sum(self, x1,x2):
@@ -41,9 +44,11 @@ class ConfirmedTXOStorage:
 
     '''
 
-    def __init__(self, path, env, wtx):
-      self.commitments = CommitmentMMR("commitments", path, clear_only=False, env=env, wtx=wtx)
-      self.txos = TXOMMR("txos", path, discard_only=True, env=env, wtx=wtx)
+    def __init__(self, path, env, wtx, mmr_node_storage={}, prune_horizon=None):
+      self.commitments = CommitmentMMR("commitments", path, clear_only=False, env=env, wtx=wtx,
+                                       node_storage=mmr_node_storage.get("commitments", "lmdb"), prune_horizon=prune_horizon)
+      self.txos = TXOMMR("txos", path, discard_only=True, env=env, wtx=wtx,
+                         node_storage=mmr_node_storage.get("txos", "lmdb"), node_size=32, prune_horizon=prune_horizon)
       self.burden = KeyValueStorage(name="burden", env=env, wtx=wtx)
 
     def get(self, hash_and_pc, rtx):
@@ -64,16 +69,27 @@ class ConfirmedTXOStorage:
     #  self.commitments.append(utxo.commitment_index,b"")
 
     def append(self, utxo, wtx):
-      assert utxo.verify() #Should be fast since cached
-      assert utxo.address_excess_num_index
-      self.txos.append(wtx=wtx, obj_index=sha256(utxo.serialized_index), obj=utxo.serialize_with_context())
-      self.commitments.append_unique(wtx=wtx, obj_index=utxo.commitment_index, obj=b"")
+      self.append_many([utxo], wtx=wtx)
+
+    def append_many(self, utxos, wtx):
+      for utxo in utxos:
+        assert utxo.verify() #Should be fast since cached
+        assert utxo.address_excess_num_index
+      self.txos.append_many(wtx=wtx, objects=[(sha256(utxo.serialized_index), utxo.serialize_with_context()) for utxo in utxos])
+      self.commitments.append_many(wtx=wtx, objects=[(utxo.commitment_index, b"") for utxo in utxos], unique=True)
 
     def spend(self, utxo, wtx, return_revert_obj=False):
-      txos = self.txos.discard(sha256(utxo.serialized_index), wtx=wtx)
-      commitment = self.commitments.clear(utxo.commitment_index, wtx=wtx)
+      revert_obj = self.spend_many([utxo], wtx=wtx)[0]
       if return_revert_obj:
-        return (txos, commitment)
+        return revert_obj
+
+    def spend_many(self, utxos, wtx):
+      '''
+        Spend list of utxos, returns list of revert objects (one per utxo).
+      '''
+      txos = self.txos.discard_many([sha256(utxo.serialized_index) for utxo in utxos], wtx=wtx)
+      commitments = self.commitments.clear_many([utxo.commitment_index for utxo in utxos], wtx=wtx)
+      return list(zip(txos, commitments))
 
     def find(self, hash_and_pc, rtx):
       '''
@@ -89,9 +105,37 @@ class ConfirmedTXOStorage:
       return utxo
 
     def unspend(self, revert_obj, wtx):
-      (txos, commitment) = revert_obj
-      self.txos.revert_discarding(txos, wtx=wtx)
-      self.commitments.revert_clearing(commitment, wtx=wtx)
+      self.unspend_many([revert_obj], wtx=wtx)
+
+    def unspend_many(self, revert_objs, wtx):
+      self.txos.revert_discarding_many([txos for (txos, commitment) in revert_objs], wtx=wtx)
+      self.commitments.revert_clearing_many([commitment for (txos, commitment) in revert_objs], wtx=wtx)
+
+    def saves_pruned(self):
+      return self.txos.save_pruned and self.commitments.save_pruned
+
+    def get_revert_objs(self, sequence_nums, rtx):
+      '''
+        Rebuild revert objects of spent utxos from (txo num, commitment num) pairs.
+        Possible only till pruning is settled.
+      '''
+      return [(self.txos.get_pruned_by_num(txo_num, rtx=rtx), self.commitments.get_pruned_by_num(commitment_num, rtx=rtx))
+              for txo_num, commitment_num in sequence_nums]
+
+    def journal_pruned(self, height, revert_objs, wtx):
+      self.txos.journal_pruned(height, [txo[0] for (txo, commitment) in revert_objs], wtx=wtx)
+      self.commitments.journal_pruned(height, [commitment[0] for (txo, commitment) in revert_objs], wtx=wtx)
+
+    def unjournal_pruned(self, height, wtx):
+      self.txos.unjournal_pruned(height, wtx=wtx)
+      self.commitments.unjournal_pruned(height, wtx=wtx)
+
+    def settle_pruned(self, height, wtx):
+      self.txos.settle_pruned(height, wtx=wtx)
+      self.commitments.settle_pruned(height, wtx=wtx)
+
+    def settled_height(self, rtx):
+      return max(self.txos.settled_height(rtx=rtx), self.commitments.settled_height(rtx=rtx))
 
     def has(self, serialized_index, rtx):
       return bool(self.txos.get_by_hash(sha256(serialized_index), rtx=rtx))
@@ -112,6 +156,24 @@ class ConfirmedTXOStorage:
     def get_txo_root(self, rtx):
       return self.txos.get_root(rtx=rtx)
 
+    def get_proof(self, hash_and_pcs, rtx):
+      '''
+        Merkle proofs for outputs with `hash_and_pcs` indexes (spent outputs are included).
+        Txos proof shows that outputs are in blockchain. Commitments proof is for the same
+        places in commitments tree: leaf is commitment index for unspent output and b"" for spent one.
+      '''
+      txos_proof = self.txos.get_multi_proof([sha256(hash_and_pc) for hash_and_pc in hash_and_pcs], rtx=rtx)
+      nums = txos_proof['sequence_nums']
+      return {'txos': txos_proof,
+              'commitments': self.commitments.get_multi_proof_by_nums(nums, rtx=rtx),
+              'commitment_leafs': [self.commitments.get_index_by_num(num.to_bytes(5,'big'), rtx=rtx) for num in nums]}
+
+    def verify_proof(self, commitment_root, txo_root, hash_and_pcs, proof):
+      if not proof['txos']['sequence_nums']==proof['commitments']['sequence_nums']:
+        return False
+      return self.txos.verify_multi_proof(txo_root, [sha256(hash_and_pc) for hash_and_pc in hash_and_pcs], proof['txos']) and \
+             self.commitments.verify_multi_proof(commitment_root, proof['commitment_leafs'], proof['commitments'])
+
     def get_state(self, rtx):
       return self.commitments.get_state(rtx=rtx)
 
@@ -165,7 +227,8 @@ class TXOsStorage:
         self.__shared_states[path]={}
     self.__dict__ = self.__shared_states[path]
     self.path = path
-    self.confirmed = ConfirmedTXOStorage(self.path, env=storage_space.env, wtx=wtx)
+    self.confirmed = ConfirmedTXOStorage(self.path, env=storage_space.env, wtx=wtx, mmr_node_storage=storage_space.mmr_node_storage,
+                                         prune_horizon=storage_space.prune_horizon)
     self.mempool = self.Interface()
     self.storage_space = storage_space
     self.storage_space.register_txos_storage(self)
@@ -178,40 +241,48 @@ class TXOsStorage:
     utxo = self.mempool.storage.pop(output_index)
     self.confirmed.append(utxo, wtx=wtx)
 
-  def apply_block_tx_get_merkles_and_rollback(self, tx, wtx):
-    rollback_inputs = []
+  def get_merkles_after_block_tx(self, tx, rtx):
+    '''
+      Calculate commitments and txos roots which trees will have after applying tx.
+      Trees are not modified: changes are applied to in-memory views.
+    '''
+    commitments, txos = self.confirmed.commitments.view(rtx), self.confirmed.txos.view(rtx)
     for _i in tx.inputs:
-        rollback_inputs.append(self.confirmed.spend(_i, wtx=wtx, return_revert_obj=True))
+      txos.discard(sha256(_i.serialized_index))
+      commitments.clear(_i.commitment_index)
     for _o in tx.outputs:
-        self.confirmed.append(_o, wtx=wtx)
-    roots=[self.confirmed.get_commitment_root(rtx=wtx), self.confirmed.get_txo_root(rtx=wtx)]
-    for r_i in rollback_inputs:
-      self.confirmed.unspend(r_i, wtx=wtx)
-    self.confirmed.remove(len(tx.outputs), wtx=wtx)
-    return roots
-
-  def apply_block_tx(self, tx, new_state, wtx):
-    rollback_inputs = []
+      assert _o.verify() #Should be fast since cached
+      assert _o.address_excess_num_index
+      txos.append(sha256(_o.serialized_index))
+      commitments.append(_o.commitment_index, unique=True)
+    return [commitments.get_root(), txos.get_root()]
+
+  def apply_block_tx(self, tx, new_state, wtx, height=None):
     for _i in tx.inputs:
         if self.storage_space.utxo_index:
           self.storage_space.utxo_index.remove_utxo(_i, wtx=wtx)
-        rollback_inputs.append(self.confirmed.spend(_i, return_revert_obj=True, wtx=wtx))
+    rollback_inputs = self.confirmed.spend_many(tx.inputs, wtx=wtx)
+    if height!=None:
+      self.confirmed.journal_pruned(height, rollback_inputs, wtx=wtx)
+      self.confirmed.settle_pruned(height, wtx=wtx)
+    self.confirmed.append_many(tx.outputs, wtx=wtx)
     for _o in tx.outputs:
         if self.storage_space.utxo_index:
           self.storage_space.utxo_index.add_utxo(_o, wtx=wtx)
-        self.confirmed.append(_o, wtx=wtx)
         self.mempool.remove(_o)
     self.confirmed.set_state(new_state, wtx=wtx)
     return (rollback_inputs, len(tx.outputs))
 
-  def rollback(self, pruned_inputs, num_of_added_outputs, prev_state, wtx):
+  def rollback(self, pruned_inputs, num_of_added_outputs, prev_state, wtx, height=None):
+    if height!=None:
+      self.confirmed.unjournal_pruned(height, wtx=wtx)
     for r_i in pruned_inputs:
       if self.storage_space.utxo_index:
         #r_i[0][2] is serialized txo (0 is txo, 2 is serialized object)
         utxo=IOput()
         utxo.deserialize(r_i[0][2])
         self.storage_space.utxo_index.add_utxo(utxo, wtx=wtx)
-      self.confirmed.unspend(r_i, wtx=wtx)
+    self.confirmed.unspend_many(pruned_inputs, wtx=wtx)
     outputs_for_mempool = self.confirmed.remove(num_of_added_outputs, wtx=wtx)
     for _o in outputs_for_mempool:
       self.mempool[_o.serialized_index]=_o
@@ -1,36 +1,97 @@
-from leer.core.utils import ObliviousDictionary
+from collections import OrderedDict
+from hashlib import sha256
+from time import time
 
 class VerificationCache:
   '''
-   Verification cache is in memory cache for storing (non-context and semi-non-context) validity 
+   Verification cache is in memory cache for storing (non-context and semi-non-context) validity
    of different objects.
    Two type of keys may be presented:
      tuple for semi-non-context checks. Second element of tuple is trated as block_number. If something
       was valid at height h, it should be valid at any height h' such as h'>=h. If something was not valid
       at height h, it should not be valid at any height h' such as h'<=h.
-     anything else, in this case verification cache is just oblivious dictionary
+     anything else, in this case verification cache is just dictionary with expiring items
+   Objects are stored under sha256 digest of their serialization, so size of an entry does not depend
+   on size of the object. Cache is bounded by `max_bytes`: least recently used entries are evicted.
+   Entries expire after `ttl` seconds: they are put to wheel of buckets by expiration time,
+   and on each access only buckets which are already expired are dropped.
   '''
+  max_bytes = 16*1024*1024
+  entry_size = 200 # approximate size of digest, value and bookkeeping of one entry in bytes
+  ttl = 3600
+  bucket_width = 60
+
   def __init__(self):
-    self.od = ObliviousDictionary(3600)
+    self.clear()
+
+  def clear(self):
+    self.entries = OrderedDict() # digest -> (value, bucket)
+    self.buckets = OrderedDict() # bucket -> set of digests, in order of expiration
+    self.hits, self.misses, self.evictions, self.expirations = 0, 0, 0, 0
+
+  def _digest(self, _index):
+    return sha256(bytes(_index)).digest()
+
+  def _expire(self):
+    now_bucket = int(time()//self.bucket_width)
+    while self.buckets:
+      bucket = next(iter(self.buckets))
+      if bucket>=now_bucket:
+        break
+      for digest in self.buckets.pop(bucket):
+        self.entries.pop(digest)
+        self.expirations += 1
+
+  def _get(self, digest):
+    self._expire()
+    if not digest in self.entries:
+      self.misses += 1
+      raise KeyError
+    self.hits += 1
+    self.entries.move_to_end(digest)
+    return self.entries[digest][0]
+
+  def _set(self, digest, value):
+    self._expire()
+    if digest in self.entries:
+      self.buckets[self.entries.pop(digest)[1]].discard(digest)
+    bucket = int((time()+self.ttl)//self.bucket_width)+1
+    if not bucket in self.buckets:
+      self.buckets[bucket] = set()
+    self.buckets[bucket].add(digest)
+    self.entries[digest] = (value, bucket)
+    while len(self.entries)*self.entry_size > self.max_bytes:
+      evicted, (_, evicted_bucket) = self.entries.popitem(last=False)
+      self.buckets[evicted_bucket].discard(evicted)
+      self.evictions += 1
 
   def __getitem__(self, _index):
     if isinstance(_index, tuple):
       _index, check_block = _index
-      is_valid, has_block = self.od[_index]
+      is_valid, has_block = self._get(self._digest(_index))
       if is_valid and check_block>=has_block: #Once valid, always valid
         return True
       if (not is_valid) and (check_block<=has_block): #If not valid at block x, not valid for all blocks before x
         return False
       raise KeyError #Generally cant say anything
     else:
-      return self.od[_index]
+      return self._get(self._digest(_index))
 
   def __setitem__(self, _index, _object):
     if isinstance(_index, tuple):
       _index, check_block = _index
-      self.od[_index]=(_object, check_block)
+      self._set(self._digest(_index), (_object, check_block))
     else:
-      self.od[_index]=_object
+      self._set(self._digest(_index), _object)
+
+  def __len__(self):
+    self._expire()
+    return len(self.entries)
+
+  def stats(self):
+    return {'entries': len(self), 'bytes': len(self.entries)*self.entry_size, 'max_bytes': self.max_bytes,
+            'hits': self.hits, 'misses': self.misses,
+            'evictions': self.evictions, 'expirations': self.expirations}
 
 
 verification_cache = VerificationCache()
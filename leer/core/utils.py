@@ -79,3 +79,50 @@ def sha256(data):
         m=hashlib.sha256()
         m.update(bytes(data))
         return m.digest()
+
+
+class Reader:
+  '''
+    Cursor over serialized data. Fields are read by offset from memoryview, so parsing
+    does not copy the whole residue on each field as `data[:n], data[n:]` does.
+    It may wrap lmdb buffers (buffers=True) as well, then it is valid only inside transaction.
+    `deserialize_raw` methods of primitives accept both bytes and Reader: if reader is passed,
+    the same (advanced) reader is returned, otherwise residue is returned as bytes.
+  '''
+  def __init__(self, data):
+    self.view = memoryview(data)
+    self.offset = 0
+
+  @classmethod
+  def of(cls, data):
+    return data if isinstance(data, Reader) else cls(data)
+
+  def __len__(self):
+    return len(self.view) - self.offset
+
+  def read(self, n):
+    if n > len(self):
+      raise Exception("Not enough bytes for deserialization")
+    self.offset += n
+    return self.view[self.offset-n:self.offset].tobytes()
+
+  def read_int(self, n):
+    if n > len(self):
+      raise Exception("Not enough bytes for deserialization")
+    self.offset += n
+    return int.from_bytes(self.view[self.offset-n:self.offset], "big")
+
+  def skip(self, n):
+    self.offset += min(n, len(self))
+
+  def since(self, start):
+    '''
+      Bytes read since `start` offset.
+    '''
+    return self.view[start:self.offset].tobytes()
+
+  def residue(self, data):
+    '''
+      Result of `deserialize_raw(data)`: this reader if `data` is it, otherwise unread bytes.
+    '''
+    return self if data is self else self.view[self.offset:].tobytes()
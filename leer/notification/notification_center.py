@@ -1,4 +1,4 @@
-from time import time, sleep
+from time import time
 
 def notification_center_launcher(syncer, config):
   '''
@@ -7,7 +7,7 @@ def notification_center_launcher(syncer, config):
   message_queue = syncer.queues['Notifications']
   keyvalue = {}
   while True:
-    sleep(0.001)
+    message_queue.wait()
     while not message_queue.empty():
       message = message_queue.get()
       if not 'action' in message:
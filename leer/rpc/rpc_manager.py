@@ -57,7 +57,7 @@ class RPCManager():
     self.app.router.add_static('/',web_wallet_dir)
     self.server = self.loop.create_server(self.app.make_handler(), self.host, self.port)
     asyncio.ensure_future(self.server, loop=loop)
-    asyncio.ensure_future(self.check_queue())
+    self.loop.add_reader(self.global_message_queue.fileno(), self.check_queue)
 
     methods.add(self.ping)
     methods.add(self.getconnectioncount)
@@ -75,6 +75,7 @@ class RPCManager():
     methods.add(self.importprivkey)
     methods.add(self.getsyncstatus)
     methods.add(self.getblock)
+    methods.add(self.getmerkleproof)
     methods.add(self.getnodes)
     methods.add(self.connecttonode)
     methods.add(self.gettransactions)
@@ -289,6 +290,19 @@ class RPCManager():
     self.requests.pop(_id)
     return answer['result']
 
+  async def getmerkleproof(self, tree, indexes):
+    _id = str(uuid4())
+    self.syncer.queues['Blockchain'].put({'action':'give merkle proof', 'id':_id, 'tree':tree,
+                                          'indexes':[bytes.fromhex(index) for index in indexes], 'sender': "RPCManager"})
+    self.requests[_id]=asyncio.Future()
+    answer = await self.requests[_id]
+    self.requests.pop(_id)
+    if answer['result']=='error':
+      exc = ServerError()
+      exc.message = answer["error"]
+      raise exc
+    return answer['result']
+
   async def getsyncstatus(self):
     _id = str(uuid4())
     self.syncer.queues['Notifications'].put({'action':'get', 'id':_id, 'key': 'blockchain height','sender': "RPCManager"})
@@ -424,22 +438,23 @@ class RPCManager():
     return "Prepairing shutdown"
     
  
-  async def check_queue(self):
-    while self.up:
-      while not self.global_message_queue.empty():
-        message = self.global_message_queue.get()
-        if 'id' in message:
-          if message['id'] in self.requests:
-            try:
-              self.requests[message['id']].set_result(message)
-            except InvalidStateError:
-              self.requests.pop(message['id'])
-          elif message["action"] == "stop":
-            self.logger.info("RPC server stops")
-            self.loop.stop()    
-        else:
-          pass 
-      await asyncio.sleep(0.2)
+  def check_queue(self):
+    while not self.global_message_queue.empty():
+      message = self.global_message_queue.get()
+      if 'id' in message:
+        if message['id'] in self.requests:
+          try:
+            self.requests[message['id']].set_result(message)
+          except InvalidStateError:
+            self.requests.pop(message['id'])
+        elif message["action"] == "stop":
+          self.logger.info("RPC server stops")
+          self.up = False
+          self.loop.remove_reader(self.global_message_queue.fileno())
+          self.loop.stop()
+          return
+      else:
+        pass 
     
 
 def RPCM_launcher(syncer, config):
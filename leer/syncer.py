@@ -1,11 +1,177 @@
-import multiprocessing
+import multiprocessing, multiprocessing.util, threading, collections, os, pickle, struct
+from multiprocessing import shared_memory
+
+'''
+  Messages between processes are dicts. Large bytes values (serialized blocks, txos, headers) are not
+  pickled: message frame is pickled header (dict without such values and list of their keys and lengths)
+  followed by raw values. Raw values are passed through shared memory ring of queue (if it has one)
+  and only their descriptors are sent through pipe.
+'''
+raw_value_threshold = 1024
+
+def encode_message(message):
+  '''
+    Returns list of buffers: header and raw values.
+  '''
+  raw_keys, raw_values = [], []
+  if isinstance(message, dict):
+    for key, value in message.items():
+      if isinstance(value, (bytes, bytearray, memoryview)) and len(value) >= raw_value_threshold:
+        raw_keys.append((key, len(value)))
+        raw_values.append(value)
+    if raw_keys or any(isinstance(value, memoryview) for value in message.values()):
+      message = {key: bytes(value) if isinstance(value, memoryview) else value
+                 for key, value in message.items() if not key in dict(raw_keys)}
+  return [pickle.dumps((message, raw_keys), pickle.HIGHEST_PROTOCOL)] + raw_values
+
+def decode_message(header, raw_values):
+  message, raw_keys = pickle.loads(header)
+  for (key, _len), value in zip(raw_keys, raw_values):
+    if not len(value)==_len:
+      raise Exception("Broken message frame")
+    message[key] = value
+  return message
+
+
+class SharedRing:
+  '''
+    Ring buffer in shared memory for raw parts of frames. Parts are written by senders under write lock
+    of queue and are read (copied out) by the receiver in the same order, so space is freed in order.
+    First 16 bytes of memory are write and read positions, which only grow. Part is prefixed with
+    its position, receiver checks it against descriptor (offset, length, generation) of the part.
+    If there is no space, part is not written and should be sent through pipe.
+  '''
+  def __init__(self, size):
+    self.capacity = size
+    self.memory = shared_memory.SharedMemory(create=True, size=size+16)
+    multiprocessing.util.Finalize(self, SharedRing._unlink, args=(self.memory,), exitpriority=0)
+
+  def __getstate__(self):
+    return {'capacity':self.capacity, 'name':self.memory.name}
+
+  def __setstate__(self, state):
+    self.capacity = state['capacity']
+    self.memory = shared_memory.SharedMemory(name=state['name'])
+
+  @staticmethod
+  def _unlink(memory):
+    memory.close()
+    memory.unlink()
+
+  def write(self, data):
+    size = len(data)+8
+    if size > self.capacity:
+      return None
+    buf = self.memory.buf
+    head, tail = struct.unpack_from(">QQ", buf, 0)
+    offset = head % self.capacity
+    if offset+size > self.capacity: # part is not split, skip to the beginning of buffer
+      head, offset = head+self.capacity-offset, 0
+    if head+size-tail > self.capacity:
+      return None
+    struct.pack_into(">Q", buf, 16+offset, head)
+    buf[16+offset+8:16+offset+size] = data
+    struct.pack_into(">Q", buf, 0, head+size)
+    return (offset, len(data), head//self.capacity)
+
+  def read(self, descriptor):
+    offset, length, generation = descriptor
+    position = generation*self.capacity+offset
+    buf = self.memory.buf
+    if not struct.unpack_from(">Q", buf, 16+offset)[0]==position:
+      raise Exception("Part of frame in shared memory is overwritten")
+    data = bytes(buf[16+offset+8:16+offset+8+length])
+    struct.pack_into(">Q", buf, 8, position+8+length)
+    return data
+
+
+class MessageQueue:
+  '''
+    Inter-process queue of messages with waitable file descriptor: `fileno` is readable when there are
+    messages in queue, so asyncio processes can `add_reader` it and synchronous processes can block on `wait`.
+    Each queue should be read by one process. As with multiprocessing.Queue, `put` never blocks:
+    frames are written to pipe by feeder thread of sending process.
+    Queue with `shared_buffer_size` passes raw parts of frames through SharedRing of that size.
+  '''
+  def __init__(self, shared_buffer_size=None):
+    self._reader, self._writer = multiprocessing.Pipe(duplex=False)
+    self._write_lock = multiprocessing.Lock()
+    self._ring = SharedRing(shared_buffer_size) if shared_buffer_size else None
+    self._feeder_pid = None
+
+  def __getstate__(self):
+    return {'_reader':self._reader, '_writer':self._writer, '_write_lock':self._write_lock,
+            '_ring':self._ring, '_feeder_pid':None}
+
+  def _start_feeder(self):
+    # feeder thread is not inherited by child process, so it is started on first `put` in each process
+    self._buffer = collections.deque()
+    self._not_empty = threading.Condition()
+    self._feeder_pid = os.getpid()
+    thread = threading.Thread(target=self._feed, daemon=True)
+    thread.start()
+    multiprocessing.util.Finalize(self, MessageQueue._flush, args=(self._buffer, self._not_empty, thread), exitpriority=5)
+
+  def _feed(self):
+    while True:
+      with self._not_empty:
+        while not self._buffer:
+          self._not_empty.wait()
+        frame = self._buffer[0]
+      if frame==None:
+        return
+      header, raw_values = frame[0], frame[1:]
+      with self._write_lock:
+        descriptors = [self._ring.write(value) if self._ring else None for value in raw_values]
+        self._writer.send_bytes(pickle.dumps(descriptors, pickle.HIGHEST_PROTOCOL))
+        self._writer.send_bytes(header)
+        for descriptor, value in zip(descriptors, raw_values):
+          if descriptor==None:
+            self._writer.send_bytes(value)
+      with self._not_empty:
+        self._buffer.popleft()
+        self._not_empty.notify_all()
+
+  @staticmethod
+  def _flush(buffer, not_empty, thread):
+    with not_empty:
+      buffer.append(None)
+      not_empty.notify_all()
+    thread.join()
+
+  def put(self, message):
+    if not self._feeder_pid==os.getpid():
+      self._start_feeder()
+    frame = encode_message(message)
+    with self._not_empty:
+      self._buffer.append(frame)
+      self._not_empty.notify_all()
+
+  def get(self):
+    descriptors = pickle.loads(self._reader.recv_bytes())
+    header = self._reader.recv_bytes()
+    return decode_message(header, [self._ring.read(descriptor) if descriptor else self._reader.recv_bytes()
+                                   for descriptor in descriptors])
+
+  def empty(self):
+    return not self._reader.poll()
+
+  def wait(self, timeout=None):
+    '''
+      Block till there are messages in queue or `timeout` seconds passed. Returns True if queue is not empty.
+    '''
+    return self._reader.poll(timeout)
+
+  def fileno(self):
+    return self._reader.fileno()
+
 
 class Syncer:
   'This class holds all sync objects'
   queue_ids = ['NetworkManager', 'Blockchain', 'RPCManager', 'Notifications', 'Wallet']
+  shared_buffer_sizes = {'NetworkManager': 4*1024*1024, 'Blockchain': 4*1024*1024} # blocks and txos go through these queues
   def __init__(self, chains_ids=[], file_paths=[]):
    self.file_locks = {}
    for file_path in file_paths:
      self.file_locks[file_path]=multiprocessing.Lock()
-   self.queues = {i: multiprocessing.Queue() for i in Syncer.queue_ids}
-
+   self.queues = {i: MessageQueue(Syncer.shared_buffer_sizes.get(i, None)) for i in Syncer.queue_ids}
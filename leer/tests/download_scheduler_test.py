@@ -0,0 +1,81 @@
+from leer.core.core_operations.download_scheduler import DownloadScheduler, BlocksDownloadScheduler, TXOsDownloadScheduler
+
+class RecordingScheduler(BlocksDownloadScheduler):
+  def __init__(self):
+    self.sent = []
+    DownloadScheduler.__init__(self, lambda node, items: self.sent.append((node, items)))
+
+def test_windows_are_assigned_by_height():
+  scheduler = RecordingScheduler()
+  nodes = {"short": {"height": 20}, "long": {"height": 100}}
+  for height in range(1, 65):
+    scheduler.add(b"block%d"%height, height)
+  scheduler.schedule(nodes, now=0)
+  # both peers get default budget of windows, the short one only while it covers window heights
+  assert [(node, len(items)) for node, items in scheduler.sent] == [("short", 16), ("long", 16), ("long", 16)]
+  assert scheduler.sent[0][1][0] == b"block1"
+  assert scheduler.stats()['queued'] == 16 and scheduler.stats()['in_flight'] == 48
+
+def test_timed_out_window_is_reassigned():
+  scheduler = RecordingScheduler()
+  nodes = {"a": {"height": 100}, "b": {"height": 100}}
+  for height in range(1, 17):
+    scheduler.add(b"block%d"%height, height)
+  scheduler.schedule(nodes, now=0)
+  first_node, items = scheduler.sent[0]
+  for item in items[:8]:
+    assert scheduler.received(item, now=5)
+  scheduler.schedule(nodes, now=scheduler.timeout+1)
+  second_node, second_items = scheduler.sent[1]
+  assert second_node != first_node and second_items == items[8:]
+  assert scheduler.peers[first_node].timeouts == 1
+  assert not scheduler.received(b"unknown")
+
+def test_fast_peers_are_preferred():
+  scheduler = RecordingScheduler()
+  nodes = {"slow": {"height": 10**6}, "fast": {"height": 10**6}}
+  scheduler.peer("slow").update_throughput(1, 10)
+  scheduler.peer("fast").update_throughput(100, 1)
+  for height in range(1, 1001):
+    scheduler.add(b"block%d"%height, height)
+  scheduler.schedule(nodes, now=0)
+  requests = [node for node, items in scheduler.sent]
+  assert requests[0] == "fast"
+  assert requests.count("fast") == scheduler.max_budget and requests.count("slow") == scheduler.min_budget
+
+def test_unneeded_items_are_forgotten():
+  scheduler = RecordingScheduler()
+  nodes = {"a": {"height": 100}}
+  for height in range(1, 33):
+    scheduler.add(b"block%d"%height, height)
+  scheduler.schedule(nodes, is_needed=lambda item: item != b"block1", now=0)
+  assert not b"block1" in sum([items for node, items in scheduler.sent], [])
+  scheduler.schedule(nodes, is_needed=lambda item: False, now=1)
+  assert scheduler.stats()['queued'] == 0 and scheduler.stats()['requests'] == 0
+  assert scheduler.peers["a"].in_flight == 0
+
+def test_txos_are_split_over_peers():
+  sent = []
+  scheduler = TXOsDownloadScheduler(lambda message: sent.append(message))
+  nodes = {"a": {}, "b": {}, "c": {}}
+  txos = [bytes([i%256, i//256])*32+b"\x00" for i in range(300)]
+  for txo in txos:
+    scheduler.add(txo)
+  scheduler.schedule(nodes, now=0)
+  assert {m["node"] for m in sent} == set(nodes)
+  assert b"".join(m["txos_hashes"] for m in sent) == b"".join(txos)
+  assert all(m["num"] <= scheduler.window_size for m in sent)
+
+def test_requests_to_disconnected_peers_are_retried_at_once():
+  sent = []
+  scheduler = TXOsDownloadScheduler(lambda message: sent.append(message))
+  for i in range(10):
+    scheduler.add(bytes([i])*65)
+  scheduler.schedule({"a": {}}, now=0)
+  scheduler.schedule({"b": {}}, now=1)
+  assert [m["node"] for m in sent] == ["a", "b"] and sent[0]["txos_hashes"] == sent[1]["txos_hashes"]
+  assert scheduler.stats()['timeouts'] == 0
+  # the only peer failed: it should be asked again rather than never
+  scheduler.schedule({"b": {}}, now=1+scheduler.timeout+1)
+  scheduler.schedule({"b": {}}, now=1+scheduler.timeout+2)
+  assert [m["node"] for m in sent] == ["a", "b", "b"]
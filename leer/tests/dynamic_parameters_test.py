@@ -0,0 +1,62 @@
+import random
+from hashlib import sha256
+from leer.core.primitives.header import Header, ContextHeader, PoPoW, VoteData
+from leer.core.parameters.dynamic import next_target, next_reward
+from leer.core.utils import encode_target, decode_target
+from leer.core.parameters.constants import initial_target
+
+class InMemoryHeaders:
+  '''
+    Linear chain of ContextHeaders with interface of HeadersStorage used by dynamic parameters.
+  '''
+  def __init__(self):
+    self.headers = {}
+    self.main_chain = []
+    self.storage_space = self
+    self.headers_manager = self
+
+  def has(self, _hash, rtx):
+    return _hash in self.headers
+
+  def get(self, _hash, rtx):
+    return self.headers[_hash]
+
+  def find_ancestor_with_height(self, _hash, height, rtx):
+    return self.main_chain[height]
+
+def generate_chain(length, with_aggregates):
+  random.seed(1)
+  storage = InMemoryHeaders()
+  prev, prev_hash, timestamp = None, b"\x00"*32, 1500000000
+  for height in range(length):
+    timestamp += random.randint(1, 180)
+    header = ContextHeader(Header(height = height, supply = 0, full_offset = 0,
+                                  merkles = [b"\x00"*65, b"\x00"*32, b"\x00"*65],
+                                  popow = PoPoW([prev_hash] if prev else []),
+                                  votedata = VoteData(dev_reward_vote=bytes([random.randint(0,255)]),
+                                                      miner_subsidy_vote=bytes([random.randint(0,255)])),
+                                  timestamp = timestamp,
+                                  target = decode_target(*encode_target(random.randint(initial_target//4, initial_target))),
+                                  version = 1, nonce = b"\x00"*8))
+    if with_aggregates:
+      header.set_aggregates(prev)
+      restored = ContextHeader()
+      restored.deserialize_raw(header.serialize_with_context())
+      assert (restored.subsidy_votes_sum, restored.dev_reward_votes_sum, restored.targets_window) == \
+             (header.subsidy_votes_sum, header.dev_reward_votes_sum, header.targets_window)
+    _hash = sha256(height.to_bytes(4,'big')).digest()
+    storage.headers[_hash] = header
+    storage.main_chain.append(_hash)
+    prev, prev_hash = header, _hash
+  return storage
+
+def test_aggregates_coincide_with_loop():
+  '''
+    Results calculated from running aggregates should be bit-identical to results of walking the chain.
+  '''
+  with_aggregates, without_aggregates = generate_chain(5000, True), generate_chain(5000, False)
+  for _hash in with_aggregates.main_chain:
+    assert with_aggregates.get(_hash, rtx=None).subsidy_votes_sum != None
+    assert without_aggregates.get(_hash, rtx=None).subsidy_votes_sum == None
+    assert next_target(_hash, with_aggregates, rtx=None) == next_target(_hash, without_aggregates, rtx=None)
+    assert next_reward(_hash, with_aggregates, rtx=None) == next_reward(_hash, without_aggregates, rtx=None)
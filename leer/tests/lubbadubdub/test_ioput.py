@@ -1,4 +1,4 @@
-from leer.core.lubbadubdub.ioput import IOput
+from leer.core.lubbadubdub.ioput import IOput, verify_outputs_batch
 from leer.core.lubbadubdub.address import address_from_private_key
 from secp256k1_zkp import PrivateKey
 
@@ -109,3 +109,22 @@ def test_ioput_indexes():
   assert len(_input1.commitment_index)==32+33
   print("ioput_indexes len OK")
 
+
+def test_verify_outputs_batch():
+  serialized = []
+  for value in range(1, 10):
+    _output=IOput()
+    _output.fill(adr2, value)
+    _output.generate()
+    serialized.append(_output.serialize())
+  corrupted = bytearray(serialized[5])
+  corrupted[-5] ^= 1
+  serialized.append(bytes(corrupted))
+  outputs = []
+  for s in serialized:
+    _output = IOput()
+    _output.deserialize_raw(s, verify=False)
+    outputs.append(_output)
+  assert verify_outputs_batch(outputs) == [True]*9+[False]
+  assert verify_outputs_batch(outputs[::-1]) == [False]+[True]*9 # from cache
+  print("verify_outputs_batch OK")
@@ -0,0 +1,14 @@
+from time import sleep
+from leer.core.lubbadubdub import verification_pool
+from leer.core.storage.verification_cache import verification_cache
+
+def test_uncollected_results_are_not_pending():
+  malformed = [b"\x02"+bytes([i])*40 for i in range(5)]
+  verification_pool.submit(malformed)
+  assert all(s in verification_pool.pending for s in malformed)
+  for future in list(verification_pool.chunks):
+    future.result(timeout=120)
+  sleep(0.1) # done callbacks
+  verification_pool.submit([])
+  assert not verification_pool.pending and not verification_pool.chunks
+  assert [verification_cache[s] for s in malformed]==[False]*5
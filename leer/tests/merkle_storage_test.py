@@ -1,17 +1,40 @@
 from leer.core.storage.merkle_storage import MMR
-import shutil, os, time, lmdb
+from leer.core.storage.txos_storage import CommitmentMMR
+from leer.core.storage.points_summation import parse_commitment, serialize_commitment, sum_points
+from leer.core.storage import snapshot
+from secp256k1_zkp import PedersenCommitment
+import shutil, os, time, lmdb, hashlib, io
 
 class MMRTest1(MMR):
   def sum(self,x,y):
    return bytes("(%s+%s)"%(x.decode('utf-8'),y.decode('utf-8')),'ascii')
 
+class MMRTestHash(MMR):
+  def sum(self,x,y):
+   return hashlib.sha256(x+y).digest()
+
 env = None
+class CommitmentMMRPairwise(CommitmentMMR):
+  # reference: nodes are serialized and parsed again for each pair
+  def sum_level(self, pairs):
+    reparse = lambda node: self._decode_node(self._encode_node(node))
+    return [reparse(CommitmentMMR.sum_level(self, [(reparse(left), reparse(right))])[0]) for left, right in pairs]
+
+def commitment_leafs(n):
+  pc = PedersenCommitment()
+  pc.create(1, b"\x01"*32)
+  step = parse_commitment(pc.serialize())
+  points = [step]
+  for i in range(n-1):
+    points += sum_points([(points[-1], step)])
+  return [serialize_commitment(point)+hashlib.sha256(str(i).encode()).digest() for i, point in enumerate(points)]
+
 def create_db():
   global env
   path = "~/.testleer/"
   if not os.path.exists(path): 
       os.makedirs(path) #TODO catch
-  env = lmdb.open(path, map_size = 1000000, max_dbs=70)   
+  env = lmdb.open(path, map_size = 100000000, max_dbs=200)   
 
 
 def wipe_test_dirs():
@@ -199,9 +222,281 @@ def test_unique(env, wtx):
   assert a.has_index(rtx=wtx, obj_index=b"e")
   assert a.get_by_hash(b"e", rtx=wtx) == b"e1ee7 2"
   print("test_unique OK")
-  
 
 
+def test_batch_operations(env, wtx):
+  a=MMRTest1("batch1","~/.testleer/", env, wtx)
+  b=MMRTest1("batch2","~/.testleer/", env, wtx)
+  full_root = b'((((0+1)+(2+3))+((4+5)+(6+7)))+(8+9))'
+  for i in range(10):
+    a.append(wtx, bytes(str(i),'ascii'), bytes(str(i)*2,'ascii'))
+  nums = b.append_many(wtx, [(bytes(str(i),'ascii'), bytes(str(i)*2,'ascii')) for i in range(10)])
+  assert nums == [i.to_bytes(5,'big') for i in range(10)]
+  assert a.get_root(rtx=wtx)==b.get_root(rtx=wtx)==full_root
+  try:
+    b.append_many(wtx, [(b'x',b'x'), (b'x',b'x')], unique=True)
+    raise Exception
+  except KeyError:
+    pass
+  assert b.num_of_elements(rtx=wtx)==10
+  print("test_append_many OK")
+  cleared_objects = b.clear_many([bytes(str(i),'ascii') for i in range(3,6)], wtx=wtx)
+  assert b.get_root(rtx=wtx)==b'((((0+1)+2)+(6+7))+(8+9))'
+  b.revert_clearing_many(cleared_objects, wtx=wtx)
+  assert b.get_root(rtx=wtx)==full_root
+  print("test_clear_many OK")
+  b.update_index_by_num_many(wtx, [((2).to_bytes(5,'big'), b"e", b"e"), ((9).to_bytes(5,'big'), b"f", b"f")])
+  assert b.get_root(rtx=wtx)==b'((((0+1)+(e+3))+((4+5)+(6+7)))+(8+f))'
+  b.remove(7, wtx=wtx)
+  assert b.get_root(rtx=wtx)==b'((0+1)+e)'
+  b.append_many(wtx, [(bytes(str(i),'ascii'), bytes(str(i),'ascii')) for i in range(3,10)])
+  assert b.get_root(rtx=wtx)==b'((((0+1)+(e+3))+((4+5)+(6+7)))+(8+9))'
+  print("test_remove_many OK")
+
+
+
+def test_cached_nodes(env, wtx):
+  full_root = b'((((0+1)+(2+3))+((4+5)+(6+7)))+(8+9))'
+  a=MMRTest1("cached1","~/.testleer/", env, wtx)
+  with a.cached_nodes(wtx):
+    for i in range(10):
+      a.append(wtx, bytes(str(i),'ascii'), bytes(str(i),'ascii'))
+    assert a.get_root(rtx=wtx)==full_root
+    assert a.node_storage.get(4, 0, rtx=wtx)==None #not flushed yet
+  b=MMRTest1("cached1","~/.testleer/", env, wtx)
+  assert b.get_root(rtx=wtx)==full_root
+  print("test_cached_nodes_flush OK")
+  try:
+    with a.cached_nodes(wtx):
+      a.remove(4, wtx=wtx)
+      assert a.get_root(rtx=wtx)==b'(((0+1)+(2+3))+(4+5))'
+      raise KeyError
+  except KeyError:
+    pass
+  assert a.node_cache==None
+  assert a.node_storage.get(4, 0, rtx=wtx)==None #flushed with removed leafs
+  b=MMRTest1("cached1","~/.testleer/", env, wtx)
+  assert b.get_root(rtx=wtx)==b'(((0+1)+(2+3))+(4+5))'
+  a._rebuild_nodes(wtx)
+  assert a.get_root(rtx=wtx)==b'(((0+1)+(2+3))+(4+5))'
+  print("test_cached_nodes_abort OK")
+
+def test_view(env, wtx):
+  a=MMRTest1("view1","~/.testleer/", env, wtx)
+  for i in range(10):
+    a.append(wtx, bytes(str(i),'ascii'), bytes(str(i),'ascii'))
+  v=a.view(wtx)
+  v.clear(b'3')
+  v.clear(b'4')
+  v.update_index_by_num((9).to_bytes(5,'big'), b'f')
+  for i in ['a','b','c','d']:
+    v.append(bytes(i,'ascii'))
+  try:
+    v.append(b'0', unique=True)
+    raise Exception
+  except KeyError:
+    pass
+  v.append(b'3', unique=True) #cleared in view
+  assert a.get_root(rtx=wtx)==b'((((0+1)+(2+3))+((4+5)+(6+7)))+(8+9))' #tree itself is not changed
+  assert v.get_root()==b'((((0+1)+2)+(5+(6+7)))+(((8+f)+(a+b))+((c+d)+3)))'
+  a.clear_many([b'3', b'4'], wtx=wtx)
+  a.update_index_by_num(wtx, (9).to_bytes(5,'big'), b'f', b'f')
+  a.append_many(wtx, [(bytes(i,'ascii'), b'') for i in ['a','b','c','d','3']])
+  assert v.get_root()==a.get_root(rtx=wtx)
+  empty=MMRTest1("view2","~/.testleer/", env, wtx)
+  assert empty.view(wtx).get_root()==empty.get_root(rtx=wtx)
+  print("test_view OK")
+
+
+def test_commitment_sum_level(env, wtx):
+  leafs = commitment_leafs(37)
+  a=CommitmentMMR("commitments1","~/.testleer/", env, wtx)
+  b=CommitmentMMRPairwise("commitments2","~/.testleer/", env, wtx)
+  for tree in [a,b]:
+    tree.append_many(wtx, [(leaf, b"") for leaf in leafs])
+    tree.clear_many(leafs[3:6], wtx=wtx)
+    tree.update_index_by_num_many(wtx, [((i).to_bytes(5,'big'), leafs[i-1], b"") for i in [10, 20, 36]])
+  assert a.get_root(rtx=wtx)==b.get_root(rtx=wtx)
+  v = a.view(wtx)
+  v.append(leafs[0])
+  v.clear(leafs[7])
+  a.append(wtx, leafs[0], b"")
+  a.clear(leafs[7], wtx=wtx)
+  assert v.get_root()==a.get_root(rtx=wtx)
+  print("test_commitment_sum_level OK")
+
+def test_flat_file_nodes(env, wtx):
+  leafs = [hashlib.sha256(str(i).encode()).digest() for i in range(100)]
+  a=MMRTestHash("flat_ref","~/.testleer/", env, wtx)
+  b=MMRTestHash("flat1","~/.testleer/", env, wtx, node_storage="flat_file", node_size=32)
+  for tree in [a,b]:
+    tree.append_many(wtx, [(leaf, b"") for leaf in leafs[:70]])
+    tree.clear_many(leafs[10:20], wtx=wtx)
+    tree.remove(25, wtx=wtx)
+    with tree.cached_nodes(wtx):
+      tree.append_many(wtx, [(leaf, b"") for leaf in leafs[70:]])
+      tree.remove(3, wtx=wtx)
+  assert a.get_root(rtx=wtx)==b.get_root(rtx=wtx)
+  print("test_flat_file_nodes OK")
+
+  root = b.get_root(rtx=wtx)
+  child = env.begin(write=True, parent=wtx)
+  b.append_many(child, [(leaf, b"") for leaf in leafs[:5]])
+  b.remove(50, wtx=child)
+  assert not b.get_root(rtx=child)==root
+  child.abort()
+  assert b.get_root(rtx=wtx)==root # original records for transaction which does not see changes
+  for tree in [a,b]:
+    tree.append(wtx, leafs[0], b"")
+  assert a.get_root(rtx=wtx)==b.get_root(rtx=wtx) # aborted changes are reverted
+  print("test_flat_file_nodes_abort OK")
+
+  b.set_state(b"state", wtx=wtx)
+  b.node_storage.close()
+  c=MMRTestHash("flat1","~/.testleer/", env, wtx, node_storage="flat_file", node_size=32)
+  assert c.node_storage.consistent and not c.node_storage.pending
+  assert a.get_root(rtx=wtx)==c.get_root(rtx=wtx)
+  for tree in [a,c]:
+    tree.append(wtx, leafs[1], b"")
+  c.node_storage.close() # "crash" after changes without sync
+  d=MMRTestHash("flat1","~/.testleer/", env, wtx, node_storage="flat_file", node_size=32)
+  assert d.node_storage.pending.full_rewrite # rebuilt from leafs
+  assert a.get_root(rtx=wtx)==d.get_root(rtx=wtx)
+  d.node_storage.close()
+  e=MMRTestHash("flat1","~/.testleer/", env, wtx)
+  assert a.get_root(rtx=wtx)==e.get_root(rtx=wtx) # switched back to lmdb and rebuilt
+  print("test_flat_file_nodes_reopen OK")
+
+def test_prune_horizon(env, wtx):
+  leafs = [hashlib.sha256(str(i).encode()).digest() for i in range(40)]
+  for discard in [True, False]:
+    name = "discard" if discard else "clear"
+    a=MMRTestHash("horizon_ref_"+name,"~/.testleer/", env, wtx, discard_only=discard, clear_only=not discard)
+    b=MMRTestHash("horizon_"+name,"~/.testleer/", env, wtx, discard_only=discard, clear_only=not discard, prune_horizon=2)
+    for tree in [a,b]:
+      tree.append_many(wtx, [(leaf, leaf) for leaf in leafs[:30]])
+    prune = lambda tree, indexes: tree.discard_many(indexes, wtx=wtx) if discard else tree.clear_many(indexes, wtx=wtx)
+    revert = lambda tree, prune_objs: tree.revert_discarding_many(prune_objs, wtx=wtx) if discard else tree.revert_clearing_many(prune_objs, wtx=wtx)
+    spent = [leafs[:8], leafs[8:11], leafs[12:16], [leafs[11]], [], leafs[16:20], []]
+    last_prune_objs = {}
+    for height, indexes in enumerate(spent):
+      for tree in [a,b]:
+        prune_objs = prune(tree, indexes)
+        last_prune_objs[tree] = prune_objs if len(prune_objs) else last_prune_objs.get(tree, [])
+        tree.journal_pruned(height, [prune_obj[0] for prune_obj in prune_objs], wtx=wtx)
+        tree.settle_pruned(height, wtx=wtx)
+      assert a.get_root(rtx=wtx)==b.get_root(rtx=wtx)
+      assert a.num_of_elements(rtx=wtx)==b.num_of_elements(rtx=wtx)==30
+    assert b.settled_height(rtx=wtx)==4
+    assert wtx.stat(db=b.order_db)['entries']==14 # leafs 0-15 are collapsed into one node
+    assert wtx.get((4).to_bytes(5,'big')+(0).to_bytes(5,'big'), db=b.collapsed_db)==a._get_node(4, 0, rtx=wtx)
+    assert b.find_by_hash(leafs[0], rtx=wtx)==None and b.find_by_hash(leafs[16], rtx=wtx)==leafs[16]
+    print("test_prune_horizon_collapse(%s) OK"%name)
+
+    try:
+      b.unjournal_pruned(3, wtx=wtx)
+      raise Exception
+    except Exception as e:
+      assert "settled" in str(e)
+    for tree in [a,b]:
+      tree.unjournal_pruned(5, wtx=wtx)
+      revert(tree, last_prune_objs[tree]) # pruning at height 5 is still revertable
+      tree.append_many(wtx, [(leaf, leaf) for leaf in leafs[30:]])
+      tree.remove(10, wtx=wtx)
+      tree.append_many(wtx, [(leaf, leaf) for leaf in leafs[30:]])
+    assert a.get_root(rtx=wtx)==b.get_root(rtx=wtx)
+    c=MMRTestHash("horizon_"+name,"~/.testleer/", env, wtx, discard_only=discard, clear_only=not discard, prune_horizon=2, node_storage="flat_file", node_size=32)
+    assert a.get_root(rtx=wtx)==c.get_root(rtx=wtx) # rebuilt from leafs and collapsed subtrees
+    c.node_storage.close()
+    print("test_prune_horizon_rollback(%s) OK"%name)
+
+
+def test_proofs(env, wtx):
+  a=MMRTest1("proofs1","~/.testleer/", env, wtx)
+  leafs = [bytes(str(i),'ascii') for i in range(11)]
+  a.append_many(wtx, [(leaf, leaf) for leaf in leafs])
+  a.clear_many([b'4', b'5'], wtx=wtx)
+  root = a.get_root(rtx=wtx)
+  for leaf in leafs[:4]+leafs[6:]:
+    proof = a.get_proof(leaf, rtx=wtx)
+    assert len(proof['nodes'])<=4
+    assert a.verify_proof(root, leaf, proof)
+    assert not a.verify_proof(root, b'x', proof)
+  assert a.get_proof(b'10', rtx=wtx)['nodes']==[(1, 4, b'(8+9)'), (3, 0, b'(((0+1)+(2+3))+(6+7))')]
+  try:
+    a.get_proof(b'4', rtx=wtx)
+    raise Exception
+  except KeyError:
+    pass
+  proof = a.get_multi_proof_by_nums([4], rtx=wtx) # cleared place
+  assert a.verify_proof(root, b'', proof) and not a.verify_proof(root, b'4', proof)
+  proof = a.get_multi_proof([b'0', b'1', b'3', b'9'], rtx=wtx)
+  assert [node[:2] for node in proof['nodes']]==[(0, 2), (0, 8), (1, 5), (2, 1)] # common siblings are shared
+  assert a.verify_multi_proof(root, [b'0', b'1', b'3', b'9'], proof)
+  assert not a.verify_multi_proof(root, [b'0', b'1', b'9', b'3'], proof)
+  proof['nodes'] = proof['nodes'][1:]
+  assert not a.verify_multi_proof(root, [b'0', b'1', b'3', b'9'], proof)
+  print("test_proofs OK")
+
+  leafs = commitment_leafs(13)
+  c=CommitmentMMR("proofs2","~/.testleer/", env, wtx)
+  c.append_many(wtx, [(leaf, b"") for leaf in leafs])
+  c.clear_many(leafs[2:5], wtx=wtx)
+  proof = c.get_multi_proof(leafs[5:7]+leafs[12:], rtx=wtx)
+  assert c.verify_multi_proof(c.get_root(rtx=wtx), leafs[5:7]+leafs[12:], proof)
+  assert not c.verify_multi_proof(c.get_root(rtx=wtx), leafs[6:8]+leafs[12:], proof)
+  print("test_proofs_commitments OK")
+
+  leafs = [hashlib.sha256(str(i).encode()).digest() for i in range(20)]
+  h=MMRTestHash("proofs3","~/.testleer/", env, wtx, clear_only=True, prune_horizon=0)
+  h.append_many(wtx, [(leaf, leaf) for leaf in leafs])
+  prune_objs = h.clear_many(leafs[:6], wtx=wtx)
+  h.journal_pruned(0, [prune_obj[0] for prune_obj in prune_objs], wtx=wtx)
+  h.settle_pruned(0, wtx=wtx)
+  for leaf in leafs[6:]:
+    assert h.verify_proof(h.get_root(rtx=wtx), leaf, h.get_proof(leaf, rtx=wtx)) # siblings are roots of collapsed subtrees
+  print("test_proofs_collapsed OK")
+
+def test_snapshot_records(env, wtx):
+  leafs = [hashlib.sha256(str(i).encode()).digest() for i in range(1000)]
+  a=MMRTestHash("snapshot_src","~/.testleer/", env, wtx)
+  b=MMRTestHash("snapshot_dst","~/.testleer/", env, wtx)
+  a.append_many(wtx, [(leaf, leaf) for leaf in leafs])
+  a.clear_many(leafs[100:300], wtx=wtx)
+  a.append_many(wtx, [(leafs[0], b"")]) # duplicated index
+  dbs = lambda tree: [tree.leaf_db, tree.order_db, tree.reverse_order_db, tree.pruned_db, tree.pruned_ro_db]
+  f = io.BytesIO()
+  chunk_size, snapshot.CHUNK_SIZE = snapshot.CHUNK_SIZE, 4096
+  writer = snapshot.SnapshotWriter(f)
+  writer.write_chunk(snapshot.META, b"{}")
+  for i, db in enumerate(dbs(a)):
+    writer.write_records(bytes([i]), wtx.cursor(db=db).iternext())
+  writer.close()
+  snapshot.CHUNK_SIZE = chunk_size
+  f.seek(0)
+  for db in dbs(b):
+    wtx.drop(db, delete=False)
+  last_records = {}
+  for chunk_type, payload in snapshot.read_chunks(f):
+    if chunk_type==snapshot.RECORDS:
+      name, records = snapshot.parse_records(payload)
+      last_records[name] = snapshot.load_records(dbs(b)[name[0]], records, wtx=wtx, last_record=last_records.get(name, None))
+  b._rebuild_nodes(wtx)
+  assert len(last_records)==5 and b.get_root(rtx=wtx)==a.get_root(rtx=wtx)
+  assert b.get_by_hash(leafs[0], rtx=wtx)==b"" and b.find_by_hash(leafs[100], rtx=wtx)==leafs[100]
+  data = bytearray(f.getvalue())
+  data[len(data)//2] ^= 1
+  try:
+    list(snapshot.read_chunks(io.BytesIO(bytes(data))))
+    raise Exception
+  except Exception as e:
+    assert "checksum" in str(e)
+  try:
+    list(snapshot.read_chunks(io.BytesIO(f.getvalue()[:-69])))
+    raise Exception
+  except Exception as e:
+    assert "truncated" in str(e) # END chunk is missed
+  print("test_snapshot_records OK")
 
 def bench(env, wtx, n=10000):
   tm=time.time()
@@ -217,6 +512,44 @@ def bench(env, wtx, n=10000):
   assert b.get_root(rtx=wtx)==b"("*5
   print("Reload take of %d take %f sec"%(n, time.time()-tm))
 
+def bench_cached_nodes(env, wtx, n=10000):
+  outputs = [(hashlib.sha256(str(i).encode()).digest(), b"\x00"*100) for i in range(n)]
+  tm=time.time()
+  a=MMRTestHash("bench_plain","~/.testleer/", env, wtx)
+  for index, obj in outputs:
+    a.append(wtx, index, obj)
+  print("Appending of %d one by one take %f sec"%(n, time.time()-tm))
+
+  tm=time.time()
+  b=MMRTestHash("bench_cached","~/.testleer/", env, wtx)
+  with b.cached_nodes(wtx):
+    for index, obj in outputs:
+      b.append(wtx, index, obj)
+  print("Appending of %d one by one with node cache take %f sec"%(n, time.time()-tm))
+
+  tm=time.time()
+  c=MMRTestHash("bench_batch","~/.testleer/", env, wtx)
+  with c.cached_nodes(wtx):
+    for i in range(0, n, 100): # blocks of 100 outputs
+      c.append_many(wtx, outputs[i:i+100])
+  print("Appending of %d in batches of 100 with node cache take %f sec"%(n, time.time()-tm))
+  assert a.get_root(rtx=wtx)==b.get_root(rtx=wtx)==c.get_root(rtx=wtx)
+
+
+def bench_commitment_updates(env, wtx, n=4096, updates=1000):
+  leafs = commitment_leafs(n+updates)
+  new_leafs = [((i*7919%n).to_bytes(5,'big'), leafs[n+i], b"") for i in range(updates)]
+  trees = [CommitmentMMRPairwise("bench_comm_pairwise","~/.testleer/", env, wtx), CommitmentMMR("bench_comm_batch","~/.testleer/", env, wtx)]
+  for tree in trees:
+    with tree.cached_nodes(wtx):
+      tree.append_many(wtx, [(leaf, b"") for leaf in leafs[:n]])
+  for tree, name in zip(trees, ["pairwise summation", "batched summation"]):
+    tm=time.time()
+    with tree.cached_nodes(wtx):
+      tree.update_index_by_num_many(wtx, new_leafs)
+    print("Root recalculation after %d leaf updates with %s take %f sec"%(updates, name, time.time()-tm))
+  assert trees[0].get_root(rtx=wtx)==trees[1].get_root(rtx=wtx)
+
 
 def merkle_test():
   wipe_test_dirs()
@@ -229,5 +562,13 @@ def merkle_test():
     test_save_pruned_db(env, wtx)
     test_state_assignment(env, wtx)
     test_unique(env, wtx)
+    test_batch_operations(env, wtx)
+    test_cached_nodes(env, wtx)
+    test_view(env, wtx)
+    test_commitment_sum_level(env, wtx)
+    test_flat_file_nodes(env, wtx)
+    test_prune_horizon(env, wtx)
+    test_proofs(env, wtx)
+    test_snapshot_records(env, wtx)
   wipe_test_dirs()
 
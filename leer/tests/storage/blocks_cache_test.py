@@ -0,0 +1,36 @@
+import lmdb, tempfile
+from leer.core.storage.blocks_storage import BlocksCache
+
+
+class DummyBlock:
+  def __init__(self, name):
+    self.name, self.tx = name, None
+
+def test_blocks_cache():
+  env = lmdb.open(tempfile.mkdtemp())
+  cache = BlocksCache()
+  with env.begin(write=False) as rtx:
+    assert cache.get(b"a", rtx=rtx)==None
+    cache.put(b"a", DummyBlock("a"), 100, rtx=rtx)
+    block = cache.get(b"a", rtx=rtx)
+    block.tx = "built tx" # copies are given out
+    assert cache.get(b"a", rtx=rtx).tx==None and cache.stats()['hits']==2
+  # block written by aborted transaction is not cached
+  wtx = env.begin(write=True)
+  cache.invalidate(b"a", wtx=wtx)
+  cache.put(b"a", DummyBlock("uncommitted"), 100, rtx=wtx)
+  assert cache.get(b"a", rtx=wtx)==None
+  wtx.abort()
+  with env.begin(write=True) as wtx:
+    cache.put(b"a", DummyBlock("aborted"), 100, rtx=wtx)
+    assert cache.get(b"a", rtx=wtx)==None
+    wtx.put(b"k", b"v")
+  # after commit the next write transaction may cache it
+  with env.begin(write=True) as wtx:
+    cache.put(b"a", DummyBlock("committed"), 100, rtx=wtx)
+    assert cache.get(b"a", rtx=wtx).name=="committed"
+  cache.max_bytes = 250
+  with env.begin(write=False) as rtx:
+    for name in [b"b", b"c"]:
+      cache.put(name, DummyBlock(name), 100, rtx=rtx)
+    assert cache.get(b"a", rtx=rtx)==None and cache.stats()['bytes']==200
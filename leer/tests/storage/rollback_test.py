@@ -0,0 +1,41 @@
+import lmdb, tempfile, os
+from leer.core.storage.blocks_storage import RollBack, BlocksDiscStorage
+
+
+def make_rollback():
+  rb = RollBack()
+  rb.prev_state = os.urandom(32)
+  rb.pruned_inputs = [[[i, os.urandom(32), os.urandom(200)], [i+7, os.urandom(65), b""]] for i in range(3)]
+  rb.updated_excesses = [(b"\x00"*4+b"\x01", os.urandom(65), os.urandom(100))]
+  rb.num_of_added_outputs, rb.num_of_added_excesses = 2, 3
+  rb.burdens = [(os.urandom(65), None)]
+  return rb
+
+def test_rollback_serialization():
+  rb = make_rollback()
+  full, compact = RollBack(), RollBack()
+  assert full.deserialize_raw(rb.serialize(compact=False)+b"tail")==b"tail"
+  assert compact.deserialize_raw(rb.serialize(compact=True))==b""
+  assert full.pruned_inputs==rb.pruned_inputs
+  assert compact.pruned_inputs==[[[_t[0], None, None], [_c[0], None, None]] for _t, _c in rb.pruned_inputs]
+  for _rb in [full, compact]:
+    assert _rb.prev_state==rb.prev_state and _rb.updated_excesses==rb.updated_excesses
+    assert (_rb.num_of_added_outputs, _rb.num_of_added_excesses, _rb.burdens)==(2, 3, rb.burdens)
+  assert len(rb.serialize(compact=True)) < len(rb.serialize(compact=False))-600
+
+def test_rollback_retention():
+  env = lmdb.open(tempfile.mkdtemp(), max_dbs=10)
+  with env.begin(write=True) as wtx:
+    storage = BlocksDiscStorage("", env, wtx=wtx)
+    assert storage.rollback_horizon(rtx=wtx)==-1
+    for height in range(10):
+      storage.put_rollback_object(bytes([height])*32, b"rb%d"%height, wtx=wtx, height=height)
+    # rolled back block does not leave reference in height index
+    assert storage.pop_rollback_object(bytes([9])*32, wtx=wtx, height=9)==b"rb9"
+    assert storage.delete_rollback_objects_up_to(5, 4, wtx=wtx)==4
+    assert storage.rollback_horizon(rtx=wtx)==3
+    assert storage.delete_rollback_objects_up_to(5, 4, wtx=wtx)==2
+    assert storage.rollback_horizon(rtx=wtx)==5
+    assert all(len(key)==32 for key in wtx.cursor(db=storage.revert_db).iternext(keys=True, values=False))
+    assert storage.delete_rollback_objects_up_to(100, 100, wtx=wtx)==3
+    assert [storage.get_rollback_object(bytes([h])*32, rtx=wtx) for h in range(10)]==[None]*10
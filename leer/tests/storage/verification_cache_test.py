@@ -0,0 +1,43 @@
+import leer.core.storage.verification_cache as verification_cache_module
+from leer.core.storage.verification_cache import VerificationCache
+
+def test_semi_context_keys():
+  cache = VerificationCache()
+  cache[(b"tx"*1000, 10)] = True
+  cache[(b"bad tx", 10)] = False
+  assert cache[(b"tx"*1000, 11)] and not cache[(b"bad tx", 9)]
+  for key in [(b"tx"*1000, 9), (b"bad tx", 11), b"unknown"]:
+    try:
+      cache[key]
+      assert False
+    except KeyError:
+      pass
+  assert cache.stats()['hits'] == 4 and cache.stats()['misses'] == 1
+
+def test_lru_eviction_by_bytes():
+  cache = VerificationCache()
+  cache.max_bytes = 10*cache.entry_size
+  for i in range(10):
+    cache[bytes([i])*100] = True
+  cache[bytes([0])*100] # refresh
+  cache[b"new"] = False
+  assert len(cache) == 10 and cache.stats()['evictions'] == 1
+  assert cache[bytes([0])*100]
+  try:
+    cache[bytes([1])*100]
+    assert False
+  except KeyError:
+    pass
+
+def test_expiration(monkeypatch):
+  now = [1000000.]
+  monkeypatch.setattr(verification_cache_module, "time", lambda: now[0])
+  cache = VerificationCache()
+  cache[b"old"] = True
+  now[0] += cache.ttl/2
+  cache[b"old"] = True # reset moves entry to later bucket
+  cache[b"young"] = True
+  now[0] += cache.ttl/2 + 2*cache.bucket_width
+  assert cache[b"old"] and cache[b"young"]
+  now[0] += cache.ttl/2 + 2*cache.bucket_width
+  assert len(cache) == 0 and cache.stats()['expirations'] == 2
@@ -0,0 +1,73 @@
+import asyncio, multiprocessing, os, select
+from leer.syncer import Syncer, MessageQueue, SharedRing, encode_message, decode_message
+
+
+def echo(syncer):
+  queue = syncer.queues['Blockchain']
+  while True:
+    queue.wait()
+    message = queue.get()
+    if message['action']=="stop":
+      return
+    message['sender'], message['action'] = "Blockchain", "echo"
+    syncer.queues['RPCManager'].put(message)
+
+def test_message_framing():
+  message = {'action':'take the blocks', 'blocks': os.urandom(100000), 'num':3, 'node':("127.0.0.1", 8888), 'small': b"\x01"}
+  header, *raw_values = encode_message(message)
+  assert raw_values==[message['blocks']] and len(header)<200
+  assert decode_message(header, raw_values)==message
+
+def test_message_queue():
+  queue = MessageQueue()
+  assert queue.empty() and not queue.wait(0.01)
+  assert select.select([queue], [], [], 0)[0]==[]
+  queue.put({'action':'first'})
+  queue.put({'action':'second', 'txos': b"\x00"*5000})
+  assert queue.wait(1) and select.select([queue], [], [], 0)[0]==[queue]
+  assert queue.get()=={'action':'first'}
+  assert queue.get()=={'action':'second', 'txos': b"\x00"*5000}
+  assert queue.empty()
+
+def test_shared_ring():
+  ring = SharedRing(100)
+  first, second = ring.write(b"a"*40), ring.write(b"b"*40)
+  assert first==(0, 40, 0) and second==(48, 40, 0)
+  assert ring.write(b"c"*40)==None # no space till first part is read
+  assert ring.read(first)==b"a"*40
+  third = ring.write(b"c"*40) # does not fit till the end, written from the beginning of next generation
+  assert third==(0, 40, 1)
+  assert ring.read(second)==b"b"*40 and ring.read(third)==b"c"*40
+  assert ring.write(b"d"*93)==None and ring.write(b"d"*44)==(48, 44, 1)
+
+def test_message_queue_shared_buffer():
+  queue = MessageQueue(shared_buffer_size=64*1024)
+  payloads = [os.urandom(20000) for i in range(10)] # do not fit to shared buffer all at once
+  for i, payload in enumerate(payloads):
+    queue.put({'action':'take the blocks', 'num':i, 'blocks':memoryview(payload)})
+  for i, payload in enumerate(payloads):
+    queue.wait(1)
+    assert queue.get()=={'action':'take the blocks', 'num':i, 'blocks':payload}
+  assert queue.empty()
+
+def test_syncer_processes():
+  syncer = Syncer()
+  process = multiprocessing.Process(target=echo, args=(syncer,))
+  process.start()
+  loop = asyncio.new_event_loop()
+  queue, received = syncer.queues['RPCManager'], []
+  def on_message():
+    while not queue.empty():
+      received.append(queue.get())
+      if len(received)==10:
+        loop.stop()
+  loop.add_reader(queue.fileno(), on_message)
+  for i in range(10):
+    syncer.queues['Blockchain'].put({'action':'ping', 'id':i, 'payload':bytes([i])*4096, 'hash':memoryview(bytes([i])*32)})
+  loop.call_later(10, loop.stop)
+  loop.run_forever()
+  loop.close()
+  syncer.queues['Blockchain'].put({'action':'stop'})
+  process.join(10)
+  assert [m['id'] for m in received]==list(range(10))
+  assert all(m['action']=="echo" and m['payload']==bytes([m['id']])*4096 and m['hash']==bytes([m['id']])*32 for m in received)
@@ -21,7 +21,7 @@ class NetworkManager:
     self.load_from_disc()
     #for node in self.nodes.values():
     #  self.connect_to(node)
-    self.loop.call_soon(self.check_global_message_queue)
+    self.loop.add_reader(self.global_message_queue.fileno(), self.check_global_message_queue)
     self.nodes={}
     self.reconnect_list = {}
     self.connecting = [] # nodes that are connecting, but not connected yet
@@ -199,11 +199,11 @@ class NetworkManager:
 
     if _type == "take the blocks":
       try:
-        _ser_num, blocks = message[:2], message[2:]
+        _ser_num, blocks = message[:2], memoryview(message)[2:] # large payloads are passed without copying
         num = int.from_bytes(_ser_num,"big")
         self.syncer.queues["Blockchain"].put({'action': 'take the blocks',
                                               'id':str(uuid4()), "num": num, 
-                                              "blocks": bytes(blocks), "node":(node.host, node.port), 'sender':"NetworkManager"})
+                                              "blocks": blocks, "node":(node.host, node.port), 'sender':"NetworkManager"})
       except Exception as e:
         print("exception nm", e)
         pass #TODO DoS protection
@@ -221,13 +221,13 @@ class NetworkManager:
 
     if _type == "take the txos":
       try:
-        _ser_num, message = message[:2], message[2:]
+        _ser_num, message = message[:2], memoryview(message)[2:] # large payloads are passed without copying
         num = int.from_bytes(_ser_num,"big")
         txos_hashes, txos_lengths, txos = message[:num*65], message[num*65:num*65+num*2], message[num*65+num*2:] 
         self.syncer.queues["Blockchain"].put({'action': 'take the txos',
                                               'id':str(uuid4()), "num": num, 
-                                              "txos_hashes": bytes(txos_hashes), "txos_lengths": bytes(txos_lengths),
-                                              "txos": bytes(txos), "node":(node.host, node.port), 'sender':"NetworkManager"})
+                                              "txos_hashes": txos_hashes, "txos_lengths": txos_lengths,
+                                              "txos": txos, "node":(node.host, node.port), 'sender':"NetworkManager"})
       except Exception as e:
         print("exception nm", e)
         pass #TODO DoS protection
@@ -454,10 +454,9 @@ class NetworkManager:
                 asyncio.ensure_future(coro, loop=self.loop)'''
           if action == "stop":
             logger.info("NetworkManager stops")
+            self.loop.remove_reader(self.global_message_queue.fileno())
             self.loop.stop()
             return
-      if self.up:
-        self.loop.call_later(0.5, self.check_global_message_queue)
     
   async def reconnect_loop(self):
     def try_num_to_delay(try_num):
@@ -1,4 +1,4 @@
-from time import time, sleep
+from time import time
 from leer.wallet.key_db import KeyDB
 from leer.wallet.key_db_migrations import apply_migrations
 
@@ -27,8 +27,8 @@ def wallet(syncer, config):
     message_queue = syncer.queues['Wallet']
     start_time = time()
     result = None
-    while True:
-      put_back = [] #We wait for specific message, all others will wait for being processed
+    put_back = [] #We wait for specific message, all others will wait for being processed
+    while not result and message_queue.wait(max(0, start_time+timeout-time())):
       while not message_queue.empty():
         message = message_queue.get()
         if (not 'id' in message)  or (not message['id']==_id):
@@ -36,13 +36,10 @@ def wallet(syncer, config):
           continue
         result = message['result']
         break
-      for message in put_back:
-        message_queue.put(message)
-      if result:
-        break
-      sleep(0.01)
-      if time()-start_time>timeout:
-        raise KeyError
+    for message in put_back:
+      message_queue.put(message)
+    if not result:
+      raise KeyError
     if result=='error':
       raise KeyError
     return result['value']
@@ -86,7 +83,7 @@ def wallet(syncer, config):
     apply_migrations(cursor)
   notify('last wallet update', time())
   while True:
-    sleep(0.01)
+    message_queue.wait()
     while not message_queue.empty():
       message = message_queue.get()
       if 'action' in message:
@@ -0,0 +1,23 @@
+'''
+  Export snapshot of blockchain state at current tip for bootstrapping of other nodes.
+  Usage: python3 export_snapshot.py path/to/config.json path/to/snapshot
+  Node with this config should be stopped.
+'''
+import sys
+from os.path import expanduser
+
+from leer.__main__ import commentjson_loads
+from leer.core import core_loop
+from leer.core.storage.snapshot import export_snapshot
+
+if __name__ == '__main__':
+    config_path, snapshot_path = sys.argv[1], sys.argv[2]
+    with open(config_path, "r") as f:
+      config = commentjson_loads(f.read())
+    for t in config["location"]:
+      config["location"][t] = expanduser(config["location"][t])
+    config.get("storage", {}).pop("snapshot", None) # never import during export
+    core_loop.init_storage_space(config)
+    with core_loop.storage_space.env.begin(write=False) as rtx:
+      meta = export_snapshot(core_loop.storage_space, snapshot_path, rtx=rtx)
+    print("Snapshot at height %d (block %s) is written to %s"%(meta['height'], meta['tip'], snapshot_path))
@@ -0,0 +1,51 @@
+'''
+  Measure parsing of network messages: batch of 1024 headers and block message of about 60KB.
+  Usage: python3 parsing_benchmark.py [repeats]
+'''
+import sys, os
+from time import time
+
+from leer.core.utils import Reader
+from leer.core.primitives.header import Header, PoPoW, VoteData
+from leer.core.primitives.transaction_skeleton import TransactionSkeleton
+from leer.core.primitives.block import Block
+from leer.core.parameters.constants import initial_target
+
+def make_header(height):
+  return Header(height = height, supply = 0, full_offset = 0,
+                merkles = [os.urandom(65), os.urandom(32), os.urandom(65)],
+                popow = PoPoW([os.urandom(32) for _ in range(height.bit_length())]),
+                votedata = VoteData(), timestamp = 1500000000+height*60,
+                target = initial_target, version = 1, nonce = os.urandom(8))
+
+def generate_headers(num):
+  return b"".join([make_header(height).serialize() for height in range(num)])
+
+def generate_block_message(size):
+  skeleton = TransactionSkeleton()
+  while len(skeleton.output_indexes)*69 < size:
+    skeleton.output_indexes.append(os.urandom(65))
+    skeleton.output_relay_fees.append(0)
+  return make_header(1000).serialize() + skeleton.serialize(rich_format=False)
+
+def parse_headers(serialized, num):
+  reader = Reader(serialized)
+  for _ in range(num):
+    Header().deserialize_raw(reader)
+
+def parse_block(serialized):
+  block = Block(storage_space=None)
+  block.deserialize_raw(serialized)
+
+def measure(f, repeats):
+  start = time()
+  for _ in range(repeats):
+    f()
+  return (time()-start)/repeats
+
+if __name__ == '__main__':
+    repeats = int(sys.argv[1]) if len(sys.argv)>1 else 20
+    headers = generate_headers(1024)
+    block = generate_block_message(60000)
+    print("1024 headers (%d bytes): %.2f ms"%(len(headers), 1000*measure(lambda: parse_headers(headers, 1024), repeats)))
+    print("block message (%d bytes): %.2f ms"%(len(block), 1000*measure(lambda: parse_block(block), repeats)))
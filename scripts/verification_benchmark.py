@@ -0,0 +1,60 @@
+'''
+  Replay non-context verification of outputs of main chain blocks and report blocks/sec
+  for sequential verification in core process and for verification pipelined through
+  pool of processes (see leer.core.lubbadubdub.verification_pool).
+  Usage: python3 verification_benchmark.py path/to/config.json from_height to_height
+  Node with this config should be stopped.
+'''
+import sys
+from time import time
+from os.path import expanduser
+
+from leer.__main__ import commentjson_loads
+from leer.core import core_loop
+from leer.core.lubbadubdub.ioput import IOput
+from leer.core.lubbadubdub import verification_pool
+from leer.core.storage.verification_cache import verification_cache
+
+def load_segment(storage_space, from_height, to_height, rtx):
+  blocks = []
+  for height in range(from_height, to_height+1):
+    block_hash = storage_space.headers_storage.get_main_chain_hash(height, rtx=rtx)
+    block = storage_space.blocks_storage.get(block_hash, rtx=rtx)
+    outputs = []
+    for output_index in block.transaction_skeleton.output_indexes:
+      serialized_output = storage_space.txos_storage.find_serialized(output_index, rtx=rtx)
+      if serialized_output: # spent outputs may be pruned
+        outputs.append(serialized_output)
+    blocks.append(outputs)
+  return blocks
+
+def deserialize(serialized_output):
+  output = IOput()
+  output.deserialize_raw(serialized_output, verify=False)
+  return output
+
+def replay(blocks, pipelined):
+  deserialized = [[deserialize(o) for o in outputs] for outputs in blocks]
+  verification_cache.clear()
+  start = time()
+  if pipelined:
+    verification_pool.submit(sum(blocks, []))
+  for outputs in deserialized:
+    for output in outputs:
+      assert output.verify()
+  return len(blocks)/(time()-start)
+
+if __name__ == '__main__':
+    config_path, from_height, to_height = sys.argv[1], int(sys.argv[2]), int(sys.argv[3])
+    with open(config_path, "r") as f:
+      config = commentjson_loads(f.read())
+    for t in config["location"]:
+      config["location"][t] = expanduser(config["location"][t])
+    config.get("storage", {}).pop("snapshot", None)
+    core_loop.init_storage_space(config)
+    with core_loop.storage_space.env.begin(write=False) as rtx:
+      blocks = load_segment(core_loop.storage_space, from_height, to_height, rtx=rtx)
+    print("%d blocks, %d outputs"%(len(blocks), sum(len(outputs) for outputs in blocks)))
+    verification_pool._get_pool().submit(int).result() # workers start is not part of replay
+    print("sequential: %.1f blocks/sec"%replay(blocks, pipelined=False))
+    print("pipelined:  %.1f blocks/sec"%replay(blocks, pipelined=True))